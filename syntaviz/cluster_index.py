@@ -0,0 +1,938 @@
+# Copyright 2018 Comcast Cable Communications Management, LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import mmap
+import struct
+import bisect
+import itertools
+import threading
+from collections import deque
+import numpy as np
+from lru_cache import LRUCache
+from token_index import TokenIndex
+
+'''
+A compact, array-backed alternative to the nested [count, dict, list] clusters
+built by cluster_query.cluster_counts_and_queries.
+
+Every cluster is a node with an integer ID. The nodes are numbered in breadth first
+order starting from a virtual root (node 0) whose children are the root clusters,
+so the children of a node always have consecutive IDs:
+    child_ptr[n]:child_ptr[n + 1]   IDs of the subclusters of node n
+    qid_ptr[n]:qid_ptr[n + 1]       slice of qid_data holding the query IDs of node n
+    node_label[n]                   position of the name of node n in labels
+    node_parent[n]                  ID of the parent of node n (-1 for the virtual root)
+    node_total[n]                   total (non-unique) count of the queries of node n
+The subclusters of every node are numbered in descending order of their unique counts
+(ties broken by name), and child_by_total[child_ptr[n]:child_ptr[n + 1]] holds the same
+IDs sorted by descending total count.
+The query IDs of every node are sorted by ID in qid_data. qid_by_freq holds the same
+query IDs sorted by descending frequency (ties broken by ID), so a page of the queries
+of a node is just a slice of one of the two arrays.
+
+edge_keys holds node_parent[n] * len(labels) + node_label[n] for every node n except the
+virtual root, sorted, and edge_nodes the corresponding node IDs. A subcluster is found by a
+binary search on it, without looking at the other subclusters of its parent.
+label_nodes[label_ptr[l]:label_ptr[l + 1]] lists the (sorted) IDs of all the nodes named
+labels[l], at any depth, so the clusters of a name are found without walking the tree.
+
+nondep_count[n] and nondep_total[n] are the unique and total counts of the "non-dependent"
+queries of node n, that is the queries of n which are not in any of its subclusters.
+qnode_data[qnode_ptr[q]:qnode_ptr[q + 1]] lists the nodes containing the query q, which
+is used to find the subclusters of a query without walking the subclusters of a node.
+All the query IDs are kept in a single int32 array, so the memory grows with the
+data instead of with the number of Python objects.
+
+The index can be saved, together with the queries, their frequencies and the actions,
+to a versioned binary snapshot (see save_snapshot). Loading a snapshot memory maps the
+file, so it is almost instant and the pages are shared among the processes using it.
+'''
+
+ROOT = 0
+# The name of the cluster into which the small subclusters of a node are folded (see prune_nodes)
+OTHER_LABEL = u'[other]'
+
+SNAPSHOT_MAGIC = b'SYNTAVIZ'
+SNAPSHOT_VERSION = 5
+# Every array in the snapshot starts at a multiple of this many bytes
+SNAPSHOT_ALIGN = 64
+# Number of array elements written to a snapshot at a time
+SNAPSHOT_BLOCK = 2 ** 22
+# The arrays of the index (and their dtypes) that are saved in a snapshot
+INDEX_ARRAYS = {
+    'node_label': np.int32,
+    'node_parent': np.int32,
+    'node_total': np.int64,
+    'child_ptr': np.int32,
+    'child_by_total': np.int32,
+    'edge_keys': np.int64,
+    'edge_nodes': np.int32,
+    'label_ptr': np.int64,
+    'label_nodes': np.int32,
+    'qid_ptr': np.int64,
+    'qid_data': np.int32,
+    'qid_by_freq': np.int32,
+    'nondep_count': np.int32,
+    'nondep_total': np.int64,
+    'qnode_ptr': np.int64,
+    'qnode_data': np.int32,
+}
+
+
+class StringTable(object):
+    '''
+    A read-only list of strings kept as a single array of utf-8 bytes and an array
+    of offsets. Indexing it returns unicode strings.
+    '''
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [astr.encode('utf-8') if isinstance(astr, unicode) else str(astr) for astr in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(astr) for astr in encoded])
+        data = np.frombuffer(b''.join(encoded) or b'\0', dtype=np.uint8)[:offsets[-1]]
+        return cls(offsets, data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('string table index out of range')
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class IndexNode(object):
+    '''
+    A read-only view of one node of a ClusterIndex. It behaves like the dictionary
+    of subclusters of the nested clusters: node[key] returns a tuple of
+    (unique count, subclusters, query IDs, total count) for the subcluster named key.
+    '''
+    __slots__ = ('index', 'node_id')
+
+    def __init__(self, index, node_id):
+        self.index = index
+        self.node_id = node_id
+
+    def __getitem__(self, key):
+        return self.index.entry(self.index.child(self.node_id, key))
+
+    def __contains__(self, key):
+        try:
+            self.index.child(self.node_id, key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for achild in self.index.children(self.node_id):
+            yield self.index.label(achild)
+
+    def __len__(self):
+        return int(self.index.child_ptr[self.node_id + 1] - self.index.child_ptr[self.node_id])
+
+    def keys(self):
+        return list(self)
+
+
+class ClusterIndex(IndexNode):
+    '''
+    The array-backed cluster index. The index itself is the view of the virtual
+    root, so it can be passed wherever the nested clusters are expected.
+    '''
+
+    def __init__(self, arrays, labels, queries=None, actions=None):
+        '''
+        :param arrays: A dictionary of the numpy arrays described in the module docstring
+                       and "freqs", the frequency of every query. It may also contain
+                       "qid_action", the position of the action of every query in actions
+                       (-1 if the action is not known).
+        :param labels: The sorted list of the names of the clusters
+        :param queries: Optional list of the queries
+        :param actions: Optional list of the names of the actions
+        '''
+        IndexNode.__init__(self, self, ROOT)
+        self.arrays = arrays
+        self.labels = labels
+        self.queries = queries
+        self.actions = actions
+        self.qid_action = None
+        # The token_index.TokenIndex of the queries, if it is known
+        self.token_index = None
+        for aname in arrays:
+            setattr(self, aname, arrays[aname])
+
+    @classmethod
+    def from_clust(cls, clust, freq_list=None):
+        '''
+        Builds the index from the nested clusters created by
+        cluster_query.cluster_counts_and_queries
+        '''
+        labels = set()
+        pending = [clust]
+        while pending:
+            asubclust = pending.pop()
+            labels.update(asubclust)
+            pending.extend(asubclust[akey][1] for akey in asubclust)
+        labels = sorted(labels)
+        label_ids = {alabel: i for i, alabel in enumerate(labels)}
+
+        node_label = [-1]
+        node_parent = [-1]
+        node_total = [0]
+        child_ptr = []
+        qid_lists = [[]]
+        # Nodes leave the queue in the order of their IDs, so the children of
+        # every node get consecutive IDs. They are numbered in descending order
+        # of their unique counts.
+        queue = deque([(ROOT, clust)])
+        while queue:
+            node_id, asubclust = queue.popleft()
+            child_ptr.append(len(node_label))
+            for akey in sorted(asubclust, key=lambda x: (-asubclust[x][0], x)):
+                entry = asubclust[akey]
+                queue.append((len(node_label), entry[1]))
+                node_label.append(label_ids[akey])
+                node_parent.append(node_id)
+                node_total.append(entry[3])
+                qid_lists.append(entry[2])
+        child_ptr.append(len(node_label))
+
+        qid_ptr = np.zeros(len(qid_lists) + 1, dtype=np.int64)
+        qid_ptr[1:] = np.cumsum([len(aqids) for aqids in qid_lists])
+        qid_data = np.fromiter(itertools.chain.from_iterable(qid_lists),
+                               dtype=np.int32, count=int(qid_ptr[-1]))
+        del qid_lists
+        return cls._from_nodes(labels,
+                               np.array(node_label, dtype=np.int32),
+                               np.array(node_parent, dtype=np.int32),
+                               np.array(node_total, dtype=np.int64),
+                               np.array(child_ptr, dtype=np.int32),
+                               qid_ptr, qid_data, freq_list)
+
+    @classmethod
+    def from_columns(cls, columns, labels, freq_list=None, maxlevel=np.inf):
+        '''
+        Builds the index from the columns of the parse trees (see tree_columns.read_columns)
+        with numpy, without building the nested clusters. The result is the same as
+        from_clust of the nested clusters built from the same trees.
+        :param labels: The sorted list of the names of the nodes of the trees
+        :param maxlevel: The nodes deeper than maxlevel (the roots are at level 0) are left out
+        '''
+        tree_ptr = columns['tree_ptr']
+        tree_label = columns['node_label']
+        tree_parent = columns['node_parent']
+        tree_qid = np.repeat(columns['qids'], np.diff(tree_ptr)).astype(np.int32)
+        num_labels = max(len(labels), 1)
+        if freq_list is None:
+            freqs = np.ones(tree_qid.max() + 1 if len(tree_qid) else 0, dtype=np.int64)
+        else:
+            freqs = np.array(freq_list, dtype=np.int64)
+
+        # Every node of every tree belongs to the cluster given by its path from the root.
+        # The clusters get their IDs level by level: the clusters of a level are sorted
+        # by the ID of their parent, then by descending unique count and by name, which is
+        # the breadth first order of from_clust.
+        tree_node = np.full(len(tree_label), -1, dtype=np.int64)
+        node_label = [np.array([-1], dtype=np.int32)]
+        node_parent = [np.array([-1], dtype=np.int32)]
+        node_count = [np.array([0], dtype=np.int64)]
+        node_total = [np.array([0], dtype=np.int64)]
+        num_nodes = 1
+        level = np.flatnonzero(tree_parent < 0)
+        depth = 0
+        while len(level) and depth <= maxlevel:
+            parent = np.where(tree_parent[level] < 0, ROOT, tree_node[tree_parent[level]])
+            # The unique (parent, name) pairs of the level are its clusters
+            keys, inverse = np.unique(parent * num_labels + tree_label[level], return_inverse=True)
+            count = np.bincount(inverse, minlength=len(keys)).astype(np.int64)
+            total = np.bincount(inverse, weights=freqs[tree_qid[level]], minlength=len(keys))
+            key_parent = keys // num_labels
+            key_label = keys % num_labels
+            order = np.lexsort((key_label, -count, key_parent))
+            rank = np.empty(len(keys), dtype=np.int64)
+            rank[order] = np.arange(len(keys))
+            tree_node[level] = num_nodes + rank[inverse]
+            node_label.append(key_label[order].astype(np.int32))
+            node_parent.append(key_parent[order].astype(np.int32))
+            node_count.append(count[order])
+            node_total.append(np.round(total[order]).astype(np.int64))
+            num_nodes += len(keys)
+            # The next level holds the tree nodes whose parents are in this level
+            in_level = np.zeros(len(tree_label), dtype=bool)
+            in_level[level] = True
+            level = np.flatnonzero((tree_parent >= 0) & in_level[np.maximum(tree_parent, 0)])
+            depth += 1
+        node_label = np.concatenate(node_label)
+        node_parent = np.concatenate(node_parent)
+        node_count = np.concatenate(node_count)
+        node_total = np.concatenate(node_total)
+        # Only the names of the clusters are kept (not those of the left out nodes)
+        labels, node_label = compact_labels(labels, node_label)
+
+        child_ptr = child_pointers(node_parent)
+        # Every tree node adds its query to its cluster
+        kept = tree_node >= 0
+        qid_ptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        qid_ptr[1:] = np.cumsum(node_count)
+        num_queries = max(len(freqs), 1)
+        qid_data = (np.sort(tree_node[kept] * num_queries + tree_qid[kept]) % num_queries).astype(np.int32)
+        return cls._from_nodes(labels, node_label, node_parent, node_total,
+                               child_ptr, qid_ptr, qid_data, freq_list)
+
+    @classmethod
+    def _from_nodes(cls, labels, node_label, node_parent, node_total, child_ptr, qid_ptr, qid_data, freq_list):
+        # Builds the rest of the arrays of the index from the nodes numbered in breadth first order
+        if freq_list is None:
+            # Without frequencies, every query counts once
+            freqs = np.ones(qid_data.max() + 1 if len(qid_data) else 0, dtype=np.int64)
+        else:
+            freqs = np.array(freq_list, dtype=np.int64)
+        qid_data, qid_by_freq = sort_queries(qid_ptr, qid_data, freqs)
+        edge_keys, edge_nodes = index_edges(node_parent, node_label, len(labels))
+        label_ptr, label_nodes = index_labels(node_label, len(labels))
+        nondep_count, nondep_total = count_nondependent(qid_ptr, qid_data, node_parent, freqs)
+        qnode_ptr, qnode_data = invert_queries(qid_ptr, qid_data, len(freqs))
+        arrays = {
+            'node_label': node_label,
+            'node_parent': node_parent,
+            'node_total': node_total,
+            'child_ptr': child_ptr,
+            'child_by_total': sort_children(node_parent, node_total),
+            'edge_keys': edge_keys,
+            'edge_nodes': edge_nodes,
+            'label_ptr': label_ptr,
+            'label_nodes': label_nodes,
+            'qid_ptr': qid_ptr,
+            'qid_data': qid_data,
+            'qid_by_freq': qid_by_freq,
+            'nondep_count': nondep_count,
+            'nondep_total': nondep_total,
+            'qnode_ptr': qnode_ptr,
+            'qnode_data': qnode_data,
+            'freqs': freqs,
+        }
+        return cls(arrays, labels)
+
+    @property
+    def num_nodes(self):
+        return len(self.node_label)
+
+    def label_id(self, label):
+        '''
+        Returns the position of a cluster name in the sorted list of labels
+        '''
+        i = bisect.bisect_left(self.labels, label)
+        if i == len(self.labels) or self.labels[i] != label:
+            raise KeyError(label)
+        return i
+
+    def label(self, node_id):
+        return self.labels[self.node_label[node_id]]
+
+    def children(self, node_id, by_total=False):
+        '''
+        IDs of the subclusters of a node in descending order of their unique counts
+        or, if by_total is True, of their total counts
+        '''
+        if by_total:
+            return self.child_by_total[self.child_ptr[node_id]:self.child_ptr[node_id + 1]]
+        return np.arange(self.child_ptr[node_id], self.child_ptr[node_id + 1])
+
+    def child(self, node_id, key):
+        '''
+        ID of the subcluster of node_id named key. Raises KeyError if there is none.
+        '''
+        edge = node_id * len(self.labels) + self.label_id(key)
+        i = np.searchsorted(self.edge_keys, edge)
+        if i == len(self.edge_keys) or self.edge_keys[i] != edge:
+            raise KeyError(key)
+        return int(self.edge_nodes[i])
+
+    def find(self, key, node_id=ROOT):
+        '''
+        ID of the node for a (possibly nested, "|" separated) key relative to node_id
+        '''
+        if not key:
+            return node_id
+        for akey in key.split('|'):
+            node_id = self.child(node_id, akey)
+        return node_id
+
+    def path(self, node_id):
+        '''
+        IDs of the nodes from the root cluster down to node_id (found through the
+        parent pointers)
+        '''
+        path = []
+        while node_id != ROOT:
+            path.append(int(node_id))
+            node_id = self.node_parent[node_id]
+        return path[::-1]
+
+    def key(self, node_id):
+        '''
+        The "|" separated key of a node
+        '''
+        return '|'.join(self.label(anode) for anode in self.path(node_id))
+
+    def count(self, node_id):
+        '''
+        Number of unique queries of a node (or an array of nodes)
+        '''
+        return self.qid_ptr[np.add(node_id, 1)] - self.qid_ptr[node_id]
+
+    def total(self, node_id):
+        '''
+        Total (non-unique) count of the queries of a node (or an array of nodes)
+        '''
+        return self.node_total[node_id]
+
+    def qids(self, node_id, by_freq=False):
+        '''
+        The query IDs of a node, sorted by ID or (if by_freq is True) by descending
+        frequency. The result is a slice of the index, so nothing is copied.
+        '''
+        qid_data = self.qid_by_freq if by_freq else self.qid_data
+        return qid_data[self.qid_ptr[node_id]:self.qid_ptr[node_id + 1]]
+
+    def labeled(self, label_ids):
+        '''
+        The sorted IDs of the nodes (at any depth) named by any of the given label positions
+        '''
+        label_ids = np.asarray(label_ids, dtype=np.int64)
+        starts = self.label_ptr[label_ids]
+        nodes = self.label_nodes[flat_ranges(starts, self.label_ptr[label_ids + 1] - starts)]
+        return np.sort(nodes) if len(label_ids) > 1 else nodes
+
+    def query_nodes(self, qid):
+        '''
+        IDs of all the nodes containing a query
+        '''
+        return self.qnode_data[self.qnode_ptr[qid]:self.qnode_ptr[qid + 1]]
+
+    def in_node(self, qids, node_id):
+        '''
+        For every query of an array of query IDs, whether it is in the node. Only the nodes
+        of the given queries are looked at, so it takes the same time for any node.
+        '''
+        qids = np.asarray(qids, dtype=np.int64)
+        starts = self.qnode_ptr[qids]
+        lengths = self.qnode_ptr[qids + 1] - starts
+        # The nodes of all the queries in qnode_data
+        found = self.qnode_data[flat_ranges(starts, lengths)] == node_id
+        return np.bincount(np.repeat(np.arange(len(qids)), lengths)[found], minlength=len(qids)) > 0
+
+    def subclusters_of_query(self, node_id, qid):
+        '''
+        Names of the subclusters of node_id which contain the query qid
+        '''
+        nodes = self.query_nodes(qid)
+        return [self.label(achild) for achild in nodes[self.node_parent[nodes] == node_id]]
+
+    def entry(self, node_id):
+        '''
+        Returns the node in the [count, subclusters, query IDs, total] layout of the
+        nested clusters
+        '''
+        return (int(self.count(node_id)), IndexNode(self, node_id),
+                self.qids(node_id), int(self.total(node_id)))
+
+    def levels(self):
+        '''
+        The level of every node: the root clusters are at level 0 (and the virtual root at -1)
+        '''
+        node_level = np.empty(self.num_nodes, dtype=np.int32)
+        # The nodes of every level have consecutive IDs, followed by their subclusters
+        start, end, level = ROOT, ROOT + 1, -1
+        while start < end:
+            node_level[start:end] = level
+            start, end, level = end, self.child_ptr[end], level + 1
+        return node_level
+
+    def prune(self, maxlevel=np.inf, min_count=1, min_total=0):
+        '''
+        Returns a smaller index without the nodes deeper than maxlevel, and with the small
+        subclusters of every node folded into an OTHER_LABEL subcluster (see fold_nodes).
+        The queries and the actions of the index are kept.
+        '''
+        node_count = self.count(np.arange(self.num_nodes))
+        node_level = self.levels()
+        num_queries = max(len(self.freqs), 1)
+        folding = fold_nodes(self.node_parent, node_level, node_count, self.node_total,
+                             maxlevel, min_count, min_total)
+        _, folded, folded_other, other_parent = folding
+        # A query may be in several of the folded subclusters of a node, but it is only
+        # once in their OTHER_LABEL subcluster
+        folded = np.flatnonzero(folded)
+        starts = self.qid_ptr[folded]
+        lengths = self.qid_ptr[folded + 1] - starts
+        other_pairs = np.unique(np.repeat(folded_other, lengths) * num_queries +
+                                self.qid_data[flat_ranges(starts, lengths)])
+        other_count, other_total = count_pairs(other_pairs, num_queries, len(other_parent), self.freqs)
+        labels, node_label, node_parent, node_count, node_total, node_new = prune_nodes(
+            self.labels, self.node_label, self.node_parent, node_level, node_count, self.node_total,
+            folding, other_count, other_total)
+        # The query IDs of every kept node go to its new node, followed by those of the
+        # OTHER_LABEL nodes
+        node_of = np.repeat(node_new, np.diff(self.qid_ptr))
+        node_of[flat_ranges(starts, lengths)] = -1
+        kept = node_of >= 0
+        other_new = np.empty(len(other_parent), dtype=np.int64)
+        other_new[folded_other] = node_new[folded]
+        qid_data = (np.sort(np.concatenate((node_of[kept] * num_queries + self.qid_data[kept],
+                                            other_new[other_pairs // num_queries] * num_queries +
+                                            other_pairs % num_queries))) % num_queries).astype(np.int32)
+        del node_of, kept, other_pairs
+        qid_ptr = np.zeros(len(node_label) + 1, dtype=np.int64)
+        qid_ptr[1:] = np.cumsum(node_count)
+        index = ClusterIndex._from_nodes(labels, node_label, node_parent, node_total,
+                                         child_pointers(node_parent), qid_ptr, qid_data, self.freqs)
+        index.queries = self.queries
+        index.actions = self.actions
+        index.token_index = self.token_index
+        if self.qid_action is not None:
+            index.arrays['qid_action'] = index.qid_action = self.qid_action
+        return index
+
+
+def compact_labels(labels, node_label):
+    '''
+    Keeps only the names of the nodes (except the virtual root), sorted.
+    Returns them and the positions of the names of the nodes in them.
+    '''
+    used = np.unique(node_label[1:])
+    names = [labels[i] for i in used]
+    order = sorted(range(len(names)), key=names.__getitem__)
+    label_ids = np.full(len(labels), -1, dtype=np.int32)
+    label_ids[used[order]] = np.arange(len(used))
+    node_label = np.array(node_label, dtype=np.int32)
+    node_label[1:] = label_ids[node_label[1:]]
+    return [names[i] for i in order], node_label
+
+
+def child_pointers(node_parent):
+    '''
+    Returns child_ptr for nodes numbered in breadth first order, where the subclusters
+    of every node have consecutive IDs
+    '''
+    num_nodes = len(node_parent)
+    child_ptr = np.searchsorted(node_parent[1:], np.arange(num_nodes + 1), side='left') + 1
+    child_ptr[-1] = num_nodes
+    return child_ptr.astype(np.int32)
+
+
+def fold_nodes(node_parent, node_level, node_count, node_total, maxlevel=np.inf, min_count=1, min_total=0):
+    '''
+    Finds the nodes of a tree (the virtual root at ROOT, and every other node after its
+    parent) that are kept by a pruning. The nodes deeper than maxlevel are dropped. The
+    nodes with fewer than min_count queries or a total count below min_total are folded,
+    together with their subclusters, into a single OTHER_LABEL subcluster of their parent.
+    :param node_level: The level of every node (-1 for the virtual root, 0 for the root clusters)
+    :return: Whether every node is kept and whether it is folded, the position of the
+             OTHER_LABEL node of every folded node (in the order of their IDs) and the
+             sorted IDs of the parents of the OTHER_LABEL nodes
+    '''
+    num_nodes = len(node_parent)
+    small = (node_count < min_count) | (node_total < min_total)
+    kept = np.zeros(num_nodes, dtype=bool)
+    folded = np.zeros(num_nodes, dtype=bool)
+    kept[ROOT] = True
+    for level in range(int(min(node_level.max(), maxlevel)) + 1):
+        at = np.flatnonzero(node_level == level)
+        parent_kept = kept[node_parent[at]]
+        kept[at] = parent_kept & ~small[at]
+        folded[at] = parent_kept & small[at]
+    other_parent, folded_other = np.unique(node_parent[folded], return_inverse=True)
+    return kept, folded, folded_other, other_parent
+
+
+def count_pairs(pairs, num_queries, num_nodes, freqs):
+    '''
+    The unique and the total counts of the queries of every node, given the distinct
+    (node * num_queries + query ID) pairs
+    '''
+    node_of = pairs // num_queries
+    count = np.bincount(node_of, minlength=num_nodes).astype(np.int64)
+    total = np.bincount(node_of, weights=freqs[pairs % num_queries], minlength=num_nodes)
+    return count, np.round(total).astype(np.int64)
+
+
+def prune_nodes(labels, node_label, node_parent, node_level, node_count, node_total, folding,
+                other_count, other_total):
+    '''
+    Numbers the nodes kept by a pruning, and one OTHER_LABEL node for every parent of
+    folded nodes, in the breadth first order of the index.
+    :param node_label: The position of the name of every node in labels (which need not be sorted)
+    :param folding: The result of fold_nodes
+    :param other_count, other_total: The unique and total counts of the queries of every
+                                     OTHER_LABEL node. A query may be in more than one of the
+                                     folded nodes, so they are not the sums of their counts.
+    :return: The sorted labels and the label, parent, unique count and total count arrays of
+             the new nodes and the new ID of every given node (-1 if it is dropped)
+    '''
+    kept, folded, folded_other, other_parent = folding
+    num_nodes = len(node_parent)
+    # The kept nodes are followed by one OTHER_LABEL node for every parent of folded nodes
+    kept = np.flatnonzero(kept)
+    position = np.full(num_nodes, -1, dtype=np.int64)
+    position[kept] = np.arange(len(kept))
+    new_label = np.concatenate((node_label[kept], np.full(len(other_parent), len(labels))))
+    labels, new_label = compact_labels(list(labels) + [OTHER_LABEL], new_label)
+    new_parent = np.concatenate((position[node_parent[kept]], position[other_parent]))
+    new_parent[ROOT] = -1
+    new_level = np.concatenate((node_level[kept], node_level[other_parent] + 1))
+    new_count = np.concatenate((node_count[kept], other_count)).astype(np.int64)
+    new_total = np.concatenate((node_total[kept], other_total)).astype(np.int64)
+    position[folded] = len(kept) + folded_other
+
+    # Level by level, the nodes are sorted by the ID of their parent, then by descending
+    # unique count and by name
+    new_id = np.zeros(len(new_parent), dtype=np.int64)
+    order = [np.array([ROOT], dtype=np.int64)]
+    next_id = 1
+    for level in range(new_level.max() + 1):
+        at = np.flatnonzero(new_level == level)
+        at = at[np.lexsort((new_label[at], -new_count[at], new_id[new_parent[at]]))]
+        new_id[at] = np.arange(next_id, next_id + len(at))
+        order.append(at)
+        next_id += len(at)
+    order = np.concatenate(order)
+    new_parent = new_id[new_parent[order]]
+    new_parent[ROOT] = -1
+    node_new = np.where(position >= 0, new_id[position], -1)
+    return labels, new_label[order], new_parent.astype(np.int32), new_count[order], new_total[order], node_new
+
+
+def index_edges(node_parent, node_label, num_labels):
+    '''
+    Returns the sorted (parent, label) keys of all the nodes except the virtual root
+    and the IDs of the corresponding nodes
+    '''
+    edge_keys = node_parent[1:].astype(np.int64) * num_labels + node_label[1:]
+    order = np.argsort(edge_keys, kind='mergesort')
+    return edge_keys[order], (order + 1).astype(np.int32)
+
+
+def index_labels(node_label, num_labels):
+    '''
+    Returns the start of the nodes of every label in label_nodes and the IDs of all the
+    nodes except the virtual root sorted by label (and by ID)
+    '''
+    label_nodes = (np.argsort(node_label[1:], kind='mergesort') + 1).astype(np.int32)
+    label_ptr = np.zeros(num_labels + 1, dtype=np.int64)
+    label_ptr[1:] = np.cumsum(np.bincount(node_label[1:], minlength=num_labels))
+    return label_ptr, label_nodes
+
+
+def sort_children(node_parent, node_total):
+    '''
+    For nodes whose subclusters have consecutive IDs, returns the array of the node IDs
+    where the subclusters of every node are sorted by descending total count (ties
+    broken by ID)
+    '''
+    node_ids = np.arange(len(node_parent), dtype=np.int32)
+    # The virtual root is nobody's subcluster and stays in front
+    order = np.lexsort((node_ids[1:], -node_total[1:], node_parent[1:]))
+    return np.concatenate(([ROOT], node_ids[1:][order])).astype(np.int32)
+
+
+def sort_queries(qid_ptr, qid_data, freqs):
+    '''
+    Sorts the query IDs of every node (the qid_ptr[n]:qid_ptr[n + 1] slices of qid_data).
+    Returns the query IDs sorted by ID and sorted by descending frequency.
+    '''
+    num_queries = max(len(freqs), 1)
+    node_of = np.repeat(np.arange(len(qid_ptr) - 1, dtype=np.int64), np.diff(qid_ptr))
+    # Sorting a single (node, key) number is much faster than a lexsort
+    qid_data = (np.sort(node_of * num_queries + qid_data) % num_queries).astype(np.int32)
+    # The rank of every query in the order of descending frequency (ties broken by ID)
+    by_freq = np.lexsort((np.arange(len(freqs)), -freqs))
+    rank = np.empty(len(freqs), dtype=np.int64)
+    rank[by_freq] = np.arange(len(freqs))
+    qid_by_freq = by_freq[np.sort(node_of * num_queries + rank[qid_data]) % num_queries].astype(np.int32)
+    return qid_data, qid_by_freq
+
+
+def count_nondependent(qid_ptr, qid_data, node_parent, freqs):
+    '''
+    Returns the unique and the total counts of the "non-dependent" queries of every
+    node, i.e. the distinct queries of a node which are not in any of its subclusters.
+    '''
+    num_queries = len(freqs)
+    node_of = np.repeat(np.arange(len(qid_ptr) - 1, dtype=np.int64), np.diff(qid_ptr))
+    # Every (node, query) pair, and the pairs covered by a subcluster of the node
+    pairs = np.unique(node_of * num_queries + qid_data)
+    covered = np.unique(node_parent[node_of].astype(np.int64) * num_queries + qid_data)
+    nondep = np.setdiff1d(pairs, covered, assume_unique=True)
+    nondep_node = nondep // num_queries
+    nondep_count = np.bincount(nondep_node, minlength=len(node_parent)).astype(np.int32)
+    nondep_total = np.bincount(nondep_node, weights=freqs[nondep % num_queries],
+                               minlength=len(node_parent))
+    return nondep_count, np.round(nondep_total).astype(np.int64)
+
+
+def invert_queries(qid_ptr, qid_data, num_queries):
+    '''
+    Returns the CSR arrays mapping every query ID to the IDs of the nodes containing it
+    '''
+    num_nodes = len(qid_ptr) - 1
+    node_of = np.repeat(np.arange(num_nodes, dtype=np.int64), np.diff(qid_ptr))
+    qnode_data = (np.sort(qid_data.astype(np.int64) * num_nodes + node_of) % num_nodes).astype(np.int32)
+    qnode_ptr = np.zeros(num_queries + 1, dtype=np.int64)
+    qnode_ptr[1:] = np.cumsum(np.bincount(qid_data, minlength=num_queries))
+    return qnode_ptr, qnode_data
+
+
+def resolve_actions(query_list, qaction):
+    '''
+    Looks up the action of every query once, so that the actions do not need to be
+    looked up by the query strings anymore.
+    :param query_list: The list of the queries
+    :param qaction: A dictionary mapping the (lower case) queries to their actions
+    :return: An int32 array with the position of the action of every query in the
+             returned (sorted) list of actions, or -1 if the query has no action.
+    '''
+    actions = sorted(set(qaction.values()))
+    action_ids = {anaction: i for i, anaction in enumerate(actions)}
+    qid_action = np.empty(len(query_list), dtype=np.int32)
+    for qid, aquery in enumerate(query_list):
+        qid_action[qid] = action_ids.get(qaction.get(aquery.lower()), -1)
+    return qid_action, actions
+
+
+def save_snapshot(filename, index, query_list, qid_action=None, actions=None, token_index=None):
+    '''
+    Saves the index, the queries, their frequencies and (optionally) the actions and the
+    token_index.TokenIndex of the queries into a single binary file. The file starts with
+    SNAPSHOT_MAGIC, the version and the length of a json header describing the dtype,
+    shape and offset of every array.
+    The arrays follow the header, each aligned to SNAPSHOT_ALIGN bytes, so that
+    load_snapshot can use them in place.
+    '''
+    arrays = {aname: np.asarray(index.arrays[aname], dtype=INDEX_ARRAYS[aname])
+              for aname in INDEX_ARRAYS}
+    arrays['freqs'] = np.asarray(index.freqs, dtype=np.int64)
+    strings = {'labels': index.labels, 'queries': query_list}
+    if qid_action is not None:
+        arrays['qid_action'] = np.asarray(qid_action, dtype=np.int32)
+        strings['actions'] = actions
+    if token_index is not None:
+        arrays['token_ptr'] = np.asarray(token_index.token_ptr, dtype=np.int64)
+        arrays['token_qids'] = np.asarray(token_index.token_qids, dtype=np.int32)
+        strings['tokens'] = token_index.tokens
+    for aname in strings:
+        table = strings[aname]
+        if not isinstance(table, StringTable):
+            table = StringTable.from_strings(table)
+        arrays[aname + '_offsets'] = table.offsets
+        arrays[aname + '_data'] = table.data
+
+    # The offsets are relative to the end of the (padded) header
+    layout = {}
+    offset = 0
+    for aname in sorted(arrays):
+        layout[aname] = [arrays[aname].dtype.str, list(arrays[aname].shape), offset]
+        offset += _align(arrays[aname].nbytes)
+    header = json.dumps({'arrays': layout, 'strings': sorted(strings)})
+    data_start = _align(len(SNAPSHOT_MAGIC) + struct.calcsize('<IQ') + len(header))
+
+    # Write to a temporary file first so that a running server never sees a
+    # partially written snapshot
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('<IQ', SNAPSHOT_VERSION, data_start))
+        f.write(header)
+        for aname in sorted(arrays):
+            f.write(b'\0' * (data_start + layout[aname][2] - f.tell()))
+            # Written in blocks, so that an array in a memory mapped file is never
+            # copied into the memory as a whole
+            flat = arrays[aname].reshape(-1)
+            for start in xrange(0, len(flat), SNAPSHOT_BLOCK):
+                f.write(np.ascontiguousarray(flat[start:start + SNAPSHOT_BLOCK]).data)
+    os.rename(tmpfile, filename)
+
+
+def load_snapshot(filename, resident_levels=None, cache=None):
+    '''
+    Loads a snapshot written by save_snapshot. The file is memory mapped and the
+    arrays of the returned ClusterIndex point into the mapping, so nothing is read
+    until it is used and the pages are shared with the other processes that load
+    the same snapshot.
+    :param resident_levels: If given, a LazyClusterIndex is returned, which keeps the query
+                            IDs of the clusters of only this many top levels in memory
+    :param cache: The LRUCache of the LazyClusterIndex
+    '''
+    with open(filename, 'rb') as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise IOError('Not a SyntaViz index snapshot: %s' % filename)
+        version, data_start = struct.unpack('<IQ', f.read(struct.calcsize('<IQ')))
+        if version != SNAPSHOT_VERSION:
+            raise IOError('Unsupported snapshot version %d (expected %d): %s'
+                          % (version, SNAPSHOT_VERSION, filename))
+        header_len = data_start - len(SNAPSHOT_MAGIC) - struct.calcsize('<IQ')
+        header = json.loads(f.read(header_len).rstrip(b'\0'))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    arrays = {}
+    offsets = {}
+    for aname, (dtype, shape, offset) in header['arrays'].items():
+        offsets[aname] = data_start + offset
+        dtype = np.dtype(str(dtype))
+        count = int(np.prod(shape))
+        if not count:
+            arrays[aname] = np.zeros(shape, dtype=dtype)
+            continue
+        arrays[aname] = np.frombuffer(mapped, dtype=dtype, count=count,
+                                      offset=data_start + offset).reshape(shape)
+    strings = {}
+    for aname in header['strings']:
+        strings[aname] = StringTable(arrays.pop(aname + '_offsets'), arrays.pop(aname + '_data'))
+    if 'label_nodes' not in arrays:
+        # A snapshot saved without the nodes of every label
+        arrays['label_ptr'], arrays['label_nodes'] = index_labels(arrays['node_label'], len(strings['labels']))
+    tokens = None
+    if 'tokens' in strings:
+        tokens = TokenIndex(strings['tokens'], arrays.pop('token_ptr'), arrays.pop('token_qids'))
+    if resident_levels is not None:
+        index = LazyClusterIndex(arrays, strings['labels'], filename, offsets, resident_levels, cache,
+                                 queries=strings['queries'], actions=strings.get('actions'))
+    else:
+        index = ClusterIndex(arrays, strings['labels'], queries=strings['queries'],
+                             actions=strings.get('actions'))
+    index.token_index = tokens
+    return index
+
+
+class LazyClusterIndex(ClusterIndex):
+    '''
+    A ClusterIndex loaded from a snapshot which keeps only the query IDs of the clusters
+    of the top levels in memory. They are most of the index and, being in breadth first
+    order, those of the top levels come first in qid_data and qid_by_freq. The query IDs
+    of the deeper clusters are read from the file when they are used, not through the
+    memory map, and kept in a bounded LRU cache. The memory used for them is then the
+    top levels and the cache, whatever has been browsed. The rest of the arrays (one
+    entry for every cluster or query) stay memory mapped.
+    '''
+
+    def __init__(self, arrays, labels, filename, offsets, resident_levels, cache=None, queries=None, actions=None):
+        '''
+        :param filename: The snapshot file
+        :param offsets: The position of every array in the file
+        :param resident_levels: The number of top levels kept in memory
+        :param cache: The LRUCache of the query IDs of the deeper clusters (a small one if None)
+        '''
+        ClusterIndex.__init__(self, arrays, labels, queries, actions)
+        self.filename = filename
+        self.offsets = offsets
+        self.cache = cache if cache is not None else LRUCache()
+        self._file = open(filename, 'rb')
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._pid = os.getpid()
+        self._file_lock = threading.Lock()
+        # The first node below the resident levels
+        start, end = ROOT, ROOT + 1
+        for _ in range(resident_levels):
+            if start == end:
+                break
+            start, end = end, int(self.child_ptr[end])
+        self.resident_nodes = end
+        num_resident = int(self.qid_ptr[end])
+        self.resident = {aname: self._read(aname, 0, num_resident) for aname in ('qid_data', 'qid_by_freq')}
+
+    def qids(self, node_id, by_freq=False):
+        aname = 'qid_by_freq' if by_freq else 'qid_data'
+        if node_id < self.resident_nodes:
+            return self.resident[aname][self.qid_ptr[node_id]:self.qid_ptr[node_id + 1]]
+        return self._cached(aname, node_id, self.qid_ptr)
+
+    def _cached(self, aname, i, ptr):
+        # The ptr[i]:ptr[i + 1] slice of an array, through the cache
+        key = (aname, int(i))
+        values = self.cache.get(key)
+        if values is None:
+            values = self._read(aname, int(ptr[i]), int(ptr[i + 1]))
+            self.cache.put(key, values, values.nbytes + _CACHE_ENTRY_BYTES)
+        return values
+
+    def _read(self, aname, start, end):
+        # Reads arrays[aname][start:end] from the file
+        dtype = self.arrays[aname].dtype
+        if end <= start:
+            return np.zeros(0, dtype=dtype)
+        with self._file_lock:
+            # A forked process shares the position in the file with its parent, so it
+            # opens the file again. It must still be the file that is memory mapped.
+            if self._pid != os.getpid():
+                self._file = open(self.filename, 'rb')
+                self._pid = os.getpid()
+                if os.fstat(self._file.fileno()).st_ino != self._inode:
+                    raise IOError('The index snapshot was replaced while in use: %s' % self.filename)
+            self._file.seek(self.offsets[aname] + start * dtype.itemsize)
+            data = self._file.read((end - start) * dtype.itemsize)
+        return np.frombuffer(data, dtype=dtype)
+
+
+# The memory taken by an entry of the cache of a LazyClusterIndex besides its values
+_CACHE_ENTRY_BYTES = 256
+
+
+def flat_ranges(starts, lengths):
+    '''
+    The positions start to start + length - 1 of all the (start, length) ranges, in order
+    '''
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - ends + lengths, lengths)
+
+
+def _align(nbytes):
+    '''
+    Rounds nbytes up to a multiple of SNAPSHOT_ALIGN
+    '''
+    return -(-nbytes // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+
+
+class SubclusterLookup(object):
+    '''
+    Lazily maps the query IDs of a node to the names of its subclusters containing
+    them. It is used in place of the qid_to_subclust dictionary of
+    cluster_query.get_statistics, so only the queries on the shown page are looked up.
+    '''
+
+    def __init__(self, index, node_id):
+        self.index = index
+        self.node_id = node_id
+
+    def __getitem__(self, qid):
+        return self.index.subclusters_of_query(self.node_id, qid)
+
+    def __contains__(self, qid):
+        return len(self[qid]) > 0
+
+    def get(self, qid, default=None):
+        return self[qid] if qid in self else default
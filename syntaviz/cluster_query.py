@@ -11,8 +11,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import json
+import argparse
+from multiprocessing import Pool
+import cPickle as cp
 import numpy as np
+import cluster_index
+import external_index
+import path_pattern
+import query_algebra
+import token_index
+import tree_columns
 
 
 def cluster_by_root(parsed_query_file='../data/dependency_syntaxnet_jsonified'):
@@ -63,19 +73,28 @@ def get_queries_and_freq(original_query_file='../data/all-queries-raw.txt'):
 
 
 def cluster_counts_and_queries(parsed_query_file='../data/dependency_syntaxnet_jsonified',
-                               original_query_file='../data/all-queries-raw.txt', get_freq=False):
+                               original_query_file='../data/all-queries-raw.txt', get_freq=False,
+                               maxlevel=np.inf):
     '''
     This function creates a dictionary of counts of various patterns and
     associates the corresponding query IDs.
     If get_freq is True, it returns the cluster, the list of original queries, and the list
     of query frequencies
     If get_freq is false, it returns only the first two.
+    The clusters deeper than maxlevel (the root clusters are at level 0) are left out.
     '''
     clust = {}
-    if get_freq:
-        original_query_list, original_freq_list = get_queries_and_freq(original_query_file)
-    else:
-        original_query_list, _ = get_queries_and_freq(original_query_file)
+    # The frequencies are always read so that the total (non-unique) count of
+    # every cluster can be filled in while the clusters are being built
+    original_query_list, original_freq_list = get_queries_and_freq(original_query_file)
+    if tree_columns.is_tree_columns(parsed_query_file):
+        # The binary format of the parse trees
+        for qid, jtree in tree_columns.iter_trees(parsed_query_file):
+            update_count_and_query(clust, jtree, qid, maxlevel=maxlevel, freq_list=original_freq_list)
+        if not get_freq:
+            return clust, original_query_list
+        else:
+            return clust, original_query_list, original_freq_list
     with open(parsed_query_file) as f:
         # i is the position of the query in parsed_query_file
         # qid is the position in original_query_file
@@ -90,13 +109,110 @@ def cluster_counts_and_queries(parsed_query_file='../data/dependency_syntaxnet_j
             except:
                 print("Skipping corrupt line %d" % i)
                 continue
-            update_count_and_query(clust, jtree, qid)
+            update_count_and_query(clust, jtree, qid, maxlevel=maxlevel, freq_list=original_freq_list)
     if not get_freq:
         return clust, original_query_list
     else:
         return clust, original_query_list, original_freq_list
 
 
+def cluster_index_and_queries(parsed_query_file, original_query_file, workers=1, maxlevel=np.inf,
+                              min_count=1, min_total=0):
+    '''
+    Builds the array-backed cluster index (see cluster_index) of the parsed queries.
+    Returns the index, the list of original queries, and the list of query frequencies.
+    If the parsed queries are in the binary format (see tree_columns), the index is built
+    directly from their columns, which is much faster than building the nested clusters.
+    :param workers: If more than 1, the text file of parsed queries is split into ranges of bytes,
+                    whose trees are decoded into columns by a pool of worker processes. The columns
+                    of the ranges are put together, and their clusters merged, by ClusterIndex.from_columns.
+    :param maxlevel: The clusters deeper than maxlevel (the root clusters are at level 0) are left out
+    :param min_count: The subclusters with fewer queries are folded into a single "[other]" subcluster
+                      of their parent (see cluster_index.prune_nodes)
+    :param min_total: The subclusters with a lower total count are folded as well
+    '''
+    if tree_columns.is_tree_columns(parsed_query_file):
+        original_query_list, original_freq_list = get_queries_and_freq(original_query_file)
+        columns, labels = tree_columns.read_columns(parsed_query_file)
+        index = cluster_index.ClusterIndex.from_columns(columns, labels, original_freq_list, maxlevel)
+    elif workers > 1:
+        # A few ranges per worker, so that the workers finish at about the same time
+        num_ranges = workers * 4
+        size = os.path.getsize(parsed_query_file)
+        bounds = [size * i // num_ranges for i in range(num_ranges + 1)]
+        pool = Pool(workers)
+        try:
+            chunks = pool.map(tree_columns.encode_text_range,
+                              [(parsed_query_file, bounds[i], bounds[i + 1]) for i in range(num_ranges)])
+        finally:
+            pool.close()
+            pool.join()
+        columns, labels = tree_columns.columns_from_bytes(b''.join(chunks))
+        del chunks
+        original_query_list, original_freq_list = get_queries_and_freq(original_query_file)
+        index = cluster_index.ClusterIndex.from_columns(columns, labels, original_freq_list, maxlevel)
+    else:
+        clust, original_query_list, original_freq_list = cluster_counts_and_queries(parsed_query_file,
+                                                                                    original_query_file,
+                                                                                    get_freq=True,
+                                                                                    maxlevel=maxlevel)
+        index = cluster_index.ClusterIndex.from_clust(clust, original_freq_list)
+    if min_count > 1 or min_total > 0:
+        index = index.prune(min_count=min_count, min_total=min_total)
+    return index, original_query_list, original_freq_list
+
+
+def build_index(original_query_file, parsed_query_file, query2action_file, index_file, workers=1,
+                memory_mb=None, tmp_dir=None, maxlevel=np.inf, min_count=1, min_total=0):
+    '''
+    Builds the clusters and saves them, together with the queries, their frequencies
+    and the actions, as a binary snapshot of the array-backed cluster index. The
+    SyntaViz server can load the snapshot almost instantly.
+    :param query2action_file: A pickle file with a dictionary mapping the (lower case)
+                              queries to the actions taken for them
+    :param memory_mb: If given, the index is built out of core (see external_index) with
+                      about this much memory for sorting the query IDs, in temporary files
+                      under tmp_dir. This builds the index of corpora that do not fit in the memory.
+    :param maxlevel, min_count, min_total: Prune the clusters (see cluster_index_and_queries)
+    '''
+    if memory_mb:
+        print("Loading queries ...")
+        query_list, freq_list = get_queries_and_freq(original_query_file)
+        qid_action, actions = load_actions(query2action_file, query_list)
+        print("Building the clusters out of core ...")
+        num_clusters = external_index.build_snapshot(parsed_query_file, query_list, freq_list, index_file,
+                                                     qid_action, actions, memory_mb=memory_mb, tmp_dir=tmp_dir,
+                                                     maxlevel=maxlevel, min_count=min_count, min_total=min_total)
+        print("Done. %d clusters saved to %s" % (num_clusters, index_file))
+        return
+    print("Loading cluster data ...")
+    index, query_list, freq_list = cluster_index_and_queries(parsed_query_file, original_query_file, workers,
+                                                             maxlevel, min_count, min_total)
+    qid_action, actions = load_actions(query2action_file, query_list)
+    tokens = build_token_index(query_list)
+    print("Writing index snapshot ...")
+    cluster_index.save_snapshot(index_file, index, query_list, qid_action, actions, tokens)
+    print("Done. %d clusters saved to %s" % (index.num_nodes - 1, index_file))
+
+
+def build_token_index(query_list):
+    '''
+    Builds the inverted index of the words of the queries (see token_index)
+    '''
+    print("Indexing the words of the queries ...")
+    return token_index.TokenIndex.from_queries(query_list)
+
+
+def load_actions(query2action_file, query_list):
+    '''
+    Reads the actions of the queries (see cluster_index.resolve_actions)
+    '''
+    print("Loading list of actions performed for each query ...")
+    with open(query2action_file, 'rb') as f:
+        qaction = cp.load(f)
+    return cluster_index.resolve_actions(query_list, qaction)
+
+
 def update_count(clust, jtree):
     '''
     This function captures the counts of all the dependency grammer
@@ -113,29 +229,34 @@ def update_count(clust, jtree):
             update_count(clust[last_named_node][1], anode)
 
 
-def update_count_and_query(clust, jtree, qID, currlevel=0, maxlevel=np.inf):
+def update_count_and_query(clust, jtree, qID, currlevel=0, maxlevel=np.inf, freq_list=None):
     '''
     This function captures the counts of all the dependency grammer
     starting from the root of the dependency tree. In addition, it
     stores the indices of the corresponding queries. Note that it needs
     a lot of memories to store the qID's.
+    If freq_list is provided, the total (non-unique) count of every cluster
+    is accumulated as well. Otherwise, every query is counted once.
     '''
     if currlevel > maxlevel:
         return
+    freq = freq_list[qID] if freq_list is not None else 1
     for anode in jtree:
         if type(anode) is unicode:
             if anode in clust:
                 clust[anode][0] += 1
                 clust[anode][2].append(qID)
+                clust[anode][3] += freq
             else:
                 # Position#0 = Number of unique queries in this cluster (redundant)
                 # Position#1 = Dictionary representing the subclusters
                 # Position#2 = List of all the unique queries falling in this cluster
-                clust[anode] = [1, {}, [qID]]
+                # Position#3 = Total (non-unique) count of the queries in this cluster
+                clust[anode] = [1, {}, [qID], freq]
             last_named_node = anode
         elif type(anode) is list:
             # Recursively parse the subtrees
-            update_count_and_query(clust[last_named_node][1], anode, qID, currlevel + 1, maxlevel)
+            update_count_and_query(clust[last_named_node][1], anode, qID, currlevel + 1, maxlevel, freq_list)
 
 
 def cd(clust, key):
@@ -151,6 +272,33 @@ def cd(clust, key):
     return clust, key
 
 
+def index_node(clust, key):
+    '''
+    If clust is an array-backed cluster index (see cluster_index.py), returns the index
+    and the ID of the node for the key. Otherwise, returns None.
+    '''
+    if isinstance(clust, cluster_index.IndexNode):
+        return clust.index, clust.index.find(key, clust.node_id)
+    return None
+
+
+def _has_freq(freq_list):
+    '''
+    True if a (non-empty) frequency list or array is given
+    '''
+    return freq_list is not None and len(freq_list) > 0
+
+
+def _page(items, st_idx, en_idx):
+    '''
+    Slices the items from st_idx to en_idx (both inclusive), following the
+    pagination convention of get_keys and get_queries
+    '''
+    if en_idx == np.inf:
+        return items[st_idx:]
+    return items[st_idx:int(en_idx) + 1]
+
+
 def show_keys(clust, key='', st_idx=0, en_idx=100):
     '''
     This is similar to get_keys but it prints the results
@@ -175,10 +323,24 @@ def get_keys(clust, key='', st_idx=0, en_idx=100, freq_list=None, sortby=0):
                     1, then the clusters will be sorted by total non-unique counts. This
                     parameter will be ignored if freq_list is set to None.
     '''
+    found = index_node(clust, key)
+    if found:
+        index, node_id = found
+        # The subclusters are stored in both orders, so the page is a slice
+        children = _page(index.children(node_id, by_total=_has_freq(freq_list) and sortby == 1),
+                         st_idx, en_idx)
+        counts = index.count(children)
+        totals = index.total(children)
+        for j in range(len(children)):
+            if not _has_freq(freq_list):
+                yield st_idx + j, index.label(children[j]), int(counts[j])
+            else:
+                yield st_idx + j, index.label(children[j]), int(counts[j]), int(totals[j])
+        return
     if key:
         clust, key = cd(clust, key)
         clust = clust[key][1]
-    if not freq_list:
+    if not _has_freq(freq_list):
         # Sort the keys based on unique counts
         allkeys = sorted([(clust[akey][0], akey) for akey in clust], key=lambda x: -1 * x[0])
         # No need to send the total non-unique counts
@@ -189,13 +351,11 @@ def get_keys(clust, key='', st_idx=0, en_idx=100, freq_list=None, sortby=0):
                 continue
             yield i, akey, unique_count
     else:
-        # Since we did not store the non-unique counts in the cluster, we need
-        # to calculate that for every cluster and subclusters. This process
-        # would make it slower than the other option.
+        # The total non-unique counts are stored in the cluster while it is
+        # built, so sorting by them is as cheap as sorting by unique counts.
         # Sort the keys based on either unique counts or non-unique counts
-        allkeys = sorted([(clust[akey][0], \
-                           sum([freq_list[aqid] for aqid in clust[akey][2]]), \
-                           akey) for akey in clust], key=lambda x: -1 * x[sortby])
+        allkeys = sorted([(clust[akey][0], clust[akey][3], akey) for akey in clust],
+                         key=lambda x: -1 * x[sortby])
         # providing the frequency list implies that the user
         # wants the total non-unique counts.        
         for i, (unique_count, non_unique_count, akey) in enumerate(allkeys):
@@ -224,9 +384,17 @@ def get_queries(clust, key, query_list, st_idx=0, en_idx=100, freq_list=None):
     :param freq_list: if the frequency list is provided (get it from cluster_counts_and_queries
                       by setting the get_freq flag to True), the queries will be sorted by frequency
     '''
+    found = index_node(clust, key)
+    if found:
+        index, node_id = found
+        # The queries of every node are stored in both orders, so the page is a slice
+        qid_list = index.qids(node_id, by_freq=_has_freq(freq_list))
+        for i, qid in enumerate(_page(qid_list, st_idx, en_idx), st_idx):
+            yield i, int(qid), query_list[qid]
+        return
     clust, key = cd(clust, key)
     qid_list = clust[key][2]
-    if freq_list:
+    if _has_freq(freq_list):
         rank, qid_list = zip(*sorted([(freq_list[aqid], aqid) for aqid in qid_list], key=lambda x: -1 * x[0]))
     else:
         qid_list = sorted(qid_list)
@@ -247,9 +415,18 @@ def get_statistics(clust, key, freq_list):
        cluster, which are not available in any of the sub-clusters.
     4. Total (Non-Unique) count of "non-dependent" queries.
     5. a dictionary, mapping qids (key) to a list of all the immediate subclusters
-       where that qid is available
-
-    '''
+       where that qid is available. For an array-backed cluster index, this is a
+       cluster_index.SubclusterLookup, which finds the subclusters of a qid on demand.
+
+    '''
+    found = index_node(clust, key)
+    if found:
+        index, node_id = found
+        # All the counts are computed while building the index and the subclusters
+        # of a query are looked up only when they are asked for
+        return int(index.count(node_id)), int(index.total(node_id)), \
+               int(index.nondep_count[node_id]), int(index.nondep_total[node_id]), \
+               cluster_index.SubclusterLookup(index, node_id)
     clust, key = cd(clust, key)
     queries = {aqid: True for aqid in clust[key][2]}
     qid_to_subclust = {}
@@ -264,10 +441,37 @@ def get_statistics(clust, key, freq_list):
                 qid_to_subclust[aqid] = [a_sub_clust]
             else:
                 qid_to_subclust[aqid].append(a_sub_clust)
-    return clust[key][0], sum([freq_list[aquery] for aquery in clust[key][2]]), \
+    return clust[key][0], clust[key][3], \
            len(queries), sum([freq_list[aquery] for aquery in queries]), qid_to_subclust
 
 
+def get_action_counts(clust, key, qid_action, num_actions, freq_list=None):
+    '''
+    Returns the histogram of the actions taken for the queries of a cluster as an
+    array holding the count of every action ID.
+    :param qid_action: An array with the action ID of every query, or -1 if the action
+                       is not known (see cluster_index.resolve_actions)
+    :param num_actions: The number of different action IDs
+    :param freq_list: If the frequency list is provided, every query is counted as many
+                      times as it was asked (total counts instead of unique counts)
+    '''
+    found = index_node(clust, key)
+    if found:
+        index, node_id = found
+        qids = index.qids(node_id)
+        freqs = index.freqs
+    else:
+        clust, key = cd(clust, key)
+        qids = np.asarray(clust[key][2], dtype=np.int64)
+        freqs = np.asarray(freq_list) if _has_freq(freq_list) else None
+    action_ids = qid_action[qids]
+    known = action_ids >= 0
+    if not _has_freq(freq_list):
+        return np.bincount(action_ids[known], minlength=num_actions)
+    counts = np.bincount(action_ids[known], weights=freqs[qids[known]], minlength=num_actions)
+    return np.round(counts).astype(np.int64)
+
+
 # def show_query_actions(clust,key,session_map,session_list,st_idx=0,en_idx=100,actualcount=False):
 #     '''
 #     Shows a probability distribution of the actions taken for the 
@@ -289,36 +493,121 @@ def get_query_IDs(clust, key):
     '''
     Similar to show_queries, but instead of printing the queries, it returns all the query ID's.
     '''
+    found = index_node(clust, key)
+    if found:
+        index, node_id = found
+        return index.qids(node_id).tolist()
     clust, key = cd(clust, key)
     return clust[key][2]
 
 
+def query_id_set(clust, key):
+    '''
+    Returns the sorted array of the unique query ID's of a cluster
+    '''
+    found = index_node(clust, key)
+    if found:
+        index, node_id = found
+        # The query IDs of a node of the index are already sorted
+        return query_algebra.unique_sorted(index.qids(node_id))
+    clust, key = cd(clust, key)
+    return np.unique(np.asarray(clust[key][2], dtype=np.int32))
+
+
 def query_or(key1, key2, clust):
     '''
-    Returns a union of queries
+    Returns a union of queries (sorted by ID)
     '''
-    qid1 = set(get_query_IDs(clust, key1))
-    qid2 = set(get_query_IDs(clust, key2))
-    return list(qid1.union(qid2))
+    return query_algebra.union(query_id_set(clust, key1), query_id_set(clust, key2)).tolist()
 
 
 def query_and(key1, key2, clust):
     '''
-    Returns an intersection of queries
+    Returns an intersection of queries (sorted by ID)
     '''
-    qid1 = set(get_query_IDs(clust, key1))
-    qid2 = set(get_query_IDs(clust, key2))
-    return list(qid1.intersection(qid2))
+    return query_algebra.intersect(query_id_set(clust, key1), query_id_set(clust, key2)).tolist()
 
 
 def query_subtract(key1, key2, clust):
     '''
     Returns the queries which are present in the first cluster
-    but not present in the second
+    but not present in the second (sorted by ID)
+    '''
+    return query_algebra.difference(query_id_set(clust, key1), query_id_set(clust, key2)).tolist()
+
+
+def query_expression(clust, expr, num_queries):
+    '''
+    Returns the sorted array of the ID's of the queries matching a boolean expression over
+    the clusters, e.g. "(key1 AND NOT key2) OR key3" (see query_algebra). Raises
+    query_algebra.ExpressionError if the expression cannot be parsed and KeyError if
+    a cluster is not found.
+    :param num_queries: The number of queries (for NOT)
+    '''
+    def lookup(operand):
+        kind, value = operand
+        if kind == 'node':
+            # Node IDs are only known in the array-backed index
+            if not isinstance(clust, cluster_index.IndexNode) or not 0 < value < clust.index.num_nodes:
+                raise KeyError('#%d' % value)
+            return query_algebra.unique_sorted(clust.index.qids(value))
+        return query_id_set(clust, value)
+    return query_algebra.evaluate(query_algebra.parse(expr), lookup, num_queries)
+
+
+def search_queries(clust, key, tokens, text):
+    '''
+    Returns the sorted array of the ID's of the queries of a cluster containing all the
+    words of a text. The queries containing the words are looked up in the inverted index
+    and only those are checked against the cluster, so the time does not depend on the size
+    of the cluster.
+    :param tokens: The token_index.TokenIndex of the queries
+    :param key: The cluster (all the queries if empty)
     '''
-    qid1 = set(get_query_IDs(clust, key1))
-    qid2 = set(get_query_IDs(clust, key2))
-    return list(qid1 - qid2)
+    qids = tokens.search(text)
+    if not key:
+        return qids
+    found = index_node(clust, key)
+    if found:
+        index, node_id = found
+        return qids[index.in_node(qids, node_id)]
+    return query_algebra.intersect(qids, query_id_set(clust, key))
+
+
+def match_pattern(index, pattern):
+    '''
+    Returns the sorted array of the ID's of the clusters of a cluster_index.ClusterIndex matching
+    a path pattern from the root clusters, e.g. "**|cancel VB ROOT" for the clusters of that name
+    at any depth (see path_pattern). Only the array-backed index keeps the clusters of every name,
+    so it raises TypeError for the nested clusters, which have to be converted (once) with
+    ClusterIndex.from_clust. Raises path_pattern.PatternError if the pattern cannot be parsed.
+    '''
+    if not isinstance(index, cluster_index.ClusterIndex):
+        raise TypeError('Patterns are matched on a ClusterIndex, not on %s' % type(index).__name__)
+    return path_pattern.match(index, pattern)
+
+
+def pattern_query_ids(index, nodes):
+    '''
+    Returns the sorted array of the unique query ID's of all the given clusters. Only
+    those of the clusters none of whose ancestors is given are put together.
+    '''
+    qids = [index.qids(anode) for anode in path_pattern.outermost(index, nodes)]
+    if not qids:
+        return np.zeros(0, dtype=np.int32)
+    return np.unique(np.concatenate(qids))
+
+
+def add_prune_arguments(parser):
+    '''
+    Adds the options for pruning the clusters to an argparse parser
+    '''
+    parser.add_argument('--max-level', type=int, default=np.inf,
+                        help='Leave out the clusters deeper than this level (the root clusters are at level 0)')
+    parser.add_argument('--min-count', type=int, default=1,
+                        help='Fold the subclusters with fewer unique queries into an "[other]" subcluster')
+    parser.add_argument('--min-total', type=int, default=0,
+                        help='Fold the subclusters with a lower total count into an "[other]" subcluster')
 
 
 def show_roots(clusthash, n=100):
@@ -330,3 +619,28 @@ def show_roots(clusthash, n=100):
         if i > n:
             break
         print '(' + str(count) + ') ' + akeys
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the hierarchical clusters of the parsed queries.')
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser('build-index',
+                                         help='Build the clusters and save them as an index snapshot '
+                                              'for the SyntaViz server')
+    build_parser.add_argument('query_file', help='The query file (ID, query, ..., count)')
+    build_parser.add_argument('parsed_query_file',
+                              help='The parsed queries (output of parse_query, in the text or the binary format)')
+    build_parser.add_argument('action_file', help='A pickle file mapping the queries to their actions')
+    build_parser.add_argument('index_file', help='Where the index snapshot will be written')
+    build_parser.add_argument('--workers', type=int, default=1,
+                              help='Number of processes decoding the parsed queries (text format)')
+    build_parser.add_argument('--memory-mb', type=int,
+                              help='Build the index out of core, sorting with about this much memory (in MB). '
+                                   'For corpora that do not fit in the memory.')
+    build_parser.add_argument('--tmp-dir', help='Where the temporary files of --memory-mb are written')
+    add_prune_arguments(build_parser)
+    args = parser.parse_args()
+
+    if args.command == 'build-index':
+        build_index(args.query_file, args.parsed_query_file, args.action_file, args.index_file, args.workers,
+                    args.memory_mb, args.tmp_dir, args.max_level, args.min_count, args.min_total)
@@ -0,0 +1,450 @@
+# Copyright 2018 Comcast Cable Communications Management, LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Builds the index snapshot (see cluster_index) of a corpus whose parse trees do not fit
+in the memory. Most of the index is the query IDs of the clusters (one for every node of
+every parse tree), and those are never all in the memory at once:
+
+1. The parse trees are read a chunk at a time. Every distinct path of names from the root
+   (i.e. every cluster) gets a number, and every tree node is written out as a
+   (path, query ID) pair. The pairs are spilled to run files of a bounded size.
+2. Once all the paths are known, the small ones are folded into "[other]" nodes (when
+   the index is pruned). Their (node, query ID) pairs are taken out of the runs and
+   merged, so that a query counts only once in an "[other]" node.
+3. The paths are numbered in the breadth first order of the index. Every run is sorted
+   by (node, query ID) and by (query ID, node).
+4. The sorted runs are merged one range of nodes (or of queries) at a time, straight into
+   the arrays of the snapshot, which are memory mapped files.
+
+The inverted index of the words of the queries (see token_index) is built the same way from
+runs of (word, query ID) pairs. Only the clusters themselves (one entry for every node of the
+index), the arrays with one entry for every query and the distinct words are kept in the memory.
+'''
+import os
+import shutil
+import tempfile
+from array import array
+import numpy as np
+import cluster_index
+import token_index
+import tree_columns
+from cluster_index import ROOT
+
+# The memory budget is spent on arrays of this many int64 numbers at a time. Every number
+# is sorted along with a few temporary arrays of the same length.
+_BYTES_PER_ITEM = 64
+# The bits of a path number in a spilled pair: path << 32 | query ID << 1 | leaf
+_PATH_SHIFT = 32
+
+
+class PathTable(object):
+    '''
+    Numbers the distinct paths of names of the parse trees in the order they are first
+    seen (0 is the virtual root) and counts the queries of every path. The tree nodes deeper
+    than maxlevel (the roots are at level 0) are left out.
+    '''
+
+    def __init__(self, freqs, maxlevel=np.inf):
+        self.freqs = freqs
+        self.maxlevel = maxlevel
+        self.label_ids = {}
+        # Sorted runs of the (parent path << 32 | label) keys of the paths and their numbers.
+        # Every run is more than twice as long as the next one, so there are only a few runs
+        # to look the keys up in, and a key is merged into a longer run only a few times.
+        self.runs = []
+        self.parent = [np.array([-1], dtype=np.int64)]
+        self.label = [np.array([-1], dtype=np.int64)]
+        self.depth = [np.array([-1], dtype=np.int64)]
+        self.num_paths = 1
+        # The counts of the paths, with room for more paths
+        self.count = np.zeros(1, dtype=np.int64)
+        self.total = np.zeros(1, dtype=np.int64)
+
+    def add(self, columns, labels):
+        '''
+        Adds the trees of a set of columns (see tree_columns.columns_from_bytes). Returns the
+        (path << 32 | query ID << 1 | leaf) pair of every tree node, where leaf is 1 if the
+        tree node has no children.
+        '''
+        chunk_label_ids = np.array([self.label_ids.setdefault(alabel, len(self.label_ids))
+                                    for alabel in labels], dtype=np.int64)
+        tree_label = chunk_label_ids[columns['node_label']]
+        tree_parent = columns['node_parent']
+        tree_qid = np.repeat(columns['qids'], np.diff(columns['tree_ptr'])).astype(np.int64)
+        tree_path = np.full(len(tree_label), -1, dtype=np.int64)
+        new_keys = []
+        new_key_paths = []
+        level = np.flatnonzero(tree_parent < 0)
+        depth = 0
+        while len(level) and depth <= self.maxlevel:
+            parent = np.where(tree_parent[level] < 0, ROOT, tree_path[tree_parent[level]])
+            keys, inverse = np.unique((parent << _PATH_SHIFT) | tree_label[level], return_inverse=True)
+            key_paths = self.find(keys)
+            new = key_paths < 0
+            new_paths = np.arange(self.num_paths, self.num_paths + np.count_nonzero(new), dtype=np.int64)
+            key_paths[new] = new_paths
+            # The keys of a level have parents of the level above, so the new keys of this
+            # chunk are never looked up again before it ends
+            new_keys.append(keys[new])
+            new_key_paths.append(new_paths)
+            self.parent.append(keys[new] >> _PATH_SHIFT)
+            self.label.append(keys[new] & ((1 << _PATH_SHIFT) - 1))
+            self.depth.append(np.full(len(new_paths), depth, dtype=np.int64))
+            self.num_paths += len(new_paths)
+            tree_path[level] = key_paths[inverse]
+            # The next level holds the tree nodes whose parents are in this level
+            in_level = np.zeros(len(tree_label), dtype=bool)
+            in_level[level] = True
+            level = np.flatnonzero((tree_parent >= 0) & in_level[np.maximum(tree_parent, 0)])
+            depth += 1
+        new_keys = np.concatenate(new_keys) if new_keys else np.zeros(0, dtype=np.int64)
+        if len(new_keys):
+            self.insert(new_keys, np.concatenate(new_key_paths))
+
+        if self.num_paths > len(self.count):
+            # The counts grow geometrically, so they are copied only a few times
+            grow = max(self.num_paths, 2 * len(self.count)) - len(self.count)
+            self.count = np.concatenate((self.count, np.zeros(grow, dtype=np.int64)))
+            self.total = np.concatenate((self.total, np.zeros(grow, dtype=np.int64)))
+        kept = tree_path >= 0
+        tree_path = tree_path[kept]
+        tree_qid = tree_qid[kept]
+        # Only the paths of the chunk are counted
+        chunk_paths, inverse = np.unique(tree_path, return_inverse=True)
+        self.count[chunk_paths] += np.bincount(inverse, minlength=len(chunk_paths))
+        self.total[chunk_paths] += np.round(np.bincount(inverse, weights=self.freqs[tree_qid],
+                                                        minlength=len(chunk_paths))).astype(np.int64)
+        leaf = np.ones(len(tree_label), dtype=np.int64)
+        leaf[tree_parent[tree_parent >= 0]] = 0
+        return (tree_path << _PATH_SHIFT) | (tree_qid << 1) | leaf[kept]
+
+    def find(self, keys):
+        '''
+        The numbers of the paths of the given keys (-1 for the keys not seen yet)
+        '''
+        key_paths = np.full(len(keys), -1, dtype=np.int64)
+        for run_keys, run_paths in self.runs:
+            pos = np.minimum(np.searchsorted(run_keys, keys), len(run_keys) - 1)
+            found = run_keys[pos] == keys
+            key_paths[found] = run_paths[pos[found]]
+        return key_paths
+
+    def insert(self, keys, key_paths):
+        '''
+        Adds the keys of new paths as a new run, merged with the runs which are not more than
+        twice as long
+        '''
+        order = np.argsort(keys)
+        keys, key_paths = keys[order], key_paths[order]
+        while self.runs and len(self.runs[-1][0]) <= 2 * len(keys):
+            run_keys, run_paths = self.runs.pop()
+            keys = np.concatenate((run_keys, keys))
+            key_paths = np.concatenate((run_paths, key_paths))
+            order = np.argsort(keys, kind='mergesort')
+            keys, key_paths = keys[order], key_paths[order]
+        self.runs.append((keys, key_paths))
+
+    def fold(self, min_count=1, min_total=0):
+        '''
+        Finds the paths that are kept and those that are folded into "[other]" nodes (see
+        cluster_index.fold_nodes)
+        '''
+        return cluster_index.fold_nodes(np.concatenate(self.parent), np.concatenate(self.depth),
+                                        self.count[:self.num_paths], self.total[:self.num_paths],
+                                        np.inf, min_count, min_total)
+
+    def number_nodes(self, folding, other_count, other_total):
+        '''
+        Numbers the kept paths and the "[other]" nodes as the nodes of the index (see
+        cluster_index.prune_nodes). Returns the sorted labels, the arrays of the nodes (label,
+        parent, unique count and total count), the node ID of every path (-1 if it is dropped)
+        and whether the tree nodes of every path have to count as leaves.
+        '''
+        labels = [None] * len(self.label_ids)
+        for alabel, i in self.label_ids.iteritems():
+            labels[i] = alabel
+        path_depth = np.concatenate(self.depth)
+        labels, node_label, node_parent, node_count, node_total, path_node = cluster_index.prune_nodes(
+            labels, np.concatenate(self.label), np.concatenate(self.parent), path_depth,
+            self.count[:self.num_paths], self.total[:self.num_paths], folding, other_count, other_total)
+        # The folded nodes (and the nodes of the last level) lose their subclusters
+        path_leaf = (folding[1] | (path_depth == self.maxlevel)).astype(np.int64)
+        return labels, node_label, node_parent, node_count, node_total, path_node, path_leaf
+
+
+def build_snapshot(parsed_query_file, query_list, freq_list, index_file, qid_action=None, actions=None,
+                   memory_mb=1024, tmp_dir=None, maxlevel=np.inf, min_count=1, min_total=0, index_tokens=True):
+    '''
+    Builds the index of the parsed queries out of core and saves it as a snapshot, the
+    same as cluster_index.save_snapshot of ClusterIndex.from_columns of the same trees.
+    :param parsed_query_file: The parsed queries (output of parse_query, in the text or the binary format)
+    :param memory_mb: The approximate memory (in MB) used for the sorting. The clusters and the arrays
+                      of the queries are kept in the memory on top of it.
+    :param tmp_dir: Where the temporary files are written (the default temporary directory
+                    if None). They take two to three times the size of the snapshot.
+    :param maxlevel, min_count, min_total: Prune the clusters (see cluster_index.prune_nodes)
+    :param index_tokens: If True, the inverted index of the words of the queries (see token_index)
+                         is built out of core as well and saved with the clusters
+    :return: The number of clusters
+    '''
+    freqs = np.array(freq_list, dtype=np.int64)
+    num_queries = max(len(freqs), 1)
+    batch_items = max(memory_mb * 2 ** 20 // _BYTES_PER_ITEM, 1024)
+    work_dir = tempfile.mkdtemp(prefix='syntaviz-index-', dir=tmp_dir)
+    try:
+        # 1. Spill the (path, query ID) pairs of the trees to runs
+        paths = PathTable(freqs, maxlevel)
+        run_files = []
+        pending = []
+        num_pending = 0
+        for columns, labels in _columns_gen(parsed_query_file):
+            pairs = paths.add(columns, labels)
+            pending.append(pairs)
+            num_pending += len(pairs)
+            if num_pending >= batch_items:
+                run_files.append(_spill(work_dir, len(run_files), pending))
+                pending = []
+                num_pending = 0
+        if num_pending:
+            run_files.append(_spill(work_dir, len(run_files), pending))
+        del pending
+        print("Spilled %d tree nodes of %d clusters to %d runs" %
+              (paths.count[:paths.num_paths].sum(), paths.num_paths - 1, len(run_files)))
+
+        # 2. Fold the small paths. A query may be in several of the folded paths of a parent,
+        # so the (OTHER node, query ID) pairs of the folded paths are taken out of the runs
+        # and merged, and every query is counted once in its OTHER node.
+        folding = paths.fold(min_count, min_total)
+        kept, folded, folded_other, other_parent = folding
+        path_other = np.full(len(kept), -1, dtype=np.int64)
+        path_other[folded] = folded_other
+        other_ptr = np.zeros(len(other_parent) + 1, dtype=np.int64)
+        for arun in run_files:
+            pairs = np.fromfile(arun, dtype=np.int64)
+            path = pairs >> _PATH_SHIFT
+            other = path_other[path]
+            qid = (pairs >> 1) & ((1 << (_PATH_SHIFT - 1)) - 1)
+            in_other = other >= 0
+            other_pairs = np.unique(other[in_other] * num_queries + qid[in_other])
+            other_ptr[1:] += np.bincount(other_pairs // num_queries, minlength=len(other_parent))
+            other_pairs.tofile(arun + '.other')
+            # Only the pairs of the kept paths stay in the run
+            pairs[kept[path]].tofile(arun)
+            del pairs, path, other, qid, in_other, other_pairs
+        del path_other
+        other_ptr = np.cumsum(other_ptr)
+        other_count = np.zeros(len(other_parent), dtype=np.int64)
+        other_total = np.zeros(len(other_parent), dtype=np.int64)
+        other_file = os.path.join(work_dir, 'other')
+        with open(other_file, 'wb') as f:
+            for start, end, keys in _merge_runs([arun + '.other' for arun in run_files], other_ptr,
+                                                num_queries, batch_items):
+                keys = np.unique(keys)
+                other_count[start:end], other_total[start:end] = cluster_index.count_pairs(
+                    keys - start * num_queries, num_queries, end - start, freqs)
+                keys.tofile(f)
+        for arun in run_files:
+            os.remove(arun + '.other')
+
+        # 3. Number the nodes and sort the runs
+        labels, node_label, node_parent, node_count, node_total, path_node, path_leaf = \
+            paths.number_nodes(folding, other_count, other_total)
+        other_node = np.empty(len(other_parent), dtype=np.int64)
+        other_node[folded_other] = path_node[folded]
+        del paths, folding, kept, folded, folded_other, other_parent
+        num_nodes = len(node_label)
+        # Number of tree nodes of every query
+        query_count = np.zeros(len(freqs), dtype=np.int64)
+        sorted_runs = []
+        for arun, node, qid, leaf in _node_runs(run_files, other_file, path_node, path_leaf, other_node,
+                                                num_queries, batch_items):
+            query_count += np.bincount(qid, minlength=len(freqs))
+            np.sort(((node * num_queries + qid) << 1) | leaf).tofile(arun + '.node')
+            np.sort(qid * num_nodes + node).tofile(arun + '.query')
+            sorted_runs.append(arun)
+            del node, qid, leaf
+        del path_node, path_leaf, other_node
+
+        # 4. Merge the runs into the arrays of the query IDs
+        child_ptr = np.searchsorted(node_parent[1:], np.arange(num_nodes + 1), side='left') + 1
+        child_ptr[-1] = num_nodes
+        qid_ptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        qid_ptr[1:] = np.cumsum(node_count)
+        qnode_ptr = np.zeros(len(freqs) + 1, dtype=np.int64)
+        qnode_ptr[1:] = np.cumsum(query_count)
+        qid_data = _disk_array(work_dir, 'qid_data', np.int32, qid_ptr[-1])
+        qid_by_freq = _disk_array(work_dir, 'qid_by_freq', np.int32, qid_ptr[-1])
+        qnode_data = _disk_array(work_dir, 'qnode_data', np.int32, qnode_ptr[-1])
+        nondep_count = np.zeros(num_nodes, dtype=np.int32)
+        nondep_total = np.zeros(num_nodes, dtype=np.int64)
+        # The rank of every query in the order of descending frequency (ties broken by ID)
+        by_freq = np.lexsort((np.arange(len(freqs)), -freqs))
+        rank = np.empty(len(freqs), dtype=np.int64)
+        rank[by_freq] = np.arange(len(freqs))
+        for start, end, keys in _merge_runs([arun + '.node' for arun in sorted_runs], qid_ptr,
+                                            num_queries * 2, batch_items):
+            pair = keys >> 1
+            node_of = pair // num_queries
+            qid = pair % num_queries
+            qid_data[qid_ptr[start]:qid_ptr[end]] = qid
+            qid_by_freq[qid_ptr[start]:qid_ptr[end]] = by_freq[np.sort(node_of * num_queries + rank[qid]) % num_queries]
+            # A query is non-dependent in a node if none of its tree nodes there has children.
+            # The leaf bit sorts after the other tree nodes of the same (node, query) pair.
+            first = np.ones(len(pair), dtype=bool)
+            first[1:] = pair[1:] != pair[:-1]
+            nondep = first & (keys & 1 == 1)
+            nondep_count[start:end] = np.bincount(node_of[nondep] - start, minlength=end - start)
+            nondep_total[start:end] = np.round(np.bincount(node_of[nondep] - start, weights=freqs[qid[nondep]],
+                                                           minlength=end - start))
+        for start, end, keys in _merge_runs([arun + '.query' for arun in sorted_runs], qnode_ptr,
+                                            num_nodes, batch_items):
+            qnode_data[qnode_ptr[start]:qnode_ptr[end]] = keys % num_nodes
+
+        edge_keys, edge_nodes = cluster_index.index_edges(node_parent, node_label, len(labels))
+        label_ptr, label_nodes = cluster_index.index_labels(node_label, len(labels))
+        arrays = {
+            'node_label': node_label,
+            'node_parent': node_parent,
+            'node_total': node_total,
+            'child_ptr': child_ptr.astype(np.int32),
+            'child_by_total': cluster_index.sort_children(node_parent, node_total),
+            'edge_keys': edge_keys,
+            'edge_nodes': edge_nodes,
+            'label_ptr': label_ptr,
+            'label_nodes': label_nodes,
+            'qid_ptr': qid_ptr,
+            'qid_data': qid_data,
+            'qid_by_freq': qid_by_freq,
+            'nondep_count': nondep_count,
+            'nondep_total': nondep_total,
+            'qnode_ptr': qnode_ptr,
+            'qnode_data': qnode_data,
+            'freqs': freqs,
+        }
+        tokens = None
+        if index_tokens:
+            print("Indexing the words of the queries ...")
+            tokens = build_token_index(query_list, work_dir, batch_items)
+        print("Writing index snapshot ...")
+        cluster_index.save_snapshot(index_file, cluster_index.ClusterIndex(arrays, labels),
+                                    query_list, qid_action, actions, tokens)
+        return num_nodes - 1
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def build_token_index(query_list, work_dir, batch_items):
+    '''
+    Builds the token_index.TokenIndex of the queries out of core, the same as
+    TokenIndex.from_queries. The (word, query ID) pairs are spilled to runs of at most
+    batch_items pairs in work_dir, sorted once all the words are known and merged into a
+    memory mapped array of the query IDs of the words.
+    '''
+    num_queries = max(len(query_list), 1)
+    token_ids = {}
+    run_files = []
+    pending = array('l')
+    for qid, aquery in enumerate(query_list):
+        for atoken in set(token_index.tokenize(aquery)):
+            pending.append(token_ids.setdefault(atoken, len(token_ids)) << _PATH_SHIFT | qid)
+        if len(pending) >= batch_items:
+            run_files.append(_spill(work_dir, len(run_files), [np.frombuffer(pending, dtype=np.int64)], 'tokens'))
+            pending = array('l')
+    if len(pending):
+        run_files.append(_spill(work_dir, len(run_files), [np.frombuffer(pending, dtype=np.int64)], 'tokens'))
+    del pending
+
+    # The words are numbered in their sorted order
+    tokens = sorted(token_ids)
+    token_rank = np.empty(len(tokens), dtype=np.int64)
+    token_rank[[token_ids[atoken] for atoken in tokens]] = np.arange(len(tokens))
+    del token_ids
+    token_count = np.zeros(len(tokens), dtype=np.int64)
+    for arun in run_files:
+        pairs = np.fromfile(arun, dtype=np.int64)
+        os.remove(arun)
+        rank = token_rank[pairs >> _PATH_SHIFT]
+        token_count += np.bincount(rank, minlength=len(tokens))
+        np.sort(rank * num_queries + (pairs & ((1 << _PATH_SHIFT) - 1))).tofile(arun + '.token')
+        del pairs, rank
+    token_ptr = np.zeros(len(tokens) + 1, dtype=np.int64)
+    token_ptr[1:] = np.cumsum(token_count)
+    token_qids = _disk_array(work_dir, 'token_qids', np.int32, token_ptr[-1])
+    for start, end, keys in _merge_runs([arun + '.token' for arun in run_files], token_ptr,
+                                        num_queries, batch_items):
+        token_qids[token_ptr[start]:token_ptr[end]] = keys % num_queries
+    return token_index.TokenIndex(tokens, token_ptr, token_qids)
+
+
+def _columns_gen(parsed_query_file, chunk_size=20000):
+    # Yields the columns and the labels of the parse trees, a chunk at a time
+    if tree_columns.is_tree_columns(parsed_query_file):
+        for achunk in tree_columns.chunk_file_gen(parsed_query_file):
+            yield tree_columns.columns_from_bytes(achunk)
+    else:
+        with open(parsed_query_file) as f:
+            for achunk in tree_columns.chunk_gen(tree_columns.text_records(f), chunk_size):
+                yield tree_columns.columns_from_bytes(achunk)
+
+
+def _spill(work_dir, run_number, pending, prefix='run'):
+    # Writes the pending pairs to a new run file
+    run_file = os.path.join(work_dir, '%s%06d' % (prefix, run_number))
+    np.concatenate(pending).tofile(run_file)
+    return run_file
+
+
+def _node_runs(run_files, other_file, path_node, path_leaf, other_node, num_queries, batch_items):
+    # Yields the name, the nodes, the query IDs and the leaf bits of the tree nodes of every run,
+    # followed by those of the OTHER nodes (which have no subclusters), a batch at a time
+    for arun in run_files:
+        pairs = np.fromfile(arun, dtype=np.int64)
+        os.remove(arun)
+        path = pairs >> _PATH_SHIFT
+        yield arun, path_node[path], (pairs >> 1) & ((1 << (_PATH_SHIFT - 1)) - 1), (pairs & 1) | path_leaf[path]
+    if os.path.getsize(other_file):
+        other_keys = np.memmap(other_file, dtype=np.int64, mode='r')
+        for i in range(0, len(other_keys), batch_items):
+            keys = np.array(other_keys[i:i + batch_items])
+            yield ('%s%06d' % (other_file, i // batch_items), other_node[keys // num_queries], keys % num_queries,
+                   np.ones(len(keys), dtype=np.int64))
+
+
+def _disk_array(work_dir, name, dtype, length):
+    # An array of the given length in a memory mapped temporary file
+    if not length:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(os.path.join(work_dir, name), dtype=dtype, mode='w+', shape=(int(length),))
+
+
+def _merge_runs(run_files, ptr, key_scale, batch_items):
+    '''
+    Merges sorted runs of keys (ID * key_scale + ...) one range of IDs at a time, where
+    ptr[i]:ptr[i + 1] is the place of the keys of ID i in the merged result. Every range
+    holds at most batch_items keys, unless a single ID has more. Yields the first and the
+    last (exclusive) ID of every range and its sorted keys.
+    '''
+    runs = [np.memmap(arun, dtype=np.int64, mode='r') for arun in run_files if os.path.getsize(arun)]
+    num_ids = len(ptr) - 1
+    start = 0
+    while start < num_ids:
+        end = int(np.searchsorted(ptr, ptr[start] + batch_items, side='right')) - 1
+        end = min(max(end, start + 1), num_ids)
+        parts = []
+        for arun in runs:
+            lo, hi = np.searchsorted(arun, [start * key_scale, end * key_scale])
+            parts.append(np.array(arun[lo:hi]))
+        keys = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+        keys.sort()
+        yield start, end, keys
+        start = end
@@ -0,0 +1,79 @@
+# Copyright 2018 Comcast Cable Communications Management, LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+A stand-in for syntaxnet/demo.sh (and demo_conll.sh with --conll) that runs without
+tensorflow. It reads one query per line from stdin and writes a parse tree in the
+same format as syntaxnet for every query. The trees are made up: the first word is
+the root, the words at the even positions depend on the previous word and the rest
+depend on the root. Use it to try the parsing pipeline, e.g. with
+parse_query_with_syntaxnet(..., shellname='python -m syntaviz.fake_syntaxnet', parser_batch_size=1)
+With --drop WORD, the queries containing the word get no tree at all, like the sentences
+that a real parser sometimes skips (the tests use it to make a shard fail).
+'''
+import sys
+
+
+def fake_parse(query):
+    '''
+    Returns the conll rows (id, form, head, cpostag, postag, deprel) of a query
+    '''
+    rows = []
+    for i, word in enumerate(query.split()):
+        idx = i + 1
+        if idx == 1:
+            rows.append((idx, word, 0, 'VERB', 'VB', 'ROOT'))
+        elif idx % 2 == 0:
+            rows.append((idx, word, idx - 1, 'NOUN', 'NN', 'dobj'))
+        else:
+            rows.append((idx, word, 1, 'NOUN', 'NN', 'dep'))
+    return rows
+
+
+def conll_format(rows):
+    return ''.join('{0}\t{1}\t_\t{3}\t{4}\t_\t{2}\t{5}\t_\t_\n'.format(*arow) for arow in rows) + '\n'
+
+
+def tree_format(rows):
+    '''
+    Draws the tree like the conll2tree script of syntaxnet
+    '''
+    children = {}
+    for arow in rows:
+        children.setdefault(arow[2], []).append(arow)
+    lines = ['Input: ' + ' '.join(arow[1] for arow in rows), 'Parse:']
+
+    def draw(arow, prefix, last, depth):
+        label = '{1} {4} {5}'.format(*arow)
+        if depth == 0:
+            lines.append(label)
+            child_prefix = ' '
+        else:
+            lines.append(prefix + '+-- ' + label)
+            child_prefix = prefix + ('    ' if last else '|   ')
+        kids = children.get(arow[0], [])
+        for i, achild in enumerate(kids):
+            draw(achild, child_prefix, i == len(kids) - 1, depth + 1)
+    for aroot in children.get(0, []):
+        draw(aroot, ' ', True, 0)
+    return '\n'.join(lines) + '\n\n'
+
+
+if __name__ == '__main__':
+    conll = '--conll' in sys.argv[1:]
+    drop = sys.argv[sys.argv.index('--drop') + 1] if '--drop' in sys.argv[1:] else None
+    for aline in iter(sys.stdin.readline, ''):
+        if drop is not None and drop in aline.split():
+            continue
+        rows = fake_parse(aline.strip())
+        sys.stdout.write(conll_format(rows) if conll else tree_format(rows))
+        sys.stdout.flush()
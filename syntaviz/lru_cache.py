@@ -0,0 +1,85 @@
+# Copyright 2018 Comcast Cable Communications Management, LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    A thread-safe least-recently-used cache. It is bounded both by the number of
+    entries and by the total size of the values (len of the value, unless a size
+    is given explicitly). It also counts its hits and misses.
+    '''
+
+    def __init__(self, max_entries=256, max_size=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''
+        Returns the value cached for the key (and marks it as the most recently used)
+        or default if it is not cached
+        '''
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value, size = self._entries.pop(key)
+            self._entries[key] = (value, size)
+            return value
+
+    def put(self, key, value, size=None):
+        '''
+        Caches a value, evicting the least recently used entries if the cache is full.
+        Values larger than the whole cache are not cached.
+        '''
+        if size is None:
+            size = len(value)
+        if size > self.max_size or self.max_entries <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_size:
+                self.size -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def stats(self):
+        '''
+        Returns the number of entries, their total size, and the hit and miss counts
+        '''
+        return {'entries': len(self._entries),
+                'size': self.size,
+                'max_entries': self.max_entries,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses}
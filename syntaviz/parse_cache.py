@@ -0,0 +1,91 @@
+# Copyright 2018 Comcast Cable Communications Management, LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+An on-disk cache of parsed queries, so that the queries parsed by earlier runs of
+parse_query are not parsed again. It is a sqlite database keyed by the sha1 of the
+parser version and the (whitespace normalized) query.
+'''
+import hashlib
+import sqlite3
+import threading
+
+# sqlite allows at most 999 parameters in a statement
+_MAX_VARS = 500
+
+
+def normalize(query):
+    '''
+    Queries which differ only in whitespace have the same parse trees
+    '''
+    return ' '.join(query.split())
+
+
+class ParseCache(object):
+    '''
+    Maps queries to their parsed form (the query, the json parse tree and the conll style
+    parse tree separated by tabs, as written by parse_query.pipeline). It can be shared by
+    multiple threads. It counts its hits and misses.
+    :param filename: The sqlite database. It is created if it does not exist.
+    :param parser_version: Identifies the parser (and its model). The trees of a different
+                           version are not returned.
+    '''
+
+    def __init__(self, filename, parser_version):
+        self.filename = filename
+        self.parser_version = parser_version
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS parses (key TEXT PRIMARY KEY, parsed TEXT)')
+        self._conn.commit()
+
+    def key(self, query):
+        return hashlib.sha1(self.parser_version + '\n' + normalize(query)).hexdigest()
+
+    def get_many(self, queries):
+        '''
+        Returns the list of the parsed forms of the queries (None for the ones not in the cache)
+        '''
+        keys = [self.key(aquery) for aquery in queries]
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), _MAX_VARS):
+                chunk = keys[i:i + _MAX_VARS]
+                cursor = self._conn.execute('SELECT key, parsed FROM parses WHERE key IN (%s)' %
+                                            ','.join('?' * len(chunk)), chunk)
+                found.update(cursor.fetchall())
+            retval = [found.get(akey) for akey in keys]
+            hits = sum(1 for parsed in retval if parsed is not None)
+            self.hits += hits
+            self.misses += len(retval) - hits
+        return retval
+
+    def put_many(self, items):
+        '''
+        Stores a list of (query, parsed form) tuples
+        '''
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO parses VALUES (?, ?)',
+                                   ((self.key(aquery), parsed) for aquery, parsed in items))
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM parses').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
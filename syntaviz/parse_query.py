@@ -13,69 +13,251 @@
 import os
 import sys
 import stat
+import argparse
+import hashlib
+import shlex
+import subprocess
+import threading
+import Queue
 import numpy as np
 import json
 import time
+from collections import deque
 from itertools import izip
-from multiprocessing import Process
+from multiprocessing.pool import ThreadPool
 from os import path
+import parse_cache
+import tree_columns
 
 __author__ = 'mtanve200'
 
 
+# A query that is appended to every batch sent to a parser. Its parse tree marks the
+# end of the output of the batch
+SENTINEL = 'syntavizendofbatch'
+
+
+class ParserWorker(object):
+    '''
+    A long-lived parser (syntaxnet) subprocess. The queries are streamed to its stdin
+    and the parse trees are read back from its stdout, so the model is loaded only once
+    for all the batches parsed by the worker. No shell is involved, so the queries are
+    passed verbatim.
+    :param shellname: Command line of the parser (e.g. syntaxnet/demo.sh, syntaxnet/demo_conll.sh,
+                      or python -m syntaviz.fake_syntaxnet)
+    :param conll: True if the parser outputs conll style trees (demo_conll.sh)
+    :param parser_batch_size: The parser reads its input in batches of this size (demo.sh uses 1024),
+                              so every batch is padded with sentinel queries up to a multiple of it.
+                              Otherwise the parser would wait for the rest of its batch forever.
+    '''
+
+    def __init__(self, shellname='syntaxnet/demo.sh', conll=False, parser_batch_size=1024):
+        self.shellname = shellname
+        self.conll = conll
+        self.parser_batch_size = parser_batch_size
+        env = dict(os.environ)
+        # The python stages of the parser must not hold their output in a buffer
+        env['PYTHONUNBUFFERED'] = '1'
+        self.proc = subprocess.Popen(shlex.split(shellname),
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     env=env)
+
+    def parse(self, queries):
+        '''
+        Parses a batch of queries and returns the lines of the output of the parser
+        (without the trees of the sentinels)
+        '''
+        num_sentinels = self.parser_batch_size - len(queries) % self.parser_batch_size
+        lines = list(queries) + [SENTINEL] * num_sentinels
+
+        def feed():
+            # Written from a separate thread, because the parser would stop reading
+            # when nobody reads its output
+            try:
+                self.proc.stdin.write(''.join(aline + '\n' for aline in lines))
+                self.proc.stdin.flush()
+            except IOError:
+                # The parser died. It is reported by the reader.
+                pass
+        writer = threading.Thread(target=feed)
+        writer.daemon = True
+        writer.start()
+
+        output = []
+        seen = 0
+        while True:
+            aline = self.proc.stdout.readline()
+            if not aline:
+                raise IOError('Parser exited before the end of the batch: ' + self.shellname)
+            aline = aline.rstrip('\n')
+            if self.conll:
+                # A sentinel is a single token sentence. It ends with a blank line.
+                if aline.split('\t')[1:2] == [SENTINEL]:
+                    seen += 1
+                    self.proc.stdout.readline()
+                    if seen == num_sentinels:
+                        break
+                    continue
+            else:
+                # The tree of a sentinel is a single (root) line after the Input and Parse lines
+                if aline.startswith('Input') and aline[6:].strip() == SENTINEL:
+                    seen += 1
+                    while not aline.startswith(SENTINEL):
+                        aline = self.proc.stdout.readline()
+                        if not aline:
+                            raise IOError('Parser exited before the end of the batch: ' + self.shellname)
+                    if seen == num_sentinels:
+                        break
+                    continue
+            if not seen:
+                output.append(aline)
+        writer.join()
+        return output
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class ParserPool(object):
+    '''
+    A fixed number of ParserWorkers. The batches are parsed by whichever worker is free.
+    :param size: Number of parser subprocesses
+    The remaining arguments are passed to the ParserWorkers.
+    '''
+
+    def __init__(self, size=1, shellname='syntaxnet/demo.sh', conll=False, parser_batch_size=1024):
+        self.worker_args = (shellname, conll, parser_batch_size)
+        self.workers = [ParserWorker(*self.worker_args) for _ in range(size)]
+        self.free = Queue.Queue()
+        for aworker in self.workers:
+            self.free.put(aworker)
+
+    def parse(self, queries):
+        '''
+        Parses a batch of queries with a free worker (see ParserWorker.parse).
+        A worker that fails is replaced by a new one.
+        '''
+        aworker = self.free.get()
+        try:
+            return aworker.parse(queries)
+        except IOError:
+            aworker.kill()
+            self.workers.remove(aworker)
+            aworker = ParserWorker(*self.worker_args)
+            self.workers.append(aworker)
+            raise
+        finally:
+            self.free.put(aworker)
+
+    def parse_batches(self, batches):
+        '''
+        Parses the batches in parallel and yields the outputs in the order of the batches
+        '''
+        return bounded_imap(self.parse, batches, len(self.workers))
+
+    def close(self):
+        for aworker in self.workers:
+            aworker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def bounded_imap(func, iterable, num_threads):
+    '''
+    Like ThreadPool.imap, but at most 2 * num_threads items of the iterable are taken
+    before their results are yielded, so that a long iterable is never read into memory
+    '''
+    threads = ThreadPool(max(num_threads, 1))
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(threads.apply_async(func, (item,)))
+            if len(pending) >= 2 * max(num_threads, 1):
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        threads.terminate()
+
+
+def batch_gen(query_generator, start_index=0, end_index=np.inf, batch_size=1000):
+    '''
+    Collects the (index, query) tuples from start_index to end_index (both inclusive, counted
+    as they arrive) of the query_generator into lists of batch_size tuples
+    '''
+    container = []
+    for i, item in enumerate(query_generator):
+        if i < start_index:
+            continue
+        elif i > end_index:
+            break
+        container.append(item)
+        if len(container) == batch_size:
+            yield container
+            container = []
+    if container:
+        yield container
+
+
 def parse_query_with_syntaxnet(query_generator,
                                start_index=0,
                                end_index=np.inf,
-                               shellname='syntaxnet/demo.sh'):
+                               shellname='syntaxnet/demo.sh',
+                               batch_size=1000,
+                               pool_size=1,
+                               parser_batch_size=1024,
+                               conll=None,
+                               pool=None):
     '''
-    Parses a query using syntaxnet. It breaks the input stream into mini batches of 1000
-    queries and passes through the syntaxnet. It extracts two different styles of the parse
-    tree. It reads the whole input and returns the trees as a list. Do do not feed an
-    infinitely long stream because that will overflow the memory.
+    Parses a query using syntaxnet. It breaks the input stream into mini batches of batch_size
+    queries and streams them through a pool of long-lived syntaxnet processes.
+    It reads the whole input and returns the trees as a list. Do do not feed an
+    infinitely long stream because that will overflow the memory (pipeline streams the
+    batches to the output file instead).
     It requires to be called from the /root/models/syntaxnet/
     folder of the syntaxnet docker
     :param query_generator: An iterator of (index, query) tuples
     :param start_index: From which item it will start parsing. Note, it does not consider the index
                         of the data in the query file. It considers the idex of the data as they arrive
     :param end_index: Where it will stop reading. Same convention to start_index applies.
-
-    Note: It is utmost important to remove the last element (a blank line)
-    from the output of parse_query_with_syntaxnet function, before passing
-    it to the segment_gen function. Otherwise, it will create an invalid 
-    tree for the last element of the batch due to the blank line.
+    :param shellname: The parser command. demo.sh gives the normal parse tree and demo_conll.sh
+                      (see make_new_shell) gives the conll style parse tree.
+    :param batch_size: Number of queries sent to a parser at a time
+    :param pool_size: Number of parser processes (each of them loads the model once)
+    :param parser_batch_size: See ParserWorker
+    :param conll: True if the parser outputs conll style trees. By default, it is guessed from the shellname.
+    :param pool: A ParserPool to use instead of starting (and stopping) a new one
     '''
     assert start_index < end_index, 'Start index cannot be greater than end index'
-    allparsetreelist = []
     orig_idx_list = []
-    container = []
-    idx_container = []
 
-    def process_single(idx_container, container, orig_idx, aquery):
-        container.append(aquery)
-        idx_container.append(orig_idx)
+    def query_batch_gen():
+        for abatch in batch_gen(query_generator, start_index, end_index, batch_size):
+            orig_idx_list.extend(orig_idx for orig_idx, _ in abatch)
+            yield [aquery for _, aquery in abatch]
 
-    def write_to_disk(idx_container, container):
-        argtxt_ = '\n'.join(container)
-        output = os.popen('echo ' + '"' + argtxt_ + '"' + ' | ' + shellname).read().split('\n')
-        allparsetreelist.extend(output)
-        orig_idx_list.extend(idx_container)
-
-    # Iterate over the queries and the save the parsed tree
-    for i, (orig_idx, aquery) in enumerate(query_generator):
-        if i < start_index:
-            continue
-        elif start_index <= i <= end_index:
-            # put the first query in a container
-            process_single(idx_container, container, orig_idx, aquery)
-            if len(container) % 1000 == 999:
-                # The container is full. Process the queries within the container
-                write_to_disk(idx_container, container)
-                container = []
-                idx_container = []
-        elif i > end_index:
-            break
-    if len(container) > 0:
-        write_to_disk(idx_container, container)
+    allparsetreelist = []
+    if pool is None:
+        if conll is None:
+            conll = 'conll' in shellname
+        with ParserPool(pool_size, shellname, conll, parser_batch_size) as pool:
+            for output in pool.parse_batches(query_batch_gen()):
+                allparsetreelist.extend(output)
+    else:
+        for output in pool.parse_batches(query_batch_gen()):
+            allparsetreelist.extend(output)
     return allparsetreelist, orig_idx_list
 
 
@@ -92,24 +274,27 @@ def make_new_shell():
     os.chmod('syntaxnet/demo_conll.sh', st.st_mode | stat.S_IEXEC)
 
 
-def query_gen(inpfile):
+def query_gen(inpfile, offset=0):
     '''
     Construct an iterator to feed the queries from the inpfile
+    :param offset: Byte offset (the start of a line) where the reading starts
     '''
     # Start reading and yieling the queries
     with open(inpfile) as f:
+        f.seek(offset)
         for aline in f:
             spltline = aline.strip().split('\t')
             yield int(spltline[0]), spltline[1]
 
 
-def abstract_query_gen(inpfile):
+def abstract_query_gen(inpfile, offset=0):
     '''
     It is similar to query_gen. The only difference is, it reads from the abstract query file,
     thus processes and transmits the abstract queries accordingly.
     '''
     # Start reading and yieling the queries
     with open(inpfile) as f:
+        f.seek(offset)
         for aline in f:
             spltline = aline.strip().split('\t')
             yield int(spltline[0]), spltline[2]
@@ -136,26 +321,24 @@ def segment_gen(inp_gen):
     is given in a json format.
     :param inp_gen: input iterator 
     '''
-    retval = ''
-    parsetree = ''
+    query = None
+    parsetree = []
     currlevel = -1
-    count = 0
     for inp in inp_gen:
         # Transforming the tree with states "Input", "Parse", and
         # the normal tree parsing.
         if inp.startswith('Input'):
-            # if there is something in retval from previous iterations
-            if retval:
-                # Close off the tree 
-                retval += parsetree + ']' * (currlevel + 2)
-                yield retval
-                # Reset the value
-                retval = ''
-            # There is nothing from previous iterations, so start making
-            retval += inp[6:].strip() + '\t'
+            # if there is a query from previous iterations
+            if query is not None:
+                # Close off the tree
+                parsetree.append(']' * (currlevel + 2))
+                yield query + '\t' + ''.join(parsetree)
+            # Start making the next one
+            query = inp[6:].strip()
+            parsetree = []
         elif inp.startswith('Parse'):
             # start of the parse tree
-            parsetree = ''
+            parsetree = []
         elif not inp:
             # if the input is empty, just skip it
             continue
@@ -163,11 +346,11 @@ def segment_gen(inp_gen):
             parse_out, currlevel = jsonify_tree(inp, currlevel)
             # Debug
             # print inp,parse_out,currlevel
-            parsetree += parse_out
-    if retval and parsetree:
+            parsetree.append(parse_out)
+    if query is not None and parsetree:
         # Close off the last tree
-        retval += parsetree + ']' * (currlevel + 2)
-        yield retval
+        parsetree.append(']' * (currlevel + 2))
+        yield query + '\t' + ''.join(parsetree)
 
 
 def segment_gen_conll(inp_gen):
@@ -183,6 +366,46 @@ def segment_gen_conll(inp_gen):
             aparse.append(inp.split('\t')[1:])
 
 
+def segment_gen_single(inp_gen):
+    '''
+    Similar to segment_gen_conll, but it also derives the json parse tree (as given by
+    segment_gen) from the conll style parse tree. So, the parser needs to run only once.
+    It yields the query, the json parse tree and the conll style parse tree separated by tabs.
+    '''
+    aparse = []
+    for inp in inp_gen:
+        if not inp:
+            # The query is given by the tokens, like the Input line of the normal parse tree
+            yield ' '.join(arow[0] for arow in aparse) + '\t' + \
+                json.dumps(conll_to_tree(aparse)) + '\t' + json.dumps(aparse)
+            aparse = []
+        else:
+            aparse.append(inp.split('\t')[1:])
+
+
+def conll_to_tree(aparse):
+    '''
+    Converts a conll style parse tree (the list of the columns of every token after the ID,
+    as given by segment_gen_conll) to the json tree structure given by jsonify_tree.
+    Every node is labelled by the word, its (fine grained) POS tag and its dependency relation,
+    followed by the list of its children (if any) in the order of the words.
+    '''
+    children = {}
+    for i, arow in enumerate(aparse):
+        # The token IDs start from 1. The root has head 0.
+        children.setdefault(int(arow[5]), []).append(i + 1)
+
+    def subtree(head):
+        retval = []
+        for idx in children[head]:
+            arow = aparse[idx - 1]
+            retval.append(arow[0] + ' ' + arow[3] + ' ' + arow[6])
+            if idx in children:
+                retval.append(subtree(idx))
+        return retval
+    return subtree(0) if 0 in children else []
+
+
 def jsonify_tree(inp, currlevel):
     '''
     Converts from syntaxnet tree structure to json tree structure.
@@ -210,7 +433,18 @@ def jsonify_tree(inp, currlevel):
 def pipeline(inpfile, outfile,
              start_idx=0,
              end_idx=np.inf,
-             stream_generator_function=query_gen):
+             stream_generator_function=query_gen,
+             batch_size=1000,
+             pool_size=1,
+             single_pass=False,
+             shellname='syntaxnet/demo.sh',
+             conll_shellname='syntaxnet/demo_conll.sh',
+             parser_batch_size=1024,
+             offset=0,
+             tree_pool=None,
+             conll_pool=None,
+             cache=None,
+             binary=False):
     '''
     This is the complete pipeline for parsing the (raw or abstract) queries from the queryfile
     (query_analysis/data/non_titles.queries) using syntaxnet and producing the outfile.
@@ -223,57 +457,374 @@ def pipeline(inpfile, outfile,
     This argument takes only the following two generator functions:
     a) query_gen
     b) abstract_query_gen
+    :param batch_size: Number of queries sent to a parser at a time
+    :param pool_size: Number of parser processes (when the pools are not given)
+    :param single_pass: If True, the queries are parsed only once (by conll_shellname) and the
+                        normal parse tree is derived from the conll style parse tree (see conll_to_tree)
+    :param shellname: The parser giving the normal parse tree
+    :param conll_shellname: The parser giving the conll style parse tree
+    :param parser_batch_size: See ParserWorker
+    :param offset: Byte offset in the inpfile where the stream starts (start_idx and end_idx count from there)
+    :param tree_pool: A ParserPool of shellname to use instead of starting a new one
+    :param conll_pool: A ParserPool of conll_shellname to use instead of starting a new one
+    :param cache: A parse_cache.ParseCache. The queries found in it are not parsed, and the
+                  newly parsed queries are added to it.
+    :param binary: If True, the parse trees are written in the binary format of tree_columns
+                   (without the queries and the conll style trees) instead of the text format
     '''
-    # Normal parse tree
-    qgen1 = stream_generator_function(inpfile)
-    output_tree, orig_idx_list = parse_query_with_syntaxnet(qgen1, start_index=start_idx, end_index=end_idx)
-    tree_gen = segment_gen(output_tree)
-
-    # Conll style parse tree
-    qgen2 = stream_generator_function(inpfile)
-    output_conll, orig_idx_list = parse_query_with_syntaxnet(qgen2, start_index=start_idx, end_index=end_idx,
-                                                             shellname='syntaxnet/demo_conll.sh')
-    conll_gen = segment_gen_conll(output_conll)
-
-    # Save to file
-    with open(outfile, 'wb') as f:
-        for (i, tree, conll) in izip(orig_idx_list, tree_gen, conll_gen):
-            f.write(tree + '\t' + conll + '\t' + str(i) + '\n')
-            f.flush()
+    # Start the parsers, unless they are given
+    own_pools = []
+    if conll_pool is None:
+        conll_pool = ParserPool(pool_size, conll_shellname, True, parser_batch_size)
+        own_pools.append(conll_pool)
+    if tree_pool is None and not single_pass:
+        tree_pool = ParserPool(pool_size, shellname, False, parser_batch_size)
+        own_pools.append(tree_pool)
+
+    def parse_batch(abatch):
+        # Returns the output lines of a batch of (query index, query) tuples
+        found = cache.get_many([aquery for _, aquery in abatch]) if cache is not None else [None] * len(abatch)
+        # Only the queries missing from the cache are parsed
+        misses = [item for item, parsed in izip(abatch, found) if parsed is None]
+        new_parsed = {}
+        if misses:
+            queries = [aquery for _, aquery in misses]
+            # Every parse tree is checked against its query, so that a query skipped by a
+            # parser fails the batch instead of shifting the trees of the next queries
+            if single_pass:
+                parsed_list = list(segment_gen_single(conll_pool.parse(queries)))
+                check_parsed(queries, [parsed.split('\t', 1)[0] for parsed in parsed_list], conll_shellname)
+            else:
+                # Normal parse tree and conll style parse tree
+                trees = list(segment_gen(tree_pool.parse(queries)))
+                check_parsed(queries, [tree.split('\t', 1)[0] for tree in trees], shellname)
+                conlls = list(segment_gen_conll(conll_pool.parse(queries)))
+                check_parsed(queries, [u' '.join(arow[0] for arow in json.loads(conll)).encode('utf-8')
+                                       for conll in conlls], conll_shellname)
+                parsed_list = [tree + '\t' + conll for tree, conll in izip(trees, conlls)]
+            new_parsed = dict(izip((orig_idx for orig_idx, _ in misses), parsed_list))
+            # Only the trees of a complete batch get into the cache
+            if cache is not None:
+                cache.put_many([(aquery, new_parsed[orig_idx]) for orig_idx, aquery in misses])
+        return [(orig_idx, parsed if parsed is not None else new_parsed[orig_idx])
+                for (orig_idx, _), parsed in izip(abatch, found)]
+
+    # The batches flow from the input through the parsers to the output file, so only
+    # a few batches are in the memory at a time
+    batches = batch_gen(stream_generator_function(inpfile, offset), start_idx, end_idx, batch_size)
+    try:
+        parsed_gen = (item for items in bounded_imap(parse_batch, batches, len(conll_pool.workers)) for item in items)
+        if binary:
+            write_atomic(outfile, tree_columns.chunk_gen((i, decode_tree(parsed)) for (i, parsed) in parsed_gen))
+        else:
+            write_atomic(outfile, (parsed + '\t' + str(i) + '\n' for (i, parsed) in parsed_gen))
+    finally:
+        for apool in own_pools:
+            apool.close()
 
 
-if __name__ == '__main__':
-    make_new_shell()
+def check_parsed(queries, texts, shellname):
+    '''
+    Raises IOError unless the texts of the parse trees (their Input lines or their tokens)
+    are those of the queries, in the same order. The parser may change the whitespace of
+    a query, so the texts are compared without it.
+    '''
+    if len(texts) != len(queries):
+        raise IOError('%s gave %d parse trees for %d queries' % (shellname, len(texts), len(queries)))
+    for aquery, atext in izip(queries, texts):
+        if ''.join(aquery.split()) != ''.join(atext.split()):
+            raise IOError('%s gave the parse tree of "%s" for the query "%s"' % (shellname, atext, aquery))
 
-    abstract = False
 
-    inpfile = sys.argv[1]
-    outfile = sys.argv[2]
+def decode_tree(parsed):
+    '''
+    Returns the json parse tree from the parsed form of a query (None if it is corrupt)
+    '''
+    try:
+        return json.loads(parsed.split('\t')[1])
+    except ValueError:
+        print("Skipping corrupt tree: %s" % parsed.split('\t')[0])
+        return None
 
-    outdir = path.dirname(os.path.abspath(outfile))
-    if not os.path.exists(outdir):
-        raise OSError("Output directory does not exist: %s" % outdir)
 
-    def file_len(fname):
-        i = -1
-        with open(fname) as f:
-            for i, l in enumerate(f):
-                pass
-        return i + 1
+def write_atomic(filename, lines):
+    '''
+    Writes the lines to a temporary file and renames it to filename, so the file
+    never exists half-written
+    '''
+    with open(filename + '.tmp', 'wb') as f:
+        for aline in lines:
+            f.write(aline)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(filename + '.tmp', filename)
+
+
+def file_checksum(filename, binary=False):
+    '''
+    Returns the sha1 (hex) and the number of parsed queries (lines, or trees if binary) of a file
+    '''
+    sha = hashlib.sha1()
+    line_cnt = 0
+    with open(filename, 'rb') as f:
+        for ablock in iter(lambda: f.read(1 << 20), b''):
+            sha.update(ablock)
+            line_cnt += ablock.count(b'\n')
+    if binary:
+        line_cnt = tree_columns.count_trees(filename)
+    return sha.hexdigest(), line_cnt
+
+
+def shard_file(inpfile, shard_size):
+    '''
+    Reads the inpfile once and splits it into shards of shard_size lines.
+    Returns the number of lines and the list of shards as (first line, number of lines, byte offset)
+    '''
+    shards = []
+    line_cnt = 0
+    offset = 0
+    with open(inpfile) as f:
+        for aline in f:
+            if line_cnt % shard_size == 0:
+                shards.append([line_cnt, 0, offset])
+            shards[-1][1] += 1
+            line_cnt += 1
+            offset += len(aline)
+    return line_cnt, [tuple(ashard) for ashard in shards]
 
 
-    line_cnt = file_len(inpfile)
+def part_name(outfile, start):
+    '''
+    Name of the file where the shard starting at the line start is written
+    '''
+    return path.join(outfile + '.parts', 'part{0:010d}'.format(start))
 
-    print(sys.argv)
-    print(line_cnt)
 
-    if abstract:
-        for i in range(0, line_cnt, 1000):
-            p = Process(target=pipeline, args=(inpfile, outfile + str(i), i, i + 999, abstract_query_gen))
-            p.start()
-            time.sleep(5)
-    else:
-        for i in range(0, line_cnt, 1000):
-            p = Process(target=pipeline, args=(inpfile, outfile + str(i), i, i + 999))
-            p.start()
-            time.sleep(5)
+def manifest_name(outfile):
+    '''
+    Name of the manifest file, recording the settings of a run and the shards it has finished
+    '''
+    return path.join(outfile + '.parts', 'manifest.json')
+
+
+def save_manifest(outfile, manifest):
+    write_atomic(manifest_name(outfile), [json.dumps(manifest, indent=1, sort_keys=True)])
+
+
+def parse_file(inpfile, outfile,
+               workers=4,
+               shard_size=10000,
+               retries=2,
+               keep_parts=False,
+               resume=False,
+               stream_generator_function=query_gen,
+               **pipeline_args):
+    '''
+    Parses all the queries of the inpfile into the outfile (parsed.txt). The file is split
+    into shards of shard_size lines, which are put in a work queue. A fixed number of workers
+    take the shards from the queue and parse them with a shared pool of (workers) parser
+    processes, using pipeline. A shard is written to its own part file (see part_name).
+    A shard that fails is retried up to retries times. When all the shards are done, the parts
+    are concatenated in order into the outfile, which must have as many lines as the inpfile.
+    A part is renamed to its final name only after it is completely written, and the manifest
+    (see manifest_name) records the number of lines and the checksum of every finished part.
+    :param keep_parts: If False, the parts are deleted after they are merged
+    :param resume: If True, the finished shards of a previous run with the same settings are not
+                   parsed again, unless their parts are missing or do not match the manifest
+    :param pipeline_args: Passed to pipeline (e.g. single_pass, batch_size, shellname)
+    '''
+    line_cnt, shards = shard_file(inpfile, shard_size)
+    print('%d queries in %d shards' % (line_cnt, len(shards)))
+    binary = bool(pipeline_args.get('binary'))
+    if not os.path.exists(outfile + '.parts'):
+        os.makedirs(outfile + '.parts')
+
+    # The parts of a run can be reused only by a run with the same settings
+    settings = {'input': path.abspath(inpfile),
+                'input_size': path.getsize(inpfile),
+                'shard_size': shard_size,
+                'stream': stream_generator_function.__name__,
+                'single_pass': bool(pipeline_args.get('single_pass')),
+                'binary': binary}
+    manifest = {'settings': settings, 'shards': {}}
+    if resume and path.exists(manifest_name(outfile)):
+        with open(manifest_name(outfile)) as f:
+            previous = json.load(f)
+        if previous['settings'] != settings:
+            raise ValueError('The parts in %s were made with different settings: %s. Run without resume.' %
+                             (outfile + '.parts', previous['settings']))
+        for start, count, _ in shards:
+            entry = previous['shards'].get(str(start))
+            if entry is None:
+                continue
+            if path.exists(part_name(outfile, start)) and \
+                    list(file_checksum(part_name(outfile, start), binary)) == [entry['sha1'], entry['lines']]:
+                manifest['shards'][str(start)] = entry
+            else:
+                print('Shard %d is missing or corrupt. It will be parsed again.' % start)
+        print('Resuming: %d of %d shards are already done' % (len(manifest['shards']), len(shards)))
+    save_manifest(outfile, manifest)
+    todo = [ashard for ashard in shards if str(ashard[0]) not in manifest['shards']]
+
+    shellname = pipeline_args.get('shellname', 'syntaxnet/demo.sh')
+    conll_shellname = pipeline_args.get('conll_shellname', 'syntaxnet/demo_conll.sh')
+    parser_batch_size = pipeline_args.get('parser_batch_size', 1024)
+    # No parser is started (and no model is loaded) if all the shards are done
+    pool_size = workers if todo else 0
+    conll_pool = ParserPool(pool_size, conll_shellname, True, parser_batch_size)
+    tree_pool = None
+    if not pipeline_args.get('single_pass'):
+        tree_pool = ParserPool(pool_size, shellname, False, parser_batch_size)
+
+    work = Queue.Queue()
+    for ashard in todo:
+        work.put((ashard, 0))
+    failed = []
+    progress = {'shards': len(shards) - len(todo), 'lines': line_cnt - sum(ashard[1] for ashard in todo)}
+    lock = threading.Lock()
+    start_time = time.time()
+
+    def worker():
+        while True:
+            try:
+                (start, count, offset), attempt = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                pipeline(inpfile, part_name(outfile, start), 0, count - 1,
+                         stream_generator_function=stream_generator_function,
+                         offset=offset,
+                         tree_pool=tree_pool,
+                         conll_pool=conll_pool,
+                         **pipeline_args)
+                sha1, part_cnt = file_checksum(part_name(outfile, start), binary)
+                # A short part fails like any other error, so it never gets into the manifest
+                if part_cnt != count:
+                    raise IOError('%d parsed queries out of %d' % (part_cnt, count))
+            except Exception as e:
+                if attempt < retries:
+                    print('Shard %d failed (%s). Retrying.' % (start, e))
+                    work.put(((start, count, offset), attempt + 1))
+                else:
+                    print('Shard %d failed (%s). Giving up.' % (start, e))
+                    with lock:
+                        failed.append(start)
+                continue
+            with lock:
+                manifest['shards'][str(start)] = {'count': count, 'offset': offset, 'lines': part_cnt, 'sha1': sha1}
+                save_manifest(outfile, manifest)
+                progress['shards'] += 1
+                progress['lines'] += count
+                elapsed = time.time() - start_time
+                print('Parsed %d/%d shards, %d/%d queries (%.1f queries/s)' %
+                      (progress['shards'], len(shards), progress['lines'], line_cnt,
+                       progress['lines'] / max(elapsed, 1e-6)))
+                sys.stdout.flush()
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    try:
+        for athread in threads:
+            athread.start()
+        for athread in threads:
+            athread.join()
+    finally:
+        conll_pool.close()
+        if tree_pool is not None:
+            tree_pool.close()
+    if failed:
+        raise RuntimeError('Failed shards (first lines): %s. Run again with resume to parse only them.' %
+                           ', '.join(str(x) for x in sorted(failed)))
+
+    # Merge the parts in order
+    print('Merging the parts into ' + outfile)
+    # The parts match their checksums, so they have the numbers of lines (or trees) in the manifest.
+    # They are merged into a temporary file, which becomes the outfile only if all the checks pass.
+    out_cnt = 0
+    try:
+        with open(outfile + '.tmp', 'wb') as f:
+            for start, _, _ in shards:
+                sha = hashlib.sha1()
+                with open(part_name(outfile, start), 'rb') as part:
+                    for ablock in iter(lambda: part.read(1 << 20), b''):
+                        f.write(ablock)
+                        sha.update(ablock)
+                out_cnt += manifest['shards'][str(start)]['lines']
+                if sha.hexdigest() != manifest['shards'][str(start)]['sha1']:
+                    raise IOError('%s does not match the manifest. Run again with resume to parse it again.' %
+                                  part_name(outfile, start))
+            if out_cnt != line_cnt:
+                raise IOError('%s has %d lines but %s has %d lines. The parts are kept in %s' %
+                              (outfile, out_cnt, inpfile, line_cnt, outfile + '.parts'))
+            f.flush()
+            os.fsync(f.fileno())
+    except:
+        os.remove(outfile + '.tmp')
+        raise
+    os.rename(outfile + '.tmp', outfile)
+    if not keep_parts:
+        for start, _, _ in shards:
+            os.remove(part_name(outfile, start))
+        os.remove(manifest_name(outfile))
+        os.rmdir(outfile + '.parts')
+    cache = pipeline_args.get('cache')
+    if cache is not None:
+        print('%d queries were found in the parse cache, %d were parsed' % (cache.hits, cache.misses))
+    print('Done. %d queries parsed into %s' % (out_cnt, outfile))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parses the queries with syntaxnet. It must run from the '
+                                                 'syntaxnet folder of the syntaxnet docker.')
+    parser.add_argument('query_file', help='The query file (ID, query, ..., count)')
+    parser.add_argument('parsed_query_file', help='Where the parsed queries will be written')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of shards parsed at a time (and of parser processes)')
+    parser.add_argument('--shard-size', type=int, default=10000, help='Number of queries in a shard')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='Number of queries sent to a parser at a time')
+    parser.add_argument('--retries', type=int, default=2, help='How many times a failed shard is retried')
+    parser.add_argument('--single-pass', action='store_true',
+                        help='Parse only once (conll) and derive the normal parse tree from it')
+    parser.add_argument('--abstract', action='store_true', help='Parse the abstract queries (third column)')
+    parser.add_argument('--keep-parts', action='store_true', help='Keep the parsed shards after merging')
+    parser.add_argument('--resume', action='store_true',
+                        help='Parse only the shards that a previous (failed) run did not finish')
+    parser.add_argument('--shell', default='syntaxnet/demo.sh', help='The parser giving the normal parse tree')
+    parser.add_argument('--conll-shell', default='syntaxnet/demo_conll.sh',
+                        help='The parser giving the conll style parse tree')
+    parser.add_argument('--parser-batch-size', type=int, default=1024,
+                        help='Batch size used inside the parser (see ParserWorker)')
+    parser.add_argument('--binary', action='store_true',
+                        help='Write the parse trees in the binary format of tree_columns, which loads much faster')
+    parser.add_argument('--cache', help='A parse cache (sqlite file). Queries parsed by earlier runs are '
+                                        'taken from it instead of being parsed again.')
+    parser.add_argument('--parser-version',
+                        help='Identifies the parser model in the parse cache (by default, the parser commands)')
+    args = parser.parse_args()
+
+    outdir = path.dirname(os.path.abspath(args.parsed_query_file))
+    if not os.path.exists(outdir):
+        raise OSError("Output directory does not exist: %s" % outdir)
+    if args.conll_shell == 'syntaxnet/demo_conll.sh':
+        make_new_shell()
+    cache = None
+    if args.cache:
+        parser_version = args.parser_version
+        if parser_version is None:
+            parser_version = args.conll_shell if args.single_pass else args.shell + '|' + args.conll_shell
+        cache = parse_cache.ParseCache(args.cache, parser_version)
+
+    parse_file(args.query_file, args.parsed_query_file,
+               workers=args.workers,
+               shard_size=args.shard_size,
+               retries=args.retries,
+               keep_parts=args.keep_parts,
+               resume=args.resume,
+               stream_generator_function=abstract_query_gen if args.abstract else query_gen,
+               single_pass=args.single_pass,
+               batch_size=args.batch_size,
+               shellname=args.shell,
+               conll_shellname=args.conll_shell,
+               parser_batch_size=args.parser_batch_size,
+               cache=cache,
+               binary=args.binary)
@@ -0,0 +1,197 @@
+# Copyright 2018 Comcast Cable Communications Management, LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Patterns of paths of clusters. A pattern is a "|" separated list of steps from the root
+clusters down, like a key, where a step is either the name of a cluster with the
+wildcards of fnmatch (*, ?, [...]) or ** for any number (including none) of levels, e.g.
+    **|cancel VB ROOT           the clusters named "cancel VB ROOT" at any depth
+    * VB ROOT|* NN dobj|**      the clusters below (and including) the direct objects of a root verb
+    **|* * dobj|* * det         the determiners of the direct objects anywhere
+
+The nodes named like the last step are looked up in the label index of the cluster
+index (see cluster_index.ClusterIndex.labeled) and the rest of the pattern is matched
+backwards along their parent pointers, all of them at once, one level at a time. The
+time is that of the candidate nodes times their depth, whatever the size of the tree.
+A pattern without ** whose last step names many nodes (e.g. "want VB ROOT|*") is rather
+matched forwards from the root clusters, through the subclusters of the matching nodes,
+as long as that looks at fewer nodes.
+'''
+import re
+import bisect
+import fnmatch
+import numpy as np
+from cluster_index import ROOT, flat_ranges
+
+ANY_LEVELS = '**'
+_WILDCARDS = re.compile(r'[*?[]')
+
+
+class PatternError(ValueError):
+    '''
+    Raised for a pattern that cannot be parsed
+    '''
+    pass
+
+
+def parse(pattern):
+    '''
+    Splits a pattern into its steps. Consecutive ** steps are merged into one.
+    '''
+    steps = []
+    for astep in pattern.split('|'):
+        if not astep:
+            raise PatternError('Empty step in the pattern: %s' % pattern)
+        if astep == ANY_LEVELS and steps and steps[-1] == ANY_LEVELS:
+            continue
+        steps.append(astep)
+    return steps
+
+
+def matching_labels(labels, step):
+    '''
+    The sorted positions of the labels (a sorted list or cluster_index.StringTable) matching
+    a step. Only the labels starting with the part of the step before its first wildcard
+    are looked at.
+    '''
+    prefix = _WILDCARDS.split(step, 1)[0]
+    start = bisect.bisect_left(labels, prefix)
+    if prefix == step:
+        if start < len(labels) and labels[start] == step:
+            return np.array([start], dtype=np.int64)
+        return np.zeros(0, dtype=np.int64)
+    step_re = re.compile(fnmatch.translate(step), re.UNICODE)
+    found = []
+    for i in xrange(start, len(labels)):
+        alabel = labels[i]
+        if not alabel.startswith(prefix):
+            break
+        if step_re.match(alabel):
+            found.append(i)
+    return np.array(found, dtype=np.int64)
+
+
+def match(index, pattern):
+    '''
+    Returns the sorted IDs of the nodes of a cluster_index.ClusterIndex matching a pattern.
+    Raises PatternError if the pattern cannot be parsed.
+    '''
+    steps = parse(pattern)
+    # A final ** adds all the subclusters of the nodes matching the rest
+    below = steps[-1] == ANY_LEVELS
+    if below:
+        steps = steps[:-1]
+    if not steps:
+        return np.arange(ROOT + 1, index.num_nodes, dtype=np.int32)
+    # Which labels every step matches (every label for **). The extra last row is the
+    # step -1, after the whole pattern has been matched.
+    label_match = np.zeros((len(steps) + 1, max(len(index.labels), 1)), dtype=bool)
+    is_any = np.zeros(len(steps) + 1, dtype=bool)
+    for j, astep in enumerate(steps):
+        if astep == ANY_LEVELS:
+            is_any[j] = True
+            label_match[j] = True
+        else:
+            label_match[j, matching_labels(index.labels, astep)] = True
+    last_labels = np.flatnonzero(label_match[-2])
+    nodes = None
+    if not is_any.any():
+        num_candidates = int((index.label_ptr[last_labels + 1] - index.label_ptr[last_labels]).sum())
+        nodes = _match_forward(index, label_match, num_candidates)
+    if nodes is None:
+        candidates = index.labeled(last_labels)
+        nodes = candidates[_match_ancestors(index, candidates, label_match, is_any)]
+    if below:
+        nodes = subtrees(index, nodes)
+    return nodes
+
+
+def _match_forward(index, label_match, limit):
+    # The nodes matching a pattern without **, found level by level from the root clusters.
+    # Returns None as soon as more than limit subclusters would have to be looked at.
+    level = np.array([ROOT], dtype=np.int64)
+    for j in range(len(label_match) - 1):
+        starts = index.child_ptr[level].astype(np.int64)
+        lengths = index.child_ptr[level + 1] - starts
+        limit -= lengths.sum()
+        if limit < 0:
+            return None
+        # The subclusters of the nodes of a level (sorted, as they are) are numbered in order
+        children = flat_ranges(starts, lengths)
+        level = children[label_match[j, index.node_label[children]]]
+    return level.astype(np.int32)
+
+
+def _match_ancestors(index, candidates, label_match, is_any):
+    # Whether the path above every candidate matches all the steps but the last one. A
+    # state (cand, j) is a candidate whose steps up to j are still to be matched by the
+    # path from the root to the current node, which is the same for all the states of a
+    # candidate and moves to its parent at every round.
+    num_steps = len(label_match) - 1
+    accepted = np.zeros(len(candidates), dtype=bool)
+    cand = np.arange(len(candidates))
+    node = index.node_parent[candidates].astype(np.int64)
+    j = np.full(len(candidates), num_steps - 2, dtype=np.int64)
+    while len(cand):
+        # A ** step may also match no level at all
+        skip = is_any[j]
+        cand = np.concatenate((cand, cand[skip]))
+        node = np.concatenate((node, node[skip]))
+        j = np.concatenate((j, j[skip] - 1))
+        done = j < 0
+        accepted[cand[done & (node == ROOT)]] = True
+        # The states at the root with steps left (or beyond the root) fail
+        live = ~done & (node != ROOT) & ~accepted[cand]
+        cand, node, j = cand[live], node[live], j[live]
+        # A name step consumes the node if it matches it, a ** step consumes it and stays
+        live = label_match[j, index.node_label[node]]
+        cand, node, j = cand[live], index.node_parent[node[live]].astype(np.int64), j[live]
+        j = np.where(is_any[j], j, j - 1)
+        # The states of a candidate now differ only in their steps
+        _, first = np.unique(cand * (num_steps + 1) + j + 1, return_index=True)
+        cand, node, j = cand[first], node[first], j[first]
+    return accepted
+
+
+def subtrees(index, nodes):
+    '''
+    The sorted IDs of the given nodes and of all their subclusters, found level by level
+    through the child pointers
+    '''
+    found = [np.asarray(nodes, dtype=np.int32)]
+    level = found[0]
+    while len(level):
+        starts = index.child_ptr[level].astype(np.int64)
+        level = flat_ranges(starts, index.child_ptr[level + 1] - starts).astype(np.int32)
+        found.append(level)
+    return np.unique(np.concatenate(found))
+
+
+def outermost(index, nodes):
+    '''
+    The nodes (of a sorted array of node IDs) none of whose ancestors is in the array.
+    The queries of the others are already in those of their ancestors.
+    '''
+    nodes = np.asarray(nodes, dtype=np.int64)
+    marked = np.zeros(index.num_nodes, dtype=bool)
+    marked[nodes] = True
+    keep = np.ones(len(nodes), dtype=bool)
+    pos = np.arange(len(nodes))
+    ancestor = index.node_parent[nodes].astype(np.int64)
+    while len(pos):
+        # Walk up from every node until the root or a marked ancestor
+        live = ancestor > ROOT
+        pos, ancestor = pos[live], ancestor[live]
+        inside = marked[ancestor]
+        keep[pos[inside]] = False
+        pos, ancestor = pos[~inside], index.node_parent[ancestor[~inside]].astype(np.int64)
+    return nodes[keep].astype(np.int32)
@@ -0,0 +1,250 @@
+# Copyright 2018 Comcast Cable Communications Management, LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Boolean algebra over the queries of the clusters. The queries of a cluster are a sorted
+array of unique query IDs. The intersection, the union and the difference of two clusters
+are found, without building any Python sets, with binary searches (numpy.searchsorted)
+if one of them is much smaller, and with a bitmap of the query IDs otherwise.
+
+An expression combines clusters with NOT, AND and OR (in this order of precedence) and
+parentheses, e.g.
+    (want VB ROOT|modem NN dobj AND NOT want VB ROOT|not RB neg) OR need VB ROOT|modem NN dobj
+A cluster is given either by its "|" separated key, which has to be quoted ("..." or '...')
+if it contains parentheses or the words AND, OR or NOT, or by its node ID as #<id>.
+'''
+import re
+import numpy as np
+
+# A quote only starts a quoted key if the key ends with a quote followed by a space, a
+# parenthesis or the end (so that a name such as 's POS possessive is still a word)
+_TOKENS = re.compile(r'''\s*(?:(\()|(\))|"([^"]*)"(?=[\s()]|$)|'([^']*)'(?=[\s()]|$)|([^\s()]+))''')
+_OPERATORS = ('AND', 'OR', 'NOT')
+# Below this ratio of the lengths of two arrays, the IDs of the shorter one are looked up
+# in the longer one by binary searches. Otherwise a bitmap of the IDs is used.
+_SEARCH_RATIO = 16
+
+
+class ExpressionError(ValueError):
+    '''
+    Raised for an expression that cannot be parsed
+    '''
+    pass
+
+
+def unique_sorted(qids):
+    '''
+    Removes the repeated IDs of a sorted array of query IDs
+    '''
+    qids = np.asarray(qids, dtype=np.int32)
+    if len(qids) < 2:
+        return qids
+    return qids[np.concatenate(([True], qids[1:] != qids[:-1]))]
+
+
+def contains(qids1, qids2):
+    '''
+    For every ID of qids1, whether it is in qids2 (both sorted)
+    '''
+    if not len(qids1) or not len(qids2):
+        return np.zeros(len(qids1), dtype=bool)
+    if len(qids1) * _SEARCH_RATIO < len(qids2):
+        # A few IDs are looked up in a long array by binary searches
+        pos = np.minimum(np.searchsorted(qids2, qids1), len(qids2) - 1)
+        return qids2[pos] == qids1
+    # Otherwise through the bitmap of qids2
+    bitmap = _bitmap(qids2, max(qids1[-1], qids2[-1]) + 1)
+    return bitmap.take(qids1)
+
+
+def intersect(qids1, qids2):
+    '''
+    The IDs in both sorted arrays of unique IDs
+    '''
+    if len(qids1) > len(qids2):
+        qids1, qids2 = qids2, qids1
+    return qids1[contains(qids1, qids2)]
+
+
+def difference(qids1, qids2):
+    '''
+    The IDs of qids1 which are not in qids2 (both sorted and unique)
+    '''
+    if len(qids1) and len(qids2) * _SEARCH_RATIO < len(qids1):
+        # The few IDs of qids2 are looked up in qids1 and left out
+        pos = np.minimum(np.searchsorted(qids1, qids2), len(qids1) - 1)
+        keep = np.ones(len(qids1), dtype=bool)
+        keep[pos[qids1[pos] == qids2]] = False
+        return qids1[keep]
+    return qids1[~contains(qids1, qids2)]
+
+
+def union(qids1, qids2):
+    '''
+    The IDs in any of the two sorted arrays of unique IDs
+    '''
+    if len(qids1) < len(qids2):
+        qids1, qids2 = qids2, qids1
+    if not len(qids2):
+        return qids1
+    if len(qids2) * _SEARCH_RATIO < len(qids1):
+        # The few new IDs are inserted at their places in the long array
+        new = difference(qids2, qids1)
+        pos = np.searchsorted(qids1, new) + np.arange(len(new))
+        merged = np.empty(len(qids1) + len(new), dtype=np.int32)
+        is_new = np.zeros(len(merged), dtype=bool)
+        is_new[pos] = True
+        merged[pos] = new
+        merged[~is_new] = qids1
+        return merged
+    bitmap = _bitmap(qids1, max(qids1[-1], qids2[-1]) + 1)
+    bitmap[qids2] = True
+    return np.flatnonzero(bitmap).astype(np.int32)
+
+
+def _bitmap(qids, size):
+    # A boolean array of the given size which is True at the IDs
+    bitmap = np.zeros(size, dtype=bool)
+    bitmap[qids] = True
+    return bitmap
+
+
+def complement(qids, num_queries):
+    '''
+    The IDs of all the queries (0 to num_queries - 1) which are not in qids
+    '''
+    keep = np.ones(num_queries, dtype=bool)
+    keep[qids] = False
+    return np.flatnonzero(keep).astype(np.int32)
+
+
+def order_by_freq(qids, freqs, end):
+    '''
+    Returns the first end IDs of qids in descending order of their frequencies (ties broken
+    by ID), without sorting all of them
+    '''
+    qfreq = freqs[qids]
+    if end < len(qids):
+        # Only the IDs at least as frequent as the end-th one can be on the page
+        threshold = -np.partition(-qfreq, end - 1)[end - 1] if end > 0 else np.inf
+        candidates = qfreq >= threshold
+        qids, qfreq = qids[candidates], qfreq[candidates]
+    return qids[np.lexsort((qids, -qfreq))][:end]
+
+
+def tokenize(expr):
+    '''
+    Splits an expression into its parentheses, operators, node IDs and keys. The
+    consecutive words of an unquoted key are joined by single spaces.
+    '''
+    tokens = []
+    pos = 0
+    expr = expr.strip()
+    while pos < len(expr):
+        match = _TOKENS.match(expr, pos)
+        if not match or match.end() == pos:
+            raise ExpressionError('Unexpected character at %d: %s' % (pos, expr[pos:]))
+        pos = match.end()
+        lparen, rparen, dquoted, squoted, word = match.groups()
+        if lparen:
+            tokens.append(('(', None))
+        elif rparen:
+            tokens.append((')', None))
+        elif dquoted is not None or squoted is not None:
+            tokens.append(('key', dquoted if dquoted is not None else squoted))
+        elif word in _OPERATORS:
+            tokens.append((word, None))
+        elif re.match(r'#\d+$', word):
+            tokens.append(('node', int(word[1:])))
+        elif tokens and tokens[-1][0] == 'word':
+            tokens[-1] = ('word', tokens[-1][1] + ' ' + word)
+        else:
+            tokens.append(('word', word))
+    return [('key', value) if kind == 'word' else (kind, value) for kind, value in tokens]
+
+
+def parse(expr):
+    '''
+    Parses an expression into a tree of tuples: ('key', key), ('node', node ID),
+    ('not', operand), ('and', left, right) and ('or', left, right)
+    '''
+    tokens = tokenize(expr)
+    if not tokens:
+        raise ExpressionError('Empty expression')
+    tree, pos = _parse_or(tokens, 0)
+    if pos < len(tokens):
+        raise ExpressionError('Unexpected %s' % _describe(tokens[pos]))
+    return tree
+
+
+def _parse_or(tokens, pos):
+    left, pos = _parse_and(tokens, pos)
+    while pos < len(tokens) and tokens[pos][0] == 'OR':
+        right, pos = _parse_and(tokens, pos + 1)
+        left = ('or', left, right)
+    return left, pos
+
+
+def _parse_and(tokens, pos):
+    left, pos = _parse_not(tokens, pos)
+    while pos < len(tokens) and tokens[pos][0] == 'AND':
+        right, pos = _parse_not(tokens, pos + 1)
+        left = ('and', left, right)
+    return left, pos
+
+
+def _parse_not(tokens, pos):
+    if pos < len(tokens) and tokens[pos][0] == 'NOT':
+        operand, pos = _parse_not(tokens, pos + 1)
+        return ('not', operand), pos
+    return _parse_operand(tokens, pos)
+
+
+def _parse_operand(tokens, pos):
+    if pos == len(tokens):
+        raise ExpressionError('Unexpected end of the expression')
+    kind, value = tokens[pos]
+    if kind == '(':
+        tree, pos = _parse_or(tokens, pos + 1)
+        if pos == len(tokens) or tokens[pos][0] != ')':
+            raise ExpressionError('Missing )')
+        return tree, pos + 1
+    if kind in ('key', 'node'):
+        return (kind, value), pos + 1
+    raise ExpressionError('Unexpected %s' % _describe(tokens[pos]))
+
+
+def _describe(token):
+    return token[0] if token[1] is None else '%s %s' % token
+
+
+def evaluate(tree, lookup, num_queries):
+    '''
+    Evaluates a parsed expression into the sorted array of the IDs of its queries.
+    :param lookup: A function returning the sorted unique query IDs of a ('key', key) or
+                   ('node', node ID) operand
+    :param num_queries: The number of queries (NOT x is every query not in x)
+    '''
+    operator = tree[0]
+    if operator in ('key', 'node'):
+        return lookup(tree)
+    if operator == 'not':
+        return complement(evaluate(tree[1], lookup, num_queries), num_queries)
+    if operator == 'and':
+        # x AND NOT y is the difference of x and y, which needs no complement
+        left, right = tree[1], tree[2]
+        if left[0] == 'not' and right[0] != 'not':
+            left, right = right, left
+        if right[0] == 'not':
+            return difference(evaluate(left, lookup, num_queries), evaluate(right[1], lookup, num_queries))
+        return intersect(evaluate(left, lookup, num_queries), evaluate(right, lookup, num_queries))
+    return union(evaluate(tree[1], lookup, num_queries), evaluate(tree[2], lookup, num_queries))
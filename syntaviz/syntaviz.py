@@ -14,16 +14,23 @@ import pdb
 
 from flask import Flask, abort, render_template, url_for, request
 import cluster_query
+import cluster_index
+import query_algebra
+import path_pattern
+from lru_cache import LRUCache
 import pickle as cp
 import numpy as np
 import urllib
 import json
 import sys
+import os
+import signal
+import socket
+import argparse
+import threading
+from werkzeug.serving import make_server
 import base64
 from io import BytesIO
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 
 '''
 This is a quick working prototype of a visualizer that would
@@ -41,29 +48,111 @@ Note: This server needs the following files:
 3.  '../data/qaction.pickle': It contains a dictionary named qaction
     which returns the actions taken (values) for the queries (keys).
 
+Alternatively, all three can be replaced by a single index snapshot
+created by "python -m syntaviz.cluster_query build-index", which
+loads almost instantly.
 '''
 
-inpfile = sys.argv[1]
-outfile = sys.argv[2]
-query2actionfile = sys.argv[3]
-PORT=5678
-if len(sys.argv) > 4:
-    PORT = int(sys.argv[4])
+parser = argparse.ArgumentParser(description='The SyntaViz server')
+parser.add_argument('files', nargs='+',
+                    help='Either the query file, the parsed query file and the actions pickle, '
+                         'or a single index snapshot. For compatibility, the port may follow.')
+parser.add_argument('--port', type=int, default=5678)
+parser.add_argument('--host', default='0.0.0.0')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of pre-forked worker processes sharing the read-only index')
+parser.add_argument('--threaded', action='store_true',
+                    help='Handle the requests of every worker in separate threads')
+parser.add_argument('--plots', choices=['client', 'server'], default='client',
+                    help='Draw the histograms of the actions in the browser (client) or '
+                         'render them with matplotlib on the server (server)')
+parser.add_argument('--cache-entries', type=int, default=256,
+                    help='Maximum number of rendered pages (and, separately, plots) kept in memory')
+parser.add_argument('--cache-mb', type=float, default=256,
+                    help='Maximum size (in MB) of the rendered pages (and, separately, plots) kept in memory')
+parser.add_argument('--resident-levels', type=int,
+                    help='With an index snapshot, keep only the query IDs of this many top levels of the '
+                         'clusters in memory and read those of the deeper clusters from the snapshot when '
+                         'they are shown')
+parser.add_argument('--subtree-cache-mb', type=float, default=256,
+                    help='Maximum size (in MB) of the query IDs of the deeper clusters kept in memory '
+                         '(with --resident-levels)')
+cluster_query.add_prune_arguments(parser)
+args = parser.parse_args()
+prune = args.max_level < np.inf or args.min_count > 1 or args.min_total > 0
+files = args.files
+PORT = args.port
+if len(files) in (2, 4) and files[-1].isdigit():
+    PORT = int(files.pop())
+if len(files) not in (1, 3):
+    parser.error('Expected either three data files or a single index snapshot')
+if args.resident_levels is not None and (len(files) != 1 or prune):
+    parser.error('--resident-levels needs an (unpruned) index snapshot')
+
+if args.plots == 'server':
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
 
 ################## Load the pre-requisites ####################
-print("Loading cluster data ...")
-clust_head, queries, freq_list = cluster_query.cluster_counts_and_queries(
-    original_query_file=inpfile,
-    parsed_query_file=outfile,
-    get_freq=True)
+if len(files) == 1:
+    print("Loading index snapshot ...")
+    subtree_cache = LRUCache(2 ** 20, int(args.subtree_cache_mb * 1024 * 1024))
+    clust_head = cluster_index.load_snapshot(files[0], args.resident_levels, subtree_cache)
+    if prune:
+        print("Pruning the clusters ...")
+        clust_head = clust_head.prune(args.max_level, args.min_count, args.min_total)
+    queries = clust_head.queries
+    freq_list = clust_head.freqs
+    qid_action = clust_head.qid_action
+    actions = clust_head.actions
+    print("Done loading index snapshot.")
+else:
+    inpfile, outfile, query2actionfile = files
+    print("Loading cluster data ...")
+    # The clusters are kept in the compact array-backed index
+    clust_head, queries, freq_list = cluster_query.cluster_index_and_queries(
+        original_query_file=inpfile,
+        parsed_query_file=outfile,
+        maxlevel=args.max_level,
+        min_count=args.min_count,
+        min_total=args.min_total)
+    print("Done clustering.")
+
+    print("Loading list of actions performed for each query ...")
+    qaction = cp.load(open(query2actionfile))
+    # Look up the action of every query only once
+    qid_action, actions = cluster_index.resolve_actions(queries, qaction)
+    del qaction
+    print("Done loading actions.")
+    clust_head.token_index = cluster_query.build_token_index(queries)
+    # Keep all the large data in numpy arrays rather than in Python objects, so that
+    # forked workers share the pages instead of copying them when refcounts change
+    queries = cluster_index.StringTable.from_strings(queries)
+    freq_list = clust_head.freqs
+if clust_head.token_index is None:
+    # A snapshot saved without the index of the words of the queries
+    clust_head.token_index = cluster_query.build_token_index(queries)
 clust = clust_head
-tot_uniq = sum([clust[akey][0] for akey in clust])
-tot_nonuniq = sum([freq_list[aqid] for akey in clust for aqid in clust[akey][2]])
-print("Done clustering.")
+root_clusters = clust.children(cluster_index.ROOT)
+tot_uniq = int(clust.count(root_clusters).sum())
+tot_nonuniq = int(clust.total(root_clusters).sum())
 
-print("Loading list of actions performed for each query ...")
-qaction = cp.load(open(query2actionfile))
-print("Done loading actions.")
+# The data does not change while the server runs, so the rendered plots and
+# pages are cached
+page_cache = LRUCache(args.cache_entries, int(args.cache_mb * 1024 * 1024))
+plot_cache = LRUCache(args.cache_entries, int(args.cache_mb * 1024 * 1024))
+# pyplot keeps a global state, so only one thread may plot at a time
+plot_lock = threading.Lock()
+
+
+def get_query_action(qid):
+    '''
+    Returns the action taken for a query
+    '''
+    if qid_action is None or qid_action[qid] < 0:
+        return '[Not Found]'
+    return actions[qid_action[qid]]
 
 ###############################################################
 
@@ -109,21 +198,18 @@ def get_queries_json(key='', st_idx=0, en_idx=50):
     return json.dumps(allqueries)
 
 
-def get_action_hist(key, qaction):
+def get_action_hist(node_id, weighted=False):
     '''
     Returns the frequency of various actions taken (in response to
-    the queries of a key) as well as the list of actions
+    the queries of a cluster) as well as the list of actions.
+    If weighted is True, every query is counted as many times as it was asked.
     '''
-    action_hist = {}
-    clust = clust_head
-    for i, qid, aquery in cluster_query.get_queries(clust, key, queries, en_idx=float('inf')):
-        aquery = aquery.lower()
-        if aquery in qaction:
-            if qaction[aquery] in action_hist:
-                action_hist[qaction[aquery]] += 1
-            else:
-                action_hist[qaction[aquery]] = 1
-    return action_hist
+    if qid_action is None:
+        return {}
+    counts = cluster_query.get_action_counts(cluster_index.IndexNode(clust_head, node_id), '',
+                                             qid_action, len(actions),
+                                             freq_list=freq_list if weighted else None)
+    return {actions[anaction]: int(counts[anaction]) for anaction in np.flatnonzero(counts)}
 
 
 def get_plot(adict):
@@ -140,7 +226,7 @@ def get_plot(adict):
     total = sum(count)
     # Plot
     if m > 30:
-        plt.figure(num=1, figsize=(12, 8), fontsize=24)
+        plt.figure(num=1, figsize=(12, 8))
         plt.clf()
         plt.bar(np.arange(30), count[:30])
         plt.xticks(np.arange(30) + 0.4, labels[:30], rotation='vertical', fontsize=24)
@@ -154,7 +240,7 @@ def get_plot(adict):
             pass
             # pdb.set_trace()
     else:
-        plt.figure(num=1, figsize=(12, 8), fontsize=24)
+        plt.figure(num=1, figsize=(12, 8))
         plt.clf()
         plt.bar(np.arange(m), count)
         plt.xticks(np.arange(m) + 0.4, labels, rotation='vertical', fontsize=24)
@@ -179,10 +265,27 @@ def get_plot(adict):
 @app.route('/both')
 def both():
     '''
-    Show the page
+    Show the page of a cluster given by its (nested) key. The links on the
+    page address the clusters by their node IDs instead (see node).
     '''
-    # Parsing arguments
     key_k = urllib.unquote(urllib.unquote(request.args.get('key_k', '')))
+    try:
+        node_id = clust_head.find(key_k)
+    except KeyError:
+        print('Key Not Found:', key_k)
+        return abort(404)
+    return node(node_id)
+
+
+@app.route('/node/<int:node_id>')
+def node(node_id):
+    '''
+    Show the page of the cluster with the given node ID
+    '''
+    if not 0 <= node_id < clust_head.num_nodes:
+        print('Node Not Found:', node_id)
+        return abort(404)
+    # Parsing arguments
     st_idx_k = int(request.args.get('st_idx_k', 0))
     en_idx_k = int(request.args.get('en_idx_k', 500))
     st_idx_q = int(request.args.get('st_idx_q', 0))
@@ -190,44 +293,51 @@ def both():
     sort_key_by = int(request.args.get('sort_key_by', 0))  # sort by unique count(0), total count(1)
     sort_query_by = int(request.args.get('sort_query_by', 0))  # sort by query frequency(0), or qid(1)
 
-    try:
-        # Build the list of keys
-        clust = clust_head
-        allkeys = []
-        for i, akey, count, nucount in cluster_query.get_keys( \
-                clust,
-                key_k,
-                st_idx_k,
-                en_idx_k,
-                freq_list=freq_list,
-                sortby=sort_key_by):
-            if key_k:
-                fullkey = key_k + '|' + akey
-            else:
-                fullkey = akey
-            encodedkey = urllib.quote(fullkey)
-            # Link to go to a specific cluster
-            keylink = url_for('both',
-                              key_k=encodedkey,
-                              st_idx_k=st_idx_k,
-                              en_idx_k=en_idx_k,
-                              st_idx_q=st_idx_q,
-                              en_idx_q=en_idx_q,
-                              sort_key_by=sort_key_by,
-                              sort_query_by=sort_query_by)
-            allkeys.append((i, count, akey, keylink, nucount,
-                            '{0:0.2f}'.format(float(count) / float(tot_uniq) * 100.),
-                            '{0:0.2f}'.format(float(nucount) / float(tot_nonuniq) * 100.)))
-    except KeyError:
-        print('Key Not Found:', key_k)
-        return abort(404)
+    # A page depends only on these arguments
+    page_args = (node_id, st_idx_k, en_idx_k, st_idx_q, en_idx_q, sort_key_by, sort_query_by)
+    page = page_cache.get(page_args)
+    if page is None:
+        page = render_cluster_page(*page_args)
+        page_cache.put(page_args, page)
+    return page
+
+
+def render_cluster_page(node_id, st_idx_k, en_idx_k, st_idx_q, en_idx_q, sort_key_by, sort_query_by):
+    '''
+    Renders the page showing the subclusters and the queries of a cluster
+    '''
+    # The view of the node works like the subclusters of the nested clusters, so
+    # the functions of cluster_query are called with an empty key
+    clust = cluster_index.IndexNode(clust_head, node_id)
+
+    # Build the list of keys
+    allkeys = []
+    for i, akey, count, nucount in cluster_query.get_keys( \
+            clust,
+            '',
+            st_idx_k,
+            en_idx_k,
+            freq_list=freq_list,
+            sortby=sort_key_by):
+        # Link to go to a specific cluster
+        keylink = url_for('node',
+                          node_id=clust_head.child(node_id, akey),
+                          st_idx_k=st_idx_k,
+                          en_idx_k=en_idx_k,
+                          st_idx_q=st_idx_q,
+                          en_idx_q=en_idx_q,
+                          sort_key_by=sort_key_by,
+                          sort_query_by=sort_query_by)
+        allkeys.append((i, count, akey, keylink, nucount,
+                        '{0:0.2f}'.format(float(count) / float(tot_uniq) * 100.),
+                        '{0:0.2f}'.format(float(nucount) / float(tot_nonuniq) * 100.)))
 
     # Build the left pane navigations
     navformat = '<a href="{0}">{1}</a>'
     diff = en_idx_k - st_idx_k
     if st_idx_k > 0:
-        left_prev_code = navformat.format(url_for('both',
-                                                  key_k=key_k,
+        left_prev_code = navformat.format(url_for('node',
+                                                  node_id=node_id,
                                                   st_idx_k=max(0, st_idx_k - diff),
                                                   en_idx_k=st_idx_k,
                                                   st_idx_q=st_idx_q,
@@ -236,8 +346,8 @@ def both():
                                                   sort_query_by=sort_query_by), '&#60&#60')
     else:
         left_prev_code = '<<'
-    left_next_code = navformat.format(url_for('both',
-                                              key_k=key_k,
+    left_next_code = navformat.format(url_for('node',
+                                              node_id=node_id,
                                               st_idx_k=en_idx_k,
                                               en_idx_k=en_idx_k + diff,
                                               st_idx_q=st_idx_q,
@@ -245,39 +355,35 @@ def both():
                                               sort_key_by=sort_key_by,
                                               sort_query_by=sort_query_by), '&#62&#62')
 
-    # Build the breadcrumb
-    if not key_k:
+    # Build the breadcrumb by following the parent pointers
+    path = clust_head.path(node_id)
+    if not path:
         currentkey = '&#60 None &#62'
+    elif len(path) == 1:
+        currentkey = clust_head.label(node_id)
     else:
-        if '|' in key_k:
-            currentkey = ''
-            spltkey = key_k.split('|')
-            for i in range(len(spltkey)):
-                encodedkey = urllib.quote('|'.join(spltkey[:i + 1]))
-                currentkey += '<a href="{1}">{0}|</a>'.format(spltkey[i], url_for('both',
-                                                                                  key_k=encodedkey,
-                                                                                  st_idx_k=0,
-                                                                                  en_idx_k=en_idx_k - st_idx_k,
-                                                                                  st_idx_q=0,
-                                                                                  en_idx_q=en_idx_q - st_idx_q,
-                                                                                  sort_key_by=sort_key_by,
-                                                                                  sort_query_by=sort_query_by))
-            if currentkey[-1] == '|':
-                currentkey = currentkey[:-1]
-        else:
-            currentkey = key_k
+        currentkey = '|'.join('<a href="{1}">{0}</a>'.format(clust_head.label(anode),
+                                                            url_for('node',
+                                                                    node_id=anode,
+                                                                    st_idx_k=0,
+                                                                    en_idx_k=en_idx_k - st_idx_k,
+                                                                    st_idx_q=0,
+                                                                    en_idx_q=en_idx_q - st_idx_q,
+                                                                    sort_key_by=sort_key_by,
+                                                                    sort_query_by=sort_query_by))
+                              for anode in path)
 
     # Build the links for sorting the keys
-    unique_link = url_for('both',
-                          key_k=key_k,
+    unique_link = url_for('node',
+                          node_id=node_id,
                           st_idx_k=st_idx_k,
                           en_idx_k=en_idx_k,
                           st_idx_q=st_idx_q,
                           en_idx_q=en_idx_q,
                           sort_key_by=0,
                           sort_query_by=sort_query_by)
-    total_link = url_for('both',
-                         key_k=key_k,
+    total_link = url_for('node',
+                         node_id=node_id,
                          st_idx_k=st_idx_k,
                          en_idx_k=en_idx_k,
                          st_idx_q=st_idx_q,
@@ -286,7 +392,7 @@ def both():
                          sort_query_by=sort_query_by)
 
     # If no key is selected, just send out the root keys
-    if not key_k:
+    if node_id == cluster_index.ROOT:
         return render_template('fullpage.html',
                                total_count=tot_nonuniq,
                                uniq_count=tot_uniq,
@@ -297,43 +403,33 @@ def both():
                                header_unique_link=unique_link,
                                header_total_link=total_link)
 
-    try:
-        # Build the list of queries
-        allqueries = []
-        clust = clust_head
-        if sort_query_by == 0:
-            # sort by query frequency
-            frequency_list = freq_list
-        else:
-            # sort by qid
-            frequency_list = None
-        # Accumulate the queries
-        for i, qid, aquery in cluster_query.get_queries(clust,
-                                                        key_k,
-                                                        queries,
-                                                        st_idx_q,
-                                                        en_idx_q,
-                                                        freq_list=frequency_list):
-            if aquery.lower() in qaction:
-                query_action = qaction[aquery.lower()]
-            else:
-                query_action = '[Not Found]'
-            allqueries.append((i,
-                               qid,
-                               aquery,
-                               query_action,
-                               freq_list[qid],
-                               '{0:0.3f}'.format(float(freq_list[qid]) / tot_nonuniq * 100.)))
-
-    except KeyError:
-        print('Key Not Found:', key_k)
-        return abort(404)
+    # Build the list of queries
+    allqueries = []
+    if sort_query_by == 0:
+        # sort by query frequency
+        frequency_list = freq_list
+    else:
+        # sort by qid
+        frequency_list = None
+    # Accumulate the queries
+    for i, qid, aquery in cluster_query.get_queries(clust,
+                                                    '',
+                                                    queries,
+                                                    st_idx_q,
+                                                    en_idx_q,
+                                                    freq_list=frequency_list):
+        allqueries.append((i,
+                           qid,
+                           aquery,
+                           get_query_action(qid),
+                           freq_list[qid],
+                           '{0:0.3f}'.format(float(freq_list[qid]) / tot_nonuniq * 100.)))
 
     # Build the right pane navigations
     diff = en_idx_q - st_idx_q
     if st_idx_q > 0:
-        right_prev_code = navformat.format(url_for('both',
-                                                   key_k=key_k,
+        right_prev_code = navformat.format(url_for('node',
+                                                   node_id=node_id,
                                                    st_idx_k=st_idx_k,
                                                    en_idx_k=en_idx_k,
                                                    st_idx_q=max(0, st_idx_q - diff),
@@ -342,8 +438,8 @@ def both():
                                                    sort_query_by=sort_query_by), '&#60&#60')
     else:
         right_prev_code = '&#60&#60'
-    right_next_code = navformat.format(url_for('both',
-                                               key_k=key_k,
+    right_next_code = navformat.format(url_for('node',
+                                               node_id=node_id,
                                                st_idx_k=st_idx_k,
                                                en_idx_k=en_idx_k,
                                                st_idx_q=en_idx_q,
@@ -353,8 +449,8 @@ def both():
 
     # Build the links for sorting the queries
     # By frequency
-    header_freq_link = url_for('both',
-                               key_k=key_k,
+    header_freq_link = url_for('node',
+                               node_id=node_id,
                                st_idx_k=st_idx_k,
                                en_idx_k=en_idx_k,
                                st_idx_q=st_idx_q,
@@ -362,8 +458,8 @@ def both():
                                sort_key_by=sort_key_by,
                                sort_query_by=0)
     # By QID
-    header_qid_link = url_for('both',
-                              key_k=key_k,
+    header_qid_link = url_for('node',
+                              node_id=node_id,
                               st_idx_k=st_idx_k,
                               en_idx_k=en_idx_k,
                               st_idx_q=st_idx_q,
@@ -372,11 +468,34 @@ def both():
                               sort_query_by=1)
 
     # Calculate the cluster statistics
-    clust_stats = cluster_query.get_statistics(clust, key_k, freq_list)
+    clust_stats = cluster_query.get_statistics(clust, '', freq_list)
 
     # Build the visualization on the right pane
-    action_freq = get_action_hist(key_k, qaction)
-    image_src = get_plot(action_freq)
+    if args.plots == 'client':
+        # The browser draws the plot from the data of /api/node/<node_id>/actions
+        return render_template('fullpage.html',
+                               total_count=tot_nonuniq,
+                               uniq_count=tot_uniq,
+                               left_prev_code=left_prev_code,
+                               left_next_code=left_next_code,
+                               allkeys=allkeys,
+                               currentkey=currentkey,
+                               header_unique_link=unique_link,
+                               header_total_link=total_link,
+                               right_prev_code=right_prev_code,
+                               right_next_code=right_next_code,
+                               allqueries=allqueries,
+                               clust_stats=clust_stats,
+                               plot_url=url_for('api_node_actions', node_id=node_id),
+                               header_freq_link=header_freq_link,
+                               header_qid_link=header_qid_link)
+    action_freq = get_action_hist(node_id)
+    if action_freq:
+        image_src = plot_cache.get(node_id)
+        if image_src is None:
+            with plot_lock:
+                image_src = get_plot(action_freq)
+            plot_cache.put(node_id, image_src)
 
     # Send all the data with visualization if there are queries
     if len(action_freq.keys()) > 0:
@@ -416,7 +535,227 @@ def both():
                                header_qid_link=header_qid_link)
 
 
+@app.route('/api/actions/<path:key>')
+def api_actions(key):
+    '''
+    Returns the histogram of the actions of a cluster as json (see api_node_actions)
+    '''
+    try:
+        node_id = clust_head.find(key)
+    except KeyError:
+        print('Key Not Found:', key)
+        return abort(404)
+    return api_node_actions(node_id)
+
+
+@app.route('/api/node/<int:node_id>/actions')
+def api_node_actions(node_id):
+    '''
+    Returns the histogram of the actions of a cluster as json, sorted by descending
+    count. With ?weighted=1, the queries are weighted by their frequencies.
+    '''
+    if not 0 < node_id < clust_head.num_nodes:
+        print('Node Not Found:', node_id)
+        return abort(404)
+    weighted = request.args.get('weighted', '0') == '1'
+    action_freq = get_action_hist(node_id, weighted=weighted)
+    counts = sorted(action_freq.items(), key=lambda x: -1 * x[1])
+    return json.dumps({'node': node_id,
+                       'key': clust_head.key(node_id),
+                       'weighted': weighted,
+                       'total': sum(action_freq.values()),
+                       'actions': counts})
+
+
+@app.route('/api/stats/<path:key>')
+def api_stats(key):
+    '''
+    Returns the statistics of a cluster as json (see api_node_stats)
+    '''
+    try:
+        node_id = clust_head.find(key)
+    except KeyError:
+        print('Key Not Found:', key)
+        return abort(404)
+    return api_node_stats(node_id)
+
+
+@app.route('/api/node/<int:node_id>/stats')
+def api_node_stats(node_id):
+    '''
+    Returns the statistics of a cluster (see cluster_query.get_statistics) as json
+    '''
+    if not 0 < node_id < clust_head.num_nodes:
+        print('Node Not Found:', node_id)
+        return abort(404)
+    clust = cluster_index.IndexNode(clust_head, node_id)
+    unq_cnt, tot_cnt, unq_nondep, tot_nondep, _ = cluster_query.get_statistics(clust, '', freq_list)
+    return json.dumps({'node': node_id,
+                       'key': clust_head.key(node_id),
+                       'parent': int(clust_head.node_parent[node_id]),
+                       'unique': unq_cnt,
+                       'total': tot_cnt,
+                       'unique_nondependent': unq_nondep,
+                       'total_nondependent': tot_nondep})
+
+
+@app.route('/api/algebra')
+def api_algebra():
+    '''
+    Returns the queries matching a boolean expression over the clusters (see query_algebra)
+    as json: their number, their total count and a page of them. The expression is given
+    by ?expr=, e.g. "(key1 AND NOT key2) OR key3" (a cluster may also be given as #<node id>).
+    The page is ?start= to ?end= (0 to 50 by default) in descending order of frequency or,
+    with ?sort=id, in the order of the query IDs.
+    '''
+    expr = request.args.get('expr', '')
+    try:
+        st_idx = max(int(request.args.get('start', 0)), 0)
+        en_idx = max(int(request.args.get('end', 50)), st_idx)
+    except ValueError:
+        return abort(400)
+    try:
+        qids = cluster_query.query_expression(clust_head, expr, len(freq_list))
+    except query_algebra.ExpressionError as e:
+        print('Bad Expression:', expr, e)
+        return abort(400)
+    except KeyError as e:
+        print('Key Not Found:', e)
+        return abort(404)
+    if request.args.get('sort', 'freq') == 'id':
+        page = qids[st_idx:en_idx]
+    else:
+        page = query_algebra.order_by_freq(qids, freq_list, en_idx)[st_idx:]
+    return json.dumps({'expr': expr,
+                       'unique': len(qids),
+                       'total': int(freq_list[qids].sum()),
+                       'start': st_idx,
+                       'end': st_idx + len(page),
+                       'queries': [(int(qid), queries[qid], int(freq_list[qid]), get_query_action(qid))
+                                   for qid in page]})
+
+
+@app.route('/api/search')
+def api_search():
+    '''
+    Returns the queries of a cluster (?key=, all the queries if it is not given) containing
+    all the words of ?q= as json: their number, their total count and a page of them
+    (?start= to ?end=, 0 to 50 by default) in descending order of frequency.
+    '''
+    key = request.args.get('key', '')
+    text = request.args.get('q', '')
+    try:
+        st_idx = max(int(request.args.get('start', 0)), 0)
+        en_idx = max(int(request.args.get('end', 50)), st_idx)
+    except ValueError:
+        return abort(400)
+    try:
+        qids = cluster_query.search_queries(clust_head, key, clust_head.token_index, text)
+    except KeyError:
+        print('Key Not Found:', key)
+        return abort(404)
+    page = query_algebra.order_by_freq(qids, freq_list, en_idx)[st_idx:]
+    return json.dumps({'key': key,
+                       'q': text,
+                       'unique': len(qids),
+                       'total': int(freq_list[qids].sum()),
+                       'start': st_idx,
+                       'end': st_idx + len(page),
+                       'queries': [(int(qid), queries[qid], int(freq_list[qid]), get_query_action(qid))
+                                   for qid in page]})
+
+
+@app.route('/api/pattern')
+def api_pattern():
+    '''
+    Returns the clusters matching a path pattern (?p=, see path_pattern), e.g. "**|cancel VB ROOT",
+    as json: their number, the number and the total count of the unique queries of all of
+    them, and a page of them (?start= to ?end=, 0 to 50 by default) with their IDs, keys,
+    unique and total counts, in descending order of their unique counts.
+    '''
+    pattern = request.args.get('p', '')
+    try:
+        st_idx = max(int(request.args.get('start', 0)), 0)
+        en_idx = max(int(request.args.get('end', 50)), st_idx)
+    except ValueError:
+        return abort(400)
+    try:
+        nodes = cluster_query.match_pattern(clust_head, pattern)
+    except path_pattern.PatternError as e:
+        print('Bad Pattern:', pattern, e)
+        return abort(400)
+    qids = cluster_query.pattern_query_ids(clust_head, nodes)
+    counts = clust_head.count(nodes)
+    page = nodes[np.lexsort((nodes, -counts))][st_idx:en_idx]
+    return json.dumps({'pattern': pattern,
+                       'nodes': len(nodes),
+                       'unique': len(qids),
+                       'total': int(freq_list[qids].sum()),
+                       'start': st_idx,
+                       'end': st_idx + len(page),
+                       'clusters': [(int(anode), clust_head.key(anode), int(clust_head.count(anode)),
+                                     int(clust_head.total(anode))) for anode in page]})
+
+
+@app.route('/cache/stats')
+def cache_stats():
+    '''
+    Returns the hit and miss counts of the page and plot caches (and of the cache of the
+    deeper clusters of a lazily loaded index)
+    '''
+    stats = {'pages': page_cache.stats(), 'plots': plot_cache.stats()}
+    if isinstance(clust, cluster_index.LazyClusterIndex):
+        stats['subtrees'] = clust.cache.stats()
+    return json.dumps(stats)
+
+
+def serve(host, port, workers=1, threaded=False):
+    '''
+    Runs the server. With more than one worker, the listening socket is opened once
+    and shared by that many pre-forked worker processes. The index is read-only and
+    kept in numpy arrays (memory mapped if it was loaded from a snapshot), so the
+    workers share its pages instead of multiplying the memory. A worker that dies
+    is replaced. Note that every worker has its own page and plot caches.
+    '''
+    if workers <= 1:
+        app.run(host=host, port=port, threaded=threaded)
+        return
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            make_server(host, port, app, threaded=threaded, fd=sock.fileno()).serve_forever()
+            os._exit(0)
+        return pid
+
+    children = set(start_worker() for i in range(workers))
+    print('Serving on http://%s:%d with %d workers' % (host, port, workers))
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while True:
+        pid, status = os.wait()
+        if pid in children:
+            print('Worker %d exited with status %d, restarting it' % (pid, status))
+            children.remove(pid)
+            children.add(start_worker())
+
+
 # Run the server
 if __name__ == '__main__':
     app.debug = False
-    app.run(host='0.0.0.0', port=PORT)
+    serve(args.host, PORT, args.workers, args.threaded)
@@ -0,0 +1,98 @@
+# Copyright 2018 Comcast Cable Communications Management, LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+An inverted index of the words of the queries, for searching the queries by their text.
+The words are the lower case runs of letters and digits of the queries. For every word
+(in the sorted list of the words), the sorted IDs of the queries containing it are
+    token_qids[token_ptr[t]:token_ptr[t + 1]]
+The index is saved in the index snapshot next to the clusters (see cluster_index).
+'''
+import re
+import bisect
+from array import array
+import numpy as np
+import query_algebra
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    '''
+    Returns the lower case words of a text (a unicode or a utf-8 string)
+    '''
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return _WORD.findall(text.lower())
+
+
+class TokenIndex(object):
+    '''
+    The inverted index of the words of the queries
+    '''
+
+    def __init__(self, tokens, token_ptr, token_qids):
+        '''
+        :param tokens: The sorted list (or cluster_index.StringTable) of the words
+        :param token_ptr: The start of the query IDs of every word in token_qids
+        :param token_qids: The query IDs of all the words
+        '''
+        self.tokens = tokens
+        self.token_ptr = token_ptr
+        self.token_qids = token_qids
+
+    @classmethod
+    def from_queries(cls, query_list):
+        '''
+        Builds the index of a list of queries, where the position of a query is its ID
+        '''
+        token_ids = {}
+        pair_tokens = array('i')
+        pair_qids = array('i')
+        for qid, aquery in enumerate(query_list):
+            for atoken in set(tokenize(aquery)):
+                pair_tokens.append(token_ids.setdefault(atoken, len(token_ids)))
+                pair_qids.append(qid)
+        tokens = sorted(token_ids)
+        token_rank = np.empty(len(tokens), dtype=np.int64)
+        token_rank[[token_ids[atoken] for atoken in tokens]] = np.arange(len(tokens))
+        num_queries = max(len(query_list), 1)
+        pairs = np.sort(token_rank[np.frombuffer(pair_tokens, dtype=np.int32)] * num_queries +
+                        np.frombuffer(pair_qids, dtype=np.int32))
+        token_ptr = np.zeros(len(tokens) + 1, dtype=np.int64)
+        token_ptr[1:] = np.cumsum(np.bincount(pairs // num_queries, minlength=len(tokens)))
+        return cls(tokens, token_ptr, (pairs % num_queries).astype(np.int32))
+
+    def postings(self, token):
+        '''
+        The sorted IDs of the queries containing a (lower case) word
+        '''
+        i = bisect.bisect_left(self.tokens, token)
+        if i == len(self.tokens) or self.tokens[i] != token:
+            return np.zeros(0, dtype=np.int32)
+        return self.token_qids[self.token_ptr[i]:self.token_ptr[i + 1]]
+
+    def search(self, text):
+        '''
+        The sorted IDs of the queries containing all the words of a text
+        '''
+        tokens = set(tokenize(text))
+        if not tokens:
+            return np.zeros(0, dtype=np.int32)
+        # Starting from the rarest word keeps the intersections small
+        postings = sorted((self.postings(atoken) for atoken in tokens), key=len)
+        qids = postings[0]
+        for more in postings[1:]:
+            if not len(qids):
+                break
+            qids = query_algebra.intersect(qids, more)
+        return qids
@@ -0,0 +1,282 @@
+# Copyright 2018 Comcast Cable Communications Management, LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+A compact binary (columnar) alternative to the text file of parsed queries written by
+parse_query. It keeps only what the clustering needs: the query ID of every tree and,
+for every node of a tree, the name of the node and the position of its parent.
+cluster_query reads it straight into numpy arrays, without decoding any json.
+
+The file is a sequence of self-contained chunks, so the files of the chunks can be
+concatenated. Every chunk is (all the integers are little endian int32):
+    TREES_MAGIC, num_trees, num_nodes, num_labels, label_bytes
+    qids[num_trees]              query ID of every tree
+    tree_ptr[num_trees + 1]      tree_ptr[t]:tree_ptr[t + 1] are the nodes of tree t
+    node_label[num_nodes]        position of the name of the node in the labels of the chunk
+    node_parent[num_nodes]       position of the parent in the tree (-1 for the root)
+    labels                       label_bytes bytes of utf-8 names separated by newlines
+The nodes of every tree are in the order of the json tree (depth first), so the parent of
+a node always comes before it.
+'''
+import sys
+import json
+import struct
+from array import array
+import numpy as np
+
+TREES_MAGIC = b'SVTREES1'
+_HEADER = struct.Struct('<8sIIII')
+
+
+class ChunkBuilder(object):
+    '''
+    Collects parse trees (in the json tree structure of parse_query.segment_gen) into a chunk
+    '''
+
+    def __init__(self):
+        self.label_ids = {}
+        self.qids = array('i')
+        self.tree_ptr = array('i', [0])
+        self.node_label = array('i')
+        self.node_parent = array('i')
+
+    def __len__(self):
+        return len(self.qids)
+
+    def add(self, qid, jtree):
+        '''
+        Adds the tree of a query. jtree may be None (e.g. for a tree that could not be
+        decoded), which adds a tree without nodes.
+        '''
+        label_ids = self.label_ids
+        node_label = []
+        node_parent = []
+        # Depth first walk. Every level holds the iterator of a list, the parent of its
+        # nodes, and its last node (which a following list belongs to).
+        levels = [[iter(jtree or []), -1, -1]]
+        while levels:
+            level = levels[-1]
+            for anode in level[0]:
+                if type(anode) is list:
+                    levels.append([iter(anode), level[2], -1])
+                    break
+                level[2] = len(node_label)
+                label_id = label_ids.get(anode)
+                if label_id is None:
+                    label_id = label_ids[anode] = len(label_ids)
+                node_label.append(label_id)
+                node_parent.append(level[1])
+            else:
+                levels.pop()
+        self.node_label.extend(node_label)
+        self.node_parent.extend(node_parent)
+        self.qids.append(qid)
+        self.tree_ptr.append(len(self.node_label))
+
+    def tobytes(self):
+        labels = [None] * len(self.label_ids)
+        for alabel, i in self.label_ids.iteritems():
+            labels[i] = alabel.encode('utf-8') if isinstance(alabel, unicode) else alabel
+        label_data = b'\n'.join(labels)
+        return _HEADER.pack(TREES_MAGIC, len(self.qids), len(self.node_label), len(labels), len(label_data)) + \
+            self.qids.tostring() + self.tree_ptr.tostring() + self.node_label.tostring() + \
+            self.node_parent.tostring() + label_data
+
+
+def chunk_gen(records, chunk_size=20000):
+    '''
+    Encodes an iterator of (query ID, json tree) tuples into chunks of chunk_size trees
+    '''
+    builder = ChunkBuilder()
+    for qid, jtree in records:
+        builder.add(qid, jtree)
+        if len(builder) == chunk_size:
+            yield builder.tobytes()
+            builder = ChunkBuilder()
+    if len(builder):
+        yield builder.tobytes()
+
+
+def is_tree_columns(filename):
+    '''
+    True if the file is in the binary format (rather than the text format) of parsed queries
+    '''
+    with open(filename, 'rb') as f:
+        return f.read(len(TREES_MAGIC)) == TREES_MAGIC
+
+
+def _read_chunks(data):
+    # Yields the arrays and the labels of every chunk
+    pos = 0
+    while pos < len(data):
+        magic, num_trees, num_nodes, num_labels, label_bytes = _HEADER.unpack_from(data, pos)
+        if magic != TREES_MAGIC:
+            raise IOError('Corrupt parsed tree chunk at byte %d' % pos)
+        pos += _HEADER.size
+        arrays = {}
+        for aname, length in (('qids', num_trees), ('tree_ptr', num_trees + 1),
+                              ('node_label', num_nodes), ('node_parent', num_nodes)):
+            arrays[aname] = np.frombuffer(data, dtype='<i4', count=length, offset=pos)
+            pos += 4 * length
+        labels = data[pos:pos + label_bytes].decode('utf-8').split(u'\n') if num_labels else []
+        pos += label_bytes
+        yield arrays, labels
+
+
+def chunk_file_gen(filename):
+    '''
+    Yields the chunks of the file one at a time (as bytes), so that the file is never
+    read into the memory as a whole
+    '''
+    with open(filename, 'rb') as f:
+        while True:
+            header = f.read(_HEADER.size)
+            if not header:
+                break
+            if len(header) < _HEADER.size:
+                raise IOError('Truncated parsed tree chunk in %s' % filename)
+            magic, num_trees, num_nodes, num_labels, label_bytes = _HEADER.unpack(header)
+            if magic != TREES_MAGIC:
+                raise IOError('Corrupt parsed tree chunk in %s' % filename)
+            yield header + f.read(4 * (2 * num_trees + 1 + 2 * num_nodes) + label_bytes)
+
+
+def count_trees(filename):
+    '''
+    Returns the number of trees in the file
+    '''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    return sum(len(arrays['qids']) for arrays, _ in _read_chunks(data))
+
+
+def read_columns(filename):
+    '''
+    Reads all the chunks of the file into a single set of columns.
+    Returns a dictionary of numpy arrays and the sorted list of the names of the nodes:
+    qids, tree_ptr (int64), node_label (position in the sorted names) and node_parent
+    (the position of the parent node in these arrays, -1 for the roots)
+    '''
+    with open(filename, 'rb') as f:
+        return columns_from_bytes(f.read())
+
+
+def columns_from_bytes(data):
+    '''
+    Same as read_columns, for chunks which are already in the memory
+    '''
+    chunks = list(_read_chunks(data))
+    labels = sorted(set().union(*[achunk_labels for _, achunk_labels in chunks]))
+    label_ids = {alabel: i for i, alabel in enumerate(labels)}
+
+    qids, tree_ptr, node_label, node_parent = [], [np.zeros(1, dtype=np.int64)], [], []
+    num_nodes = 0
+    for arrays, achunk_labels in chunks:
+        # Translate the positions in the chunk to the positions in the whole file
+        chunk_label_ids = np.array([label_ids[alabel] for alabel in achunk_labels], dtype=np.int32)
+        tree_start = np.repeat(arrays['tree_ptr'][:-1], np.diff(arrays['tree_ptr']))
+        qids.append(arrays['qids'])
+        tree_ptr.append(arrays['tree_ptr'][1:].astype(np.int64) + num_nodes)
+        node_label.append(chunk_label_ids[arrays['node_label']])
+        node_parent.append(np.where(arrays['node_parent'] < 0, -1,
+                                    arrays['node_parent'] + tree_start + num_nodes).astype(np.int32))
+        num_nodes += len(arrays['node_label'])
+    columns = {'qids': np.concatenate(qids or [np.zeros(0, dtype=np.int32)]).astype(np.int32),
+               'tree_ptr': np.concatenate(tree_ptr),
+               'node_label': np.concatenate(node_label or [np.zeros(0, dtype=np.int32)]),
+               'node_parent': np.concatenate(node_parent or [np.zeros(0, dtype=np.int32)])}
+    return columns, labels
+
+
+def iter_trees(filename):
+    '''
+    Yields the query ID and the json tree (as in the text format) of every tree in the file
+    '''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    for arrays, labels in _read_chunks(data):
+        tree_ptr = arrays['tree_ptr'].tolist()
+        node_label = arrays['node_label'].tolist()
+        node_parent = arrays['node_parent'].tolist()
+        for t, qid in enumerate(arrays['qids'].tolist()):
+            jtree = []
+            # The list holding every node, and the list of the children of every node
+            parent_list = {-1: jtree}
+            child_lists = {}
+            for j in range(tree_ptr[t + 1] - tree_ptr[t]):
+                parent = node_parent[tree_ptr[t] + j]
+                if parent < 0:
+                    alist = jtree
+                elif parent in child_lists:
+                    alist = child_lists[parent]
+                else:
+                    # The children of a node directly follow it
+                    alist = child_lists[parent] = []
+                    parent_list[parent].append(alist)
+                alist.append(labels[node_label[tree_ptr[t] + j]])
+                parent_list[j] = alist
+            yield qid, jtree
+
+
+def text_records(lines):
+    '''
+    Yields the query ID and the json tree of every line of a text file of parsed queries
+    (the output of parse_query). The tree of a corrupt line is None.
+    '''
+    for i, aline in enumerate(lines):
+        spltline = aline.strip().split('\t')
+        try:
+            jtree = json.loads(spltline[1])
+        except:
+            print("Skipping corrupt line %d" % i)
+            jtree = None
+        yield int(spltline[3]), jtree
+
+
+def encode_text_range(args):
+    '''
+    Encodes the trees of the lines (of a text file of parsed queries) which start in a
+    range of bytes into a single chunk. It takes a single tuple (filename, start, end),
+    so that the ranges of a file can be mapped by a multiprocessing pool.
+    '''
+    filename, start, end = args
+
+    def lines():
+        with open(filename, 'rb') as f:
+            if start > 0:
+                # The line holding the byte before start belongs to the previous range
+                f.seek(start - 1)
+                f.readline()
+            pos = f.tell()
+            while pos < end:
+                aline = f.readline()
+                if not aline:
+                    break
+                pos += len(aline)
+                yield aline
+    builder = ChunkBuilder()
+    for qid, jtree in text_records(lines()):
+        builder.add(qid, jtree)
+    return builder.tobytes()
+
+
+def convert(parsed_query_file, outfile, chunk_size=20000):
+    '''
+    Converts a text file of parsed queries (the output of parse_query) to the binary format
+    '''
+    with open(parsed_query_file) as inp, open(outfile, 'wb') as f:
+        for achunk in chunk_gen(text_records(inp), chunk_size):
+            f.write(achunk)
+
+
+if __name__ == '__main__':
+    convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,59 @@
+'''
+A small random corpus in the formats of the pipeline: the query file, the parsed queries
+(text and binary) and the actions pickle
+'''
+import json
+import random
+import cPickle as cp
+import pytest
+from syntaviz import tree_columns
+
+VERBS = ['want', 'need', 'cancel', 'send', 'change']
+NOUNS = ['modem', 'email', 'plan', 'bill', 'the']
+RELS = ['dobj', 'nsubj', 'det', 'prep']
+ACTIONS = ['A', 'B', 'C']
+
+
+def random_subtree(rnd, depth):
+    # The names of a level may repeat, so a query can be in a cluster more than once
+    subtree = []
+    for _ in range(rnd.randint(0, 3 - depth)):
+        subtree.append(u'%s NN %s' % (rnd.choice(NOUNS), rnd.choice(RELS)))
+        if depth < 2 and rnd.random() < 0.5:
+            children = random_subtree(rnd, depth + 1)
+            if children:
+                subtree.append(children)
+    return subtree
+
+
+def write_corpus(directory, num_queries=600, seed=0):
+    '''
+    Writes the files of a random corpus into a directory. Returns their names.
+    '''
+    rnd = random.Random(seed)
+    files = {'queries': str(directory.join('queries')),
+             'parsed': str(directory.join('parsed.txt')),
+             'parsed_bin': str(directory.join('parsed.bin')),
+             'actions': str(directory.join('actions.pkl'))}
+    qaction = {}
+    with open(files['queries'], 'w') as qf, open(files['parsed'], 'w') as pf:
+        for qid in range(num_queries):
+            verb = rnd.choice(VERBS)
+            jtree = [u'%s VB ROOT' % verb]
+            children = random_subtree(rnd, 0)
+            if children:
+                jtree.append(children)
+            query = '%s %s %d' % (verb, rnd.choice(NOUNS), qid % 37)
+            qf.write('%d\t%s\t1.0\t1.0\t%d\n' % (qid, query, rnd.randint(1, 20)))
+            pf.write('%s\t%s\t[]\t%d\n' % (query, json.dumps(jtree), qid))
+            if rnd.random() < 0.8:
+                qaction[query.lower()] = rnd.choice(ACTIONS)
+    with open(files['actions'], 'wb') as f:
+        cp.dump(qaction, f)
+    tree_columns.convert(files['parsed'], files['parsed_bin'], chunk_size=100)
+    return files
+
+
+@pytest.fixture(scope='module')
+def corpus(tmpdir_factory):
+    return write_corpus(tmpdir_factory.mktemp('corpus'))
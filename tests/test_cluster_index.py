@@ -0,0 +1,131 @@
+import filecmp
+import numpy as np
+from syntaviz import cluster_index
+from syntaviz import cluster_query
+from syntaviz import external_index
+
+
+def assert_same_index(index1, index2):
+    assert list(index1.labels) == list(index2.labels)
+    for aname in sorted(cluster_index.INDEX_ARRAYS) + ['freqs']:
+        assert np.array_equal(index1.arrays[aname], index2.arrays[aname]), aname
+
+
+def nested_index(corpus):
+    clust, _, freq_list = cluster_query.cluster_counts_and_queries(corpus['parsed'], corpus['queries'],
+                                                                   get_freq=True)
+    return cluster_index.ClusterIndex.from_clust(clust, freq_list)
+
+
+def test_builds_are_equal(corpus):
+    # The nested clusters, the columns of the binary trees and the text trees decoded by workers
+    from_clust = nested_index(corpus)
+    from_columns, _, _ = cluster_query.cluster_index_and_queries(corpus['parsed_bin'], corpus['queries'])
+    from_workers, _, _ = cluster_query.cluster_index_and_queries(corpus['parsed'], corpus['queries'], workers=2)
+    assert from_clust.num_nodes > 100
+    assert_same_index(from_clust, from_columns)
+    assert_same_index(from_clust, from_workers)
+
+
+def test_counts_match_nested_clusters(corpus):
+    clust, _, freq_list = cluster_query.cluster_counts_and_queries(corpus['parsed'], corpus['queries'],
+                                                                   get_freq=True)
+    index = cluster_index.ClusterIndex.from_clust(clust, freq_list)
+    pending = [(clust, cluster_index.ROOT)]
+    while pending:
+        asubclust, node_id = pending.pop()
+        for akey in asubclust:
+            child = index.child(node_id, akey)
+            count, subclusters, qids, total = asubclust[akey]
+            assert index.count(child) == count == len(qids)
+            assert index.total(child) == total == sum(freq_list[qid] for qid in qids)
+            assert sorted(index.qids(child)) == sorted(qids)
+            pending.append((subclusters, child))
+
+
+def test_external_build_equals_in_memory_build(corpus, tmpdir):
+    for prune in [{}, {'min_count': 4}, {'maxlevel': 1, 'min_total': 30}]:
+        in_memory = str(tmpdir.join('in_memory.snap'))
+        out_of_core = str(tmpdir.join('out_of_core.snap'))
+        cluster_query.build_index(corpus['queries'], corpus['parsed_bin'], corpus['actions'], in_memory, **prune)
+        # A tiny memory budget, so that there are many runs to merge
+        for parsed in (corpus['parsed'], corpus['parsed_bin']):
+            cluster_query.build_index(corpus['queries'], parsed, corpus['actions'], out_of_core,
+                                      memory_mb=0.001, tmp_dir=str(tmpdir), **prune)
+            assert filecmp.cmp(in_memory, out_of_core, shallow=False), prune
+
+
+def test_prune_equals_pruned_build(corpus):
+    index, _, _ = cluster_query.cluster_index_and_queries(corpus['parsed_bin'], corpus['queries'])
+    pruned, _, _ = cluster_query.cluster_index_and_queries(corpus['parsed_bin'], corpus['queries'],
+                                                           maxlevel=1, min_count=3)
+    assert_same_index(index.prune(maxlevel=1, min_count=3), pruned)
+    assert pruned.num_nodes < index.num_nodes
+
+
+def test_other_holds_the_folded_queries_once(corpus):
+    index, _, _ = cluster_query.cluster_index_and_queries(corpus['parsed_bin'], corpus['queries'])
+    for prune in [{'min_count': 5}, {'min_total': 60}, {'maxlevel': 1, 'min_count': 3}]:
+        pruned = index.prune(**prune)
+        others = [node_id for node_id in range(1, pruned.num_nodes)
+                  if pruned.label(node_id) == cluster_index.OTHER_LABEL]
+        assert others, prune
+        for node_id in others:
+            qids = pruned.qids(node_id).tolist()
+            parent = int(pruned.node_parent[node_id])
+            # The queries of the subclusters of the parent that were folded
+            original = index.find(pruned.key(parent))
+            kept = set(pruned.label(achild) for achild in pruned.children(parent))
+            folded = set()
+            for achild in index.children(original):
+                if index.label(achild) not in kept:
+                    folded.update(index.qids(achild).tolist())
+            assert qids == sorted(folded)
+            assert pruned.count(node_id) == len(set(qids))
+            assert pruned.total(node_id) == sum(pruned.freqs[qid] for qid in qids)
+            if parent != cluster_index.ROOT:
+                assert pruned.count(node_id) <= pruned.count(parent)
+
+
+def test_path_table_of_many_chunks(corpus):
+    _, query_list, freq_list = cluster_query.cluster_index_and_queries(corpus['parsed_bin'], corpus['queries'])
+    tables = []
+    for chunk_size in (100000, 7):
+        paths = external_index.PathTable(np.array(freq_list, dtype=np.int64))
+        for columns, labels in external_index._columns_gen(corpus['parsed'], chunk_size):
+            paths.add(columns, labels)
+        no_other = np.zeros(0, dtype=np.int64)
+        tables.append(paths.number_nodes(paths.fold(), no_other, no_other))
+    # The paths are numbered in another order, but they make the same nodes
+    assert tables[0][0] == tables[1][0]
+    for aname, array1, array2 in zip(['label', 'parent', 'count', 'total'], tables[0][1:5], tables[1][1:5]):
+        assert np.array_equal(array1, array2), aname
+
+
+def test_snapshot_round_trip(corpus, tmpdir):
+    snapshot = str(tmpdir.join('index.snap'))
+    cluster_query.build_index(corpus['queries'], corpus['parsed_bin'], corpus['actions'], snapshot)
+    index, query_list, _ = cluster_query.cluster_index_and_queries(corpus['parsed_bin'], corpus['queries'])
+    loaded = cluster_index.load_snapshot(snapshot)
+    assert_same_index(index, loaded)
+    assert list(loaded.queries) == query_list
+    # The lazily loaded index reads the query IDs of the deeper clusters from the file
+    lazy = cluster_index.load_snapshot(snapshot, resident_levels=1)
+    for node_id in range(1, index.num_nodes):
+        assert np.array_equal(lazy.qids(node_id), index.qids(node_id))
+        assert np.array_equal(lazy.qids(node_id, by_freq=True), index.qids(node_id, by_freq=True))
+
+
+def test_nondependent_counts_of_many_queries():
+    # The (parent, query) pairs of the last nodes do not fit in 32 bits
+    num_queries = 10 ** 6
+    node_parent = np.array([-1] + [cluster_index.ROOT] * 3000 + [3000], dtype=np.int32)
+    qid_ptr = np.concatenate(([0], np.arange(len(node_parent)))).astype(np.int64)
+    qid_data = np.full(len(node_parent) - 1, num_queries - 1, dtype=np.int32)
+    freqs = np.full(num_queries, 2, dtype=np.int64)
+    nondep_count, nondep_total = cluster_index.count_nondependent(qid_ptr, qid_data, node_parent, freqs)
+    # Only the query of node 3000 is also in a subcluster
+    expected = np.ones(len(node_parent), dtype=np.int32)
+    expected[[cluster_index.ROOT, 3000]] = 0
+    assert np.array_equal(nondep_count, expected)
+    assert np.array_equal(nondep_total, 2 * expected)
@@ -0,0 +1,52 @@
+from syntaviz.lru_cache import LRUCache
+
+
+def test_evicts_by_entries():
+    cache = LRUCache(max_entries=2)
+    cache.put('a', 'x')
+    cache.put('b', 'y')
+    # Reading a makes b the least recently used entry
+    assert cache.get('a') == 'x'
+    cache.put('c', 'z')
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+    assert len(cache) == 2
+
+
+def test_evicts_by_size():
+    cache = LRUCache(max_entries=10, max_size=10)
+    cache.put('a', 'aaaa')
+    cache.put('b', 'bbbb')
+    cache.put('c', 'cccc')
+    assert 'a' not in cache and len(cache) == 2 and cache.size == 8
+    # An explicit size instead of the length of the value
+    cache.put('d', None, size=7)
+    assert list(cache._entries) == ['d'] and cache.size == 7
+    # A value larger than the whole cache is not cached
+    cache.put('e', 'e' * 11)
+    assert 'e' not in cache and 'd' in cache
+
+
+def test_replace_updates_the_size():
+    cache = LRUCache(max_entries=10, max_size=10)
+    cache.put('a', 'aaaa')
+    cache.put('a', 'aaaaaa')
+    assert cache.size == 6 and cache.get('a') == 'aaaaaa'
+    cache.clear()
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_disabled():
+    cache = LRUCache(max_entries=0)
+    cache.put('a', 'x')
+    assert cache.get('a') is None and len(cache) == 0
+
+
+def test_stats():
+    cache = LRUCache(max_entries=5, max_size=100)
+    assert cache.get('a', 'default') == 'default'
+    cache.put('a', 'abc')
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+    assert cache.stats() == {'entries': 1, 'size': 3, 'max_entries': 5, 'max_size': 100,
+                             'hits': 2, 'misses': 2}
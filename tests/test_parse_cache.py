@@ -0,0 +1,49 @@
+from syntaviz import parse_cache
+
+
+def test_normalize():
+    assert parse_cache.normalize('  want   a\tmodem ') == 'want a modem'
+
+
+def test_get_and_put(tmpdir):
+    cache = parse_cache.ParseCache(str(tmpdir.join('cache.db')), 'v1')
+    assert cache.get_many(['want modem', 'cancel plan']) == [None, None]
+    assert (cache.hits, cache.misses) == (0, 2)
+    cache.put_many([('want modem', 'want modem\t["want VB ROOT"]'), ('cancel plan', 'cancel plan\t[]')])
+    assert len(cache) == 2
+    # Queries differing only in whitespace share their parse trees
+    assert cache.get_many(['cancel plan', 'new plan', ' want  modem']) == \
+        ['cancel plan\t[]', None, 'want modem\t["want VB ROOT"]']
+    assert (cache.hits, cache.misses) == (2, 3)
+    # A later put replaces the parse tree
+    cache.put_many([('want modem', 'want modem\t[]')])
+    assert cache.get_many(['want modem']) == ['want modem\t[]']
+    assert len(cache) == 2
+    cache.close()
+
+
+def test_parser_versions(tmpdir):
+    filename = str(tmpdir.join('cache.db'))
+    cache = parse_cache.ParseCache(filename, 'v1')
+    cache.put_many([('want modem', 'v1 tree')])
+    cache.close()
+    # The trees of an other parser are not returned, but they are kept
+    other = parse_cache.ParseCache(filename, 'v2')
+    assert other.get_many(['want modem']) == [None]
+    other.put_many([('want modem', 'v2 tree')])
+    other.close()
+    cache = parse_cache.ParseCache(filename, 'v1')
+    assert cache.get_many(['want modem']) == ['v1 tree']
+    assert len(cache) == 2
+    cache.close()
+
+
+def test_many_queries(tmpdir):
+    # More queries than fit in a single statement
+    cache = parse_cache.ParseCache(str(tmpdir.join('cache.db')), 'v1')
+    queries = ['query %d' % i for i in range(1500)]
+    cache.put_many([(aquery, aquery + ' tree') for aquery in queries[::2]])
+    found = cache.get_many(queries)
+    assert found == [aquery + ' tree' if i % 2 == 0 else None for i, aquery in enumerate(queries)]
+    assert (cache.hits, cache.misses) == (750, 750)
+    cache.close()
@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import pytest
+from syntaviz import fake_syntaxnet
+from syntaviz import parse_cache
+from syntaviz import parse_query
+from syntaviz import tree_columns
+
+FAKE_PARSER = '%s %s' % (sys.executable, os.path.splitext(fake_syntaxnet.__file__)[0] + '.py')
+QUERIES = ['want modem', 'cancel my plan now', 'send the email to me', 'change plan', 'need a new modem please']
+
+
+@pytest.fixture
+def query_file(tmpdir):
+    filename = str(tmpdir.join('queries'))
+    with open(filename, 'w') as f:
+        for qid in range(50):
+            f.write('%d\t%s %d\t1.0\t1.0\t%d\n' % (qid, QUERIES[qid % len(QUERIES)], qid, qid + 1))
+    return filename
+
+
+def parse(query_file, outfile, parser=FAKE_PARSER, **kwargs):
+    parse_query.parse_file(query_file, outfile, workers=2, shard_size=8, retries=1,
+                           conll_shellname=parser + ' --conll', shellname=parser, parser_batch_size=3,
+                           batch_size=4, **kwargs)
+
+
+def expected_tree(query):
+    conll = fake_syntaxnet.conll_format(fake_syntaxnet.fake_parse(query))
+    return parse_query.conll_to_tree([aline.split('\t')[1:] for aline in conll.split('\n') if aline])
+
+
+def read_trees(outfile):
+    with open(outfile) as f:
+        return [(int(aline.rstrip('\n').split('\t')[3]), json.loads(aline.split('\t')[1])) for aline in f]
+
+
+@pytest.mark.parametrize('conll', [False, True])
+def test_pool_keeps_the_order_of_the_batches(conll):
+    queries = ['%s %d' % (QUERIES[i % len(QUERIES)], i) for i in range(20)]
+    output, orig_idx_list = parse_query.parse_query_with_syntaxnet(
+        enumerate(queries), shellname=FAKE_PARSER + (' --conll' if conll else ''), batch_size=3, pool_size=2,
+        parser_batch_size=2)
+    assert orig_idx_list == range(len(queries))
+    if conll:
+        expected = []
+        for aquery in queries:
+            conll_lines = fake_syntaxnet.conll_format(fake_syntaxnet.fake_parse(aquery)).split('\n')
+            expected.append([aline.split('\t')[1:] for aline in conll_lines if aline])
+        assert [json.loads(aparse) for aparse in parse_query.segment_gen_conll(output)] == expected
+    else:
+        assert [atree.split('\t')[0] for atree in parse_query.segment_gen(output)] == queries
+
+
+def test_single_pass_equals_two_passes(query_file, tmpdir):
+    trees = {}
+    for single_pass in (False, True):
+        outfile = str(tmpdir.join('parsed%d.txt' % single_pass))
+        parse_query.pipeline(query_file, outfile, batch_size=4, pool_size=2, single_pass=single_pass,
+                             shellname=FAKE_PARSER, conll_shellname=FAKE_PARSER + ' --conll', parser_batch_size=3)
+        trees[single_pass] = read_trees(outfile)
+    assert trees[False] == trees[True]
+    queries = [aline.split('\t')[1] for aline in open(query_file)]
+    assert [qid for qid, _ in trees[True]] == range(len(queries))
+    for qid, jtree in trees[True]:
+        assert jtree == expected_tree(queries[qid])
+
+
+@pytest.mark.parametrize('single_pass', [False, True])
+def test_parse_file(query_file, tmpdir, single_pass):
+    outfile = str(tmpdir.join('parsed.txt'))
+    parse(query_file, outfile, single_pass=single_pass)
+    queries = [aline.split('\t')[1] for aline in open(query_file)]
+    trees = read_trees(outfile)
+    assert [qid for qid, _ in trees] == range(len(queries))
+    for qid, jtree in trees:
+        assert jtree == expected_tree(queries[qid])
+    # The parts and the manifest are removed after the merge
+    assert not os.path.exists(outfile + '.parts')
+
+
+def test_parse_file_binary(query_file, tmpdir):
+    text_file = str(tmpdir.join('parsed.txt'))
+    binary_file = str(tmpdir.join('parsed.bin'))
+    parse(query_file, text_file, single_pass=True)
+    parse(query_file, binary_file, single_pass=True, binary=True)
+    assert tree_columns.is_tree_columns(binary_file)
+    assert list(tree_columns.iter_trees(binary_file)) == read_trees(text_file)
+
+
+def test_dropped_query_fails_the_shard_and_resume_parses_it(query_file, tmpdir):
+    outfile = str(tmpdir.join('parsed.txt'))
+    # The parser gives no tree for the query 13, so its shard is short
+    with pytest.raises(RuntimeError):
+        parse(query_file, outfile, parser=FAKE_PARSER + ' --drop 13', single_pass=True)
+    # Nothing is merged and only the complete shards are in the manifest
+    assert not os.path.exists(outfile)
+    with open(parse_query.manifest_name(outfile)) as f:
+        done = json.load(f)['shards']
+    assert len(done) == 6 and '8' not in done
+    for entry in done.values():
+        assert entry['lines'] == entry['count']
+    mtimes = {start: os.path.getmtime(parse_query.part_name(outfile, int(start))) for start in done}
+
+    parse(query_file, outfile, single_pass=True, resume=True, keep_parts=True)
+    assert len(read_trees(outfile)) == 50
+    # The complete shards were not parsed again
+    for start in done:
+        assert os.path.getmtime(parse_query.part_name(outfile, int(start))) == mtimes[start]
+
+
+def test_failed_merge_leaves_no_outfile(query_file, tmpdir, monkeypatch):
+    outfile = str(tmpdir.join('parsed.txt'))
+    shard_file = parse_query.shard_file
+    # One more line than the parts have, as if a line had been lost
+    monkeypatch.setattr(parse_query, 'shard_file', lambda *args: (shard_file(*args)[0] + 1, shard_file(*args)[1]))
+    with pytest.raises(IOError):
+        parse(query_file, outfile, single_pass=True)
+    assert not os.path.exists(outfile)
+    assert not os.path.exists(outfile + '.tmp')
+    assert os.path.exists(outfile + '.parts')
+
+
+@pytest.mark.parametrize('single_pass', [False, True])
+def test_dropped_query_is_not_cached(tmpdir, single_pass):
+    query_file = str(tmpdir.join('queries'))
+    queries = ['alpha beta', 'drop me', 'gamma delta', 'eps zeta']
+    with open(query_file, 'w') as f:
+        for qid, aquery in enumerate(queries):
+            f.write('%d\t%s\t1.0\t1.0\t1\n' % (qid, aquery))
+    outfile = str(tmpdir.join('parsed.txt'))
+    cache = parse_cache.ParseCache(str(tmpdir.join('cache.db')), 'fake')
+    # The trees after the dropped query would go to the wrong queries
+    with pytest.raises(RuntimeError):
+        parse(query_file, outfile, parser=FAKE_PARSER + ' --drop drop', single_pass=single_pass, cache=cache)
+    assert len(cache) == 0
+    parse(query_file, outfile, single_pass=single_pass, resume=True, cache=cache)
+    trees = read_trees(outfile)
+    assert [qid for qid, _ in trees] == range(len(queries))
+    for qid, jtree in trees:
+        assert jtree == expected_tree(queries[qid])
+    assert len(cache) == len(queries)
@@ -0,0 +1,81 @@
+import random
+import fnmatch
+import numpy as np
+import pytest
+from syntaviz import cluster_index
+from syntaviz import cluster_query
+from syntaviz import path_pattern
+
+
+def node_paths(index):
+    # The names of the clusters from the root down to every node
+    paths = {cluster_index.ROOT: []}
+    for node_id in range(cluster_index.ROOT + 1, index.num_nodes):
+        paths[node_id] = paths[int(index.node_parent[node_id])] + [index.labels[index.node_label[node_id]]]
+    return paths
+
+
+def brute_match(steps, path):
+    if not steps:
+        return not path
+    if steps[0] == path_pattern.ANY_LEVELS:
+        return any(brute_match(steps[1:], path[i:]) for i in range(len(path) + 1))
+    return bool(path) and fnmatch.fnmatchcase(path[0], steps[0]) and brute_match(steps[1:], path[1:])
+
+
+def random_step(rnd, labels):
+    alabel = rnd.choice(labels)
+    word, pos, rel = alabel.split(' ')
+    return rnd.choice(['**', '*', alabel, '* %s %s' % (pos, rel), '%s * *' % word, '%s*' % word[:2],
+                       '? %s %s' % (pos, rel), '[a-m]* * %s' % rel])
+
+
+@pytest.fixture(scope='module')
+def index(corpus):
+    return cluster_query.cluster_index_and_queries(corpus['parsed_bin'], corpus['queries'])[0]
+
+
+def test_patterns_match_brute_force(index):
+    paths = node_paths(index)
+    labels = list(index.labels)
+    rnd = random.Random(3)
+    patterns = ['**', '*', '**|**', '**|cancel VB ROOT', 'want VB ROOT|*', '* VB ROOT|* NN dobj|**',
+                '**|* * det', 'want VB ROOT|modem NN dobj|*', '*|*|*', 'no such cluster', '**|no such|**']
+    patterns += ['|'.join(random_step(rnd, labels) for _ in range(rnd.randint(1, 4))) for _ in range(300)]
+    for pattern in patterns:
+        steps = path_pattern.parse(pattern)
+        expected = [node_id for node_id in range(cluster_index.ROOT + 1, index.num_nodes)
+                    if brute_match(steps, paths[node_id])]
+        assert path_pattern.match(index, pattern).tolist() == expected, pattern
+
+
+def test_pattern_query_ids(index):
+    for pattern in ['**|* NN dobj', '* VB ROOT|**', '**|the NN det|**', 'no such cluster']:
+        nodes = cluster_query.match_pattern(index, pattern)
+        expected = set()
+        for node_id in nodes:
+            expected.update(index.qids(node_id).tolist())
+        assert cluster_query.pattern_query_ids(index, nodes).tolist() == sorted(expected), pattern
+
+
+def test_bad_patterns(index, corpus):
+    for pattern in ['', 'want VB ROOT|', '||*']:
+        with pytest.raises(path_pattern.PatternError):
+            cluster_query.match_pattern(index, pattern)
+    clust, _ = cluster_query.cluster_counts_and_queries(corpus['parsed'], corpus['queries'])
+    with pytest.raises(TypeError):
+        cluster_query.match_pattern(clust, '**')
+
+
+def test_outermost(index):
+    nodes = path_pattern.match(index, '**|* NN *')
+    marked = set(nodes.tolist())
+    expected = []
+    for node_id in nodes:
+        ancestor = int(index.node_parent[node_id])
+        while ancestor != cluster_index.ROOT and ancestor not in marked:
+            ancestor = int(index.node_parent[ancestor])
+        if ancestor == cluster_index.ROOT:
+            expected.append(node_id)
+    assert len(expected) < len(nodes)
+    assert path_pattern.outermost(index, nodes).tolist() == expected
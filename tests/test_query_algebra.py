@@ -0,0 +1,77 @@
+import re
+import random
+import numpy as np
+import pytest
+from syntaviz import cluster_query
+from syntaviz import query_algebra
+
+
+def random_ids(rnd, size, num_queries):
+    return np.array(sorted(rnd.sample(range(num_queries), size)), dtype=np.int32)
+
+
+@pytest.mark.parametrize('size1,size2', [(0, 50), (3, 5000), (400, 600), (5000, 7), (2000, 2000)])
+def test_set_operations(size1, size2):
+    # Sizes on both sides of the ratio between binary searches and bitmaps
+    rnd = random.Random(size1 * 31 + size2)
+    qids1 = random_ids(rnd, size1, 10000)
+    qids2 = random_ids(rnd, size2, 10000)
+    set1, set2 = set(qids1.tolist()), set(qids2.tolist())
+    assert query_algebra.intersect(qids1, qids2).tolist() == sorted(set1 & set2)
+    assert query_algebra.union(qids1, qids2).tolist() == sorted(set1 | set2)
+    assert query_algebra.difference(qids1, qids2).tolist() == sorted(set1 - set2)
+    assert query_algebra.difference(qids2, qids1).tolist() == sorted(set2 - set1)
+    assert query_algebra.complement(qids1, 10000).tolist() == sorted(set(range(10000)) - set1)
+
+
+def test_order_by_freq():
+    rnd = random.Random(1)
+    freqs = np.array([rnd.randint(1, 5) for _ in range(1000)], dtype=np.int64)
+    qids = random_ids(rnd, 300, 1000)
+    expected = sorted(qids.tolist(), key=lambda qid: (-freqs[qid], qid))
+    for end in (0, 1, 10, 300, 500):
+        assert query_algebra.order_by_freq(qids, freqs, end).tolist() == expected[:end]
+
+
+def test_parse():
+    tree = query_algebra.parse("(want VB ROOT AND NOT #3) OR 'a (b)' AND \"c OR d\"")
+    assert tree == ('or', ('and', ('key', 'want VB ROOT'), ('not', ('node', 3))),
+                    ('and', ('key', 'a (b)'), ('key', 'c OR d')))
+    assert query_algebra.parse("x|'s POS possessive") == ('key', "x|'s POS possessive")
+    for expr in ['', 'a AND', '(a OR b', 'a b)', 'NOT']:
+        with pytest.raises(query_algebra.ExpressionError):
+            query_algebra.parse(expr)
+
+
+def random_expression(rnd, keys, depth=0):
+    if depth > 2 or rnd.random() < 0.3:
+        return '"%s"' % rnd.choice(keys)
+    operator = rnd.choice(['AND', 'OR', 'AND NOT', 'NOT'])
+    if operator == 'NOT':
+        return '(NOT (%s))' % random_expression(rnd, keys, depth + 1)
+    return '(%s %s %s)' % (random_expression(rnd, keys, depth + 1), operator,
+                           random_expression(rnd, keys, depth + 1))
+
+
+def brute_force(expr, query_sets, num_queries):
+    # The expression evaluated with Python sets. The keys are replaced first, so that the
+    # operators are not looked for in them.
+    keys = sorted(query_sets)
+    python_expr = re.sub(r'"([^"]*)"', lambda match: 'sets[%d]' % keys.index(match.group(1)), expr)
+    python_expr = python_expr.replace('AND NOT', '-').replace('AND', '&').replace('OR', '|').replace(
+        'NOT', 'everything -')
+    return sorted(eval(python_expr, {'sets': [query_sets[akey] for akey in keys],
+                                     'everything': set(range(num_queries))}))
+
+
+def test_expressions_match_brute_force(corpus):
+    index, query_list, _ = cluster_query.cluster_index_and_queries(corpus['parsed_bin'], corpus['queries'])
+    keys = [index.key(node_id) for node_id in range(1, min(index.num_nodes, 60))]
+    query_sets = {akey: set(index.qids(index.find(akey)).tolist()) for akey in keys}
+    rnd = random.Random(2)
+    for _ in range(200):
+        expr = random_expression(rnd, keys)
+        assert cluster_query.query_expression(index, expr, len(query_list)).tolist() == \
+            brute_force(expr, query_sets, len(query_list)), expr
+    with pytest.raises(KeyError):
+        cluster_query.query_expression(index, 'no such cluster', len(query_list))
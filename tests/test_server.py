@@ -0,0 +1,50 @@
+import os
+import sys
+import json
+import pytest
+from syntaviz import cluster_query
+from syntaviz import token_index
+
+
+@pytest.fixture(scope='module')
+def server(corpus, tmpdir_factory):
+    # The server reads its arguments when it is imported
+    snapshot = str(tmpdir_factory.mktemp('server').join('index.snap'))
+    cluster_query.build_index(corpus['queries'], corpus['parsed'], corpus['actions'], snapshot)
+    argv = sys.argv
+    sys.argv = ['syntaviz', snapshot]
+    try:
+        from syntaviz import syntaviz
+    finally:
+        sys.argv = argv
+    # The templates are found next to the server, not in the directory it is started from
+    syntaviz.app.root_path = os.path.dirname(os.path.abspath(syntaviz.__file__))
+    return syntaviz
+
+
+def test_cache_stats(server):
+    client = server.app.test_client()
+    before = json.loads(client.get('/cache/stats').data)['pages']
+    first = client.get('/node/1?st_idx_q=3')
+    second = client.get('/node/1?st_idx_q=3')
+    assert first.status_code == 200 and first.data == second.data
+    after = json.loads(client.get('/cache/stats').data)['pages']
+    assert after['misses'] == before['misses'] + 1
+    assert after['hits'] == before['hits'] + 1
+    assert after['entries'] == before['entries'] + 1
+    assert after['size'] >= before['size'] + len(first.data)
+
+
+def test_api_search(server):
+    client = server.app.test_client()
+    queries = server.queries
+    for key, text in [('', 'want'), ('', 'Modem 3'), ('want VB ROOT', 'plan'), ('', 'no such word')]:
+        data = json.loads(client.get('/api/search', query_string={'key': key, 'q': text, 'end': 1000}).data)
+        qids = set(server.clust_head.qids(server.clust_head.find(key)).tolist()) if key else \
+            range(len(queries))
+        words = set(token_index.tokenize(text))
+        expected = [qid for qid in qids if words <= set(token_index.tokenize(queries[qid]))]
+        assert data['unique'] == len(expected)
+        assert sorted(qid for qid, _, _, _ in data['queries']) == sorted(expected)
+        assert data['total'] == sum(server.freq_list[qid] for qid in expected)
+    assert client.get('/api/search?key=no%20such%20cluster&q=want').status_code == 404
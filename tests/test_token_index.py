@@ -0,0 +1,69 @@
+import random
+import numpy as np
+import pytest
+from syntaviz import cluster_index
+from syntaviz import cluster_query
+from syntaviz import token_index
+
+
+def test_tokenize():
+    assert token_index.tokenize('Cancel my  PLAN, now!') == ['cancel', 'my', 'plan', 'now']
+    assert token_index.tokenize(u'caf\xe9 au lait') == [u'caf\xe9', u'au', u'lait']
+    assert token_index.tokenize('caf\xc3\xa9') == [u'caf\xe9']
+
+
+def brute_force(query_list, text, qids=None):
+    words = set(token_index.tokenize(text))
+    if qids is None:
+        qids = range(len(query_list))
+    return [qid for qid in sorted(qids) if words and words <= set(token_index.tokenize(query_list[qid]))]
+
+
+def search_texts(query_list):
+    rnd = random.Random(4)
+    words = sorted(set(aword for aquery in query_list for aword in token_index.tokenize(aquery)))
+    texts = ['', 'no such word', 'WANT', 'modem  want', words[0]]
+    texts += [' '.join(rnd.sample(words, rnd.randint(1, 3))) for _ in range(100)]
+    return texts
+
+
+@pytest.fixture(scope='module')
+def indexes(corpus, tmpdir_factory):
+    # The index of the words built in memory and out of core
+    _, query_list = cluster_query.cluster_counts_and_queries(corpus['parsed'], corpus['queries'])
+    snapshot = str(tmpdir_factory.mktemp('tokens').join('index.snap'))
+    cluster_query.build_index(corpus['queries'], corpus['parsed_bin'], corpus['actions'], snapshot,
+                              memory_mb=0.001)
+    return query_list, token_index.TokenIndex.from_queries(query_list), \
+        cluster_index.load_snapshot(snapshot).token_index
+
+
+def test_out_of_core_index_equals_in_memory_index(indexes):
+    _, in_memory, out_of_core = indexes
+    assert list(in_memory.tokens) == list(out_of_core.tokens)
+    assert np.array_equal(in_memory.token_ptr, out_of_core.token_ptr)
+    assert np.array_equal(in_memory.token_qids, out_of_core.token_qids)
+
+
+def test_search_matches_brute_force(indexes):
+    query_list, in_memory, out_of_core = indexes
+    for text in search_texts(query_list):
+        expected = brute_force(query_list, text)
+        assert in_memory.search(text).tolist() == expected, text
+        assert out_of_core.search(text).tolist() == expected, text
+
+
+def test_search_queries(corpus, indexes):
+    query_list, tokens, _ = indexes
+    clust, _ = cluster_query.cluster_counts_and_queries(corpus['parsed'], corpus['queries'])
+    index, _, _ = cluster_query.cluster_index_and_queries(corpus['parsed_bin'], corpus['queries'])
+    keys = ['', 'want VB ROOT', 'cancel VB ROOT|modem NN dobj']
+    for key in keys:
+        qids = set(index.qids(index.find(key)).tolist()) if key else None
+        for text in search_texts(query_list)[:30]:
+            expected = brute_force(query_list, text, qids)
+            # The array-backed index and the nested clusters
+            assert cluster_query.search_queries(index, key, tokens, text).tolist() == expected
+            assert list(cluster_query.search_queries(clust, key, tokens, text)) == expected
+    with pytest.raises(KeyError):
+        cluster_query.search_queries(index, 'no such cluster', tokens, 'want')